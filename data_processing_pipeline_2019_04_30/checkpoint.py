@@ -0,0 +1,170 @@
+"""
+checkpoint
+~~~~~~~~~~
+Crash-resumable runs of ParserFactory.parse_file_ext.
+
+Every checkpoint_every files the run's progress is made durable:
+    1. the extracted text of the new files is appended to the partial
+       output and fsynced, or the output sink is flushed in streaming mode,
+       and the pdf page sink is flushed
+    2. the names of the new files are appended to the done-list, followed by
+       a marker with the size of the partial output, of the sink and of the
+       page sink, and fsynced
+The done-list is written last, so a file is never marked done before its
+text is on disk. A resumed run cuts the done-list, the partial output and a
+JsonLinesSink output or page sink back to the last marker, which drops a torn
+last line and the records written after the checkpoint. It then restores the done files' text
+and errors and skips them; only the files after the last checkpoint are
+parsed again.
+
+# Data Structure #
+<Ext>_<date>_done.jsonl: {'files': 'file.docx', 'status': 'ok' | 'error'}
+                         {'checkpoint': 1, 'partial_bytes': 1024, 'sink_bytes': None, 'page_bytes': None}
+<Ext>_<date>_partial.jsonl: {'files': 'file.docx', 'raw_text': 'extracted text'}
+"""
+import os
+import json
+from data_processing_pipeline_2019_04_30.output_sinks import JsonLinesSink, iter_json_lines
+
+
+def truncate_file(file_name: str, size: int):
+    """Cut file_name back to size bytes"""
+    if os.path.exists(file_name) and os.path.getsize(file_name) > size:
+        with open(file_name, 'r+b') as f:
+            f.truncate(size)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class RunCheckpoint(object):
+    """Done-list and partial output of one file ext's run"""
+
+    def __init__(self, checkpoint_dir: str, name: str, checkpoint_every: int = 500,
+                 partial_output: bool = True):
+        self.checkpoint_dir = checkpoint_dir
+        self.done_file = name + '_done.jsonl'
+        self.partial_file = name + '_partial.jsonl'
+        self.checkpoint_every = checkpoint_every
+        self.partial_output = partial_output    # False when an output sink holds the text
+        self.done: dict = {}            # {file name: status} of the checkpointed files
+        self.pending: list = []         # done-list entries of the next checkpoint
+        self.partial: JsonLinesSink = None
+        self.page_sink = None           # by-page pdf output, checkpointed with the text
+        self.checkpoint_counter: int = 0    # count of the checkpoints written
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.checkpoint_dir, file_name)
+
+    def start(self, resume: bool = False, sink=None, page_sink=None) -> dict:
+        """Open the checkpoint. With resume, load the done-list of the last run,
+        cut its outputs back to the last checkpoint and return the text of its
+        done files, otherwise start over.
+        """
+        self.page_sink = page_sink
+        mapping = {}
+        marker = {}
+        if resume:
+            marker = self.load_done_list()
+        else:
+            self.remove()
+        if self.partial_output:
+            truncate_file(self.path(self.partial_file), marker.get('partial_bytes') or 0)
+            if os.path.exists(self.path(self.partial_file)):
+                for record in iter_json_lines(self.checkpoint_dir, self.partial_file):
+                    if self.done.get(record['files']) == 'ok':
+                        mapping[record['files']] = record['raw_text']
+            # the checkpoint decides when the partial output is flushed
+            self.partial = JsonLinesSink(write_path=self.checkpoint_dir, file_name=self.partial_file,
+                                         flush_every=2 ** 62, append=resume)
+        if resume:
+            # the records streamed after the last checkpoint are parsed again
+            if sink is not None and hasattr(sink, 'truncate'):
+                sink.truncate(marker.get('sink_bytes') or 0)
+            if page_sink is not None and hasattr(page_sink, 'truncate'):
+                page_sink.truncate(marker.get('page_bytes') or 0)
+        return mapping
+
+    def load_done_list(self) -> dict:
+        """Load the files of the complete checkpoints in the done-list and cut off
+        the entries of an unfinished one. Returns the last checkpoint's marker.
+        """
+        marker = {}
+        if not os.path.exists(self.path(self.done_file)):
+            return marker
+        batch = {}
+        size = 0        # bytes of the done-list up to the last marker
+        position = 0
+        with open(self.path(self.done_file), 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break   # torn by the crash
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                position += len(line)
+                if 'checkpoint' in entry:
+                    self.done.update(batch)
+                    batch = {}
+                    marker = entry
+                    size = position
+                else:
+                    batch[entry['files']] = entry['status']
+        truncate_file(self.path(self.done_file), size)
+        self.checkpoint_counter = marker.get('checkpoint', 0)
+        return marker
+
+    def files_with_status(self, status: str) -> list:
+        return [file_name for file_name, s in self.done.items() if s == status]
+
+    def is_done(self, current_file: str) -> bool:
+        return os.path.basename(current_file) in self.done
+
+    def add(self, mapping: dict, error_files: list, sink=None):
+        """Record the output and errors of the files parsed since the last call"""
+        if self.partial is not None:
+            self.partial.write(mapping)
+        self.pending.extend({'files': file_name, 'status': 'ok'} for file_name in mapping)
+        self.pending.extend({'files': file_name, 'status': 'error'} for file_name in error_files)
+        if len(self.pending) >= self.checkpoint_every:
+            self.save(sink)
+
+    def save(self, sink=None):
+        """Make the pending files durable: their text first, then the done-list"""
+        if not self.pending:
+            return
+        marker = {'checkpoint': self.checkpoint_counter + 1, 'partial_bytes': None,
+                  'sink_bytes': None, 'page_bytes': None}
+        if self.partial is not None:
+            self.partial.flush()
+            marker['partial_bytes'] = self.partial.tell()
+        if sink is not None:
+            sink.flush()
+            if hasattr(sink, 'tell'):
+                marker['sink_bytes'] = sink.tell()
+        if self.page_sink is not None:
+            self.page_sink.flush()
+            if hasattr(self.page_sink, 'tell'):
+                marker['page_bytes'] = self.page_sink.tell()
+        with open(self.path(self.done_file), 'a', encoding='utf-8') as f:
+            for entry in self.pending + [marker]:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update((entry['files'], entry['status']) for entry in self.pending)
+        self.pending = []
+        self.checkpoint_counter += 1
+
+    def close(self, sink=None):
+        self.save(sink)
+        if self.partial is not None:
+            self.partial.close()
+            self.partial = None
+
+    def remove(self):
+        """Delete the checkpoint once the run's output is loaded, so a rerun starts over"""
+        self.close()
+        for file_name in (self.done_file, self.partial_file):
+            if os.path.exists(self.path(file_name)):
+                os.remove(self.path(file_name))
+        self.done = {}
@@ -0,0 +1,120 @@
+"""
+connection_pool
+~~~~~~~~~~~~~~~
+Authenticated ssh transports shared by SftpConnection, Hive, HivCli and HDFS.
+
+One paramiko Transport is kept alive per (host, port, username). Every
+sftp session and remote command runs on a new channel of that transport,
+so a pipeline step no longer pays for a tcp connect, key exchange and
+authentication. A transport that fails its health check is reconnected.
+
+The channels of a transport share its tcp connection and its single cipher
+stream, so bulk transfers that should run side by side ask for transports
+of their own with transport_index, e.g. SftpConnection.upload_files.
+"""
+import atexit
+import socket
+import threading
+import paramiko
+
+
+class ConnectionPool(object):
+    """Pool of authenticated paramiko Transports"""
+
+    def __init__(self, keepalive: int = 30, timeout: int = 60):
+        self.keepalive = keepalive      # seconds between keepalive packets
+        self.timeout = timeout          # seconds to wait for the tcp connection
+        self.transports: dict = {}      # {(host, port, username, transport_index): paramiko.Transport}
+        self.lock = threading.Lock()
+
+        # pool counters
+        self.connect_counter: int = 0   # count of the transports opened
+        self.reuse_counter: int = 0     # count of the transports handed out again
+
+    @staticmethod
+    def is_healthy(transport: paramiko.Transport) -> bool:
+        """check that the transport is authenticated and the server still answers"""
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except (EOFError, OSError, paramiko.SSHException):
+            return False
+
+    def open_transport(self, host: str, port: int, username: str, password: str) -> paramiko.Transport:
+        sock = socket.create_connection((host, port), timeout=self.timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.set_keepalive(self.keepalive)
+            transport.connect(username=username, password=password)
+        except Exception:
+            transport.close()
+            raise
+        self.connect_counter += 1
+        print(f"Ssh transport to {host}:{port} opened")
+        return transport
+
+    def get_transport(self, host: str, port: int, username: str, password: str,
+                      reconnect: bool = False, transport_index: int = 0) -> paramiko.Transport:
+        """Return the live transport of host, port and username, connecting if needed.
+        Each transport_index is a separate tcp connection to the host.
+        """
+        key = (host, int(port), username, transport_index)
+        with self.lock:
+            transport = self.transports.get(key)
+            if not reconnect and self.is_healthy(transport):
+                self.reuse_counter += 1
+                return transport
+            if transport is not None:
+                print(f"Ssh transport to {host}:{port} is down, reconnecting")
+                transport.close()
+            transport = self.open_transport(host, int(port), username, password)
+            self.transports[key] = transport
+            return transport
+
+    def open_on_transport(self, host: str, port: int, username: str, password: str, opener,
+                          transport_index: int = 0):
+        """Call opener with the pooled transport, reconnecting once if the transport dropped.
+        A channel the server refuses, e.g. past its MaxSessions, raises paramiko.ChannelException
+        and the transport is kept, with the channels other threads have open on it.
+        """
+        transport = self.get_transport(host, port, username, password, transport_index=transport_index)
+        try:
+            return opener(transport)
+        except paramiko.ChannelException:
+            raise
+        except (EOFError, paramiko.SSHException):
+            if transport.is_active():
+                raise
+            # the health check replaces the dropped transport, unless another thread already did
+            return opener(self.get_transport(host, port, username, password, transport_index=transport_index))
+
+    def open_channel(self, host: str, port: int, username: str, password: str,
+                     transport_index: int = 0) -> paramiko.Channel:
+        """Open a session channel, reconnecting once if the transport dropped"""
+        return self.open_on_transport(host, port, username, password,
+                                      lambda transport: transport.open_session(), transport_index)
+
+    def open_sftp(self, host: str, port: int, username: str, password: str,
+                  transport_index: int = 0) -> paramiko.SFTPClient:
+        """Open an sftp session, reconnecting once if the transport dropped"""
+        return self.open_on_transport(host, port, username, password, paramiko.SFTPClient.from_transport,
+                                      transport_index)
+
+    def close(self, host: str, port: int, username: str):
+        """Close every transport of host, port and username"""
+        with self.lock:
+            for key in [k for k in self.transports if k[:3] == (host, int(port), username)]:
+                self.transports.pop(key).close()
+
+    def close_all(self):
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports = {}
+
+
+# the pool shared by every connection of the process
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
@@ -0,0 +1,164 @@
+"""
+dag_runner
+~~~~~~~~~~
+Asyncio runner for the pipeline's steps.
+
+Each step is a task with explicit dependencies. A task starts as soon as
+the tasks it depends on finish, so the upload and Hive load of one file
+ext overlap the parsing of the next one. There are no sleeps or polling:
+a task waits on the completion of its dependencies' futures.
+
+Tasks run on one of two executors:
+    - 'cpu': parse steps, at most cpu_workers at a time. A parse step
+      can fan out further with ParserFactory.parse_file_ext(workers=...)
+    - 'io': uploads and Hive statements, at most io_workers at a time
+A task can also take a named slot, e.g. 'upload' or 'hive', to limit how
+many tasks of a kind run at once regardless of the executor's size.
+
+At the deadline the tasks that haven't started are cancelled and
+cancel_event is set. A running task can't be interrupted: it stops early
+only if it checks cancel_event, e.g. ParserFactory.parse_file_ext(stop_event=...)
+between files. Any other running task, e.g. a Hive statement, runs to the
+end, and the interpreter waits for it before exiting.
+
+# Example #
+dag = DagRunner(cpu_workers=1, io_workers=4)
+dag.add('parse_docx', parse, 'docx', executor='cpu')
+dag.add('upload_docx', upload, dag.output('parse_docx'), depends_on=['parse_docx'])
+results = dag.run()
+"""
+import time
+import asyncio
+import functools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# outcome of a task: 'ok', 'failed', 'skipped' when a dependency did not finish,
+# or 'timeout' when the deadline passed before it finished
+TaskResult = namedtuple('TaskResult', ['name', 'status', 'result', 'error', 'seconds'])
+
+
+def timed(func, *args, **kwargs):
+    """func's result and run time, without the time spent waiting for an executor"""
+    start_time = time.time()
+    return func(*args, **kwargs), time.time() - start_time
+
+
+class TaskOutput(object):
+    """Placeholder argument, replaced by the result of task name when the task runs"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class DagTask(object):
+    """A pipeline step and the names of the tasks it depends on"""
+
+    def __init__(self, name: str, func, args: tuple, kwargs: dict, depends_on: list, executor: str,
+                 slot: str = None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.depends_on = list(depends_on)
+        self.executor = executor
+        self.slot = slot
+
+
+class DagRunner(object):
+    """Run a DAG of pipeline steps on cpu and io thread pools"""
+
+    EXECUTORS: tuple = ('cpu', 'io')
+
+    def __init__(self, cpu_workers: int = 1, io_workers: int = 4, slots: dict = None):
+        self.cpu_workers = cpu_workers
+        self.io_workers = io_workers
+        self.slots: dict = dict(slots or {})   # {slot: number of its tasks that can run at once}
+        self.tasks: dict = {}       # {name: DagTask}, in the order they were added
+        self.results: dict = {}     # {name: TaskResult}, after run()
+        self.cancel_event = threading.Event()   # set when the deadline passes
+
+    def add(self, name: str, func, *args, depends_on: list = (), executor: str = 'io',
+            slot: str = None, **kwargs) -> str:
+        """Add the task name, which runs func(*args, **kwargs) after depends_on"""
+        if name in self.tasks:
+            raise ValueError(f"ValueError: task {name} was already added")
+        if executor not in self.EXECUTORS:
+            raise ValueError(f"ValueError: executor must be one of {self.EXECUTORS}")
+        if slot is not None and slot not in self.slots:
+            raise KeyError(f"KeyError: task {name} uses unknown slot {slot}")
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                # tasks are added after their dependencies, which also rules out cycles
+                raise KeyError(f"KeyError: task {name} depends on unknown task {dependency}")
+        self.tasks[name] = DagTask(name, func, args, kwargs, depends_on, executor, slot)
+        return name
+
+    @staticmethod
+    def output(name: str) -> TaskOutput:
+        """Pass the result of task name as an argument of another task"""
+        return TaskOutput(name)
+
+    def resolve(self, value):
+        return self.results[value.name].result if isinstance(value, TaskOutput) else value
+
+    async def run_task(self, task: DagTask, futures: dict, executors: dict, semaphores: dict) -> TaskResult:
+        # wait for the dependencies to complete
+        for dependency in task.depends_on:
+            await futures[dependency]
+        failed = [d for d in task.depends_on if self.results[d].status != 'ok']
+        if failed:
+            result = TaskResult(task.name, 'skipped', None, f"dependency {failed[0]} did not finish", 0.0)
+            self.results[task.name] = result
+            print(f"Dag: skipped {task.name}: {result.error}")
+            return result
+
+        args = [self.resolve(a) for a in task.args]
+        kwargs = {k: self.resolve(v) for k, v in task.kwargs.items()}
+        start_time = time.time()
+        loop = asyncio.get_running_loop()
+        try:
+            call = functools.partial(timed, task.func, *args, **kwargs)
+            if task.slot is not None:
+                async with semaphores[task.slot]:
+                    value, seconds = await loop.run_in_executor(executors[task.executor], call)
+            else:
+                value, seconds = await loop.run_in_executor(executors[task.executor], call)
+            result = TaskResult(task.name, 'ok', value, None, seconds)
+        except Exception as e:
+            result = TaskResult(task.name, 'failed', None, f"{e.__class__.__name__}: {e}",
+                                time.time() - start_time)
+            print(f"Dag: {task.name} failed: {result.error}")
+        self.results[task.name] = result
+        print(f"Dag: {task.name} {result.status} in {result.seconds:.1f}s")
+        return result
+
+    async def run_async(self, deadline: float = None) -> dict:
+        """Run every task, cancelling the unfinished ones after deadline seconds"""
+        executors = {'cpu': ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix='dag_cpu'),
+                     'io': ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='dag_io')}
+        semaphores = {slot: asyncio.Semaphore(size) for slot, size in self.slots.items()}
+        futures = {}
+        try:
+            for name, task in self.tasks.items():
+                futures[name] = asyncio.ensure_future(self.run_task(task, futures, executors, semaphores))
+            done, pending = await asyncio.wait(futures.values(), timeout=deadline)
+            if pending:
+                self.cancel_event.set()
+            for name, future in futures.items():
+                if future in pending:
+                    future.cancel()
+                    self.results[name] = TaskResult(name, 'timeout', None, 'deadline exceeded', 0.0)
+                    print(f"Dag: {name} did not finish within the {deadline}s deadline")
+        finally:
+            # running steps can't be interrupted, don't wait for them past the deadline
+            for executor in executors.values():
+                executor.shutdown(wait=deadline is None)
+        return self.results
+
+    def run(self, deadline: float = None) -> dict:
+        """Run the DAG and return the TaskResult of every task"""
+        self.results = {}
+        self.cancel_event.clear()
+        return asyncio.run(self.run_async(deadline=deadline))
@@ -9,30 +9,39 @@ import os
 import re
 import abc
 
-import string
 import pickle
 import zipfile
+import time
+import threading
 import subprocess
 import xlsxwriter
 import pandas as pd
 from email import policy
 from pprint import pprint
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from bs4 import BeautifulSoup
 from PyPDF2 import PdfFileReader
 from email.parser import BytesParser
-from xml.etree.cElementTree import XML
+from xml.etree.ElementTree import iterparse
+from collections import namedtuple
 from typing import Dict, List, Type, TypeVar, NewType, AnyStr, ByteString
-from data_processing_pipeline_2019_04_30.file_encoders import (destinations, specialchars,
-                           BARS, TABS, PUNCTUATION, SPACES, WHITESPACE,
-                           NEWLINE, RTF_ENCODING)
 from data_processing_pipeline_2019_04_30.logging_config import BaseLogger
+from data_processing_pipeline_2019_04_30.output_sinks import (OutputSinkInterface, JsonLinesSink,
+                           ParquetSink, PAGE_SCHEMA)
+from data_processing_pipeline_2019_04_30.extraction_cache import ExtractionCache
+from data_processing_pipeline_2019_04_30.checkpoint import RunCheckpoint
+from data_processing_pipeline_2019_04_30.sandbox import SandboxedExtractor
+from data_processing_pipeline_2019_04_30.pdf_ocr import OCREngine, page_images, count_page_images
+from data_processing_pipeline_2019_04_30.text_normalizer import normalize_text
+from data_processing_pipeline_2019_04_30.rtf_decoder import decode_rtf_file
+from data_processing_pipeline_2019_04_30.ole_doc import extract_doc_text
 from data_processing_pipeline_2019_04_30.configuration import (personal_umbrella, sa_claims,
         pickle_path, mapping_file, log_file_path, error_file_path,
         eml_write_path, rtf_write_path, doc_write_path,
         docx_write_path, pdf_write_path, r_path, r_executable,
                            r_script_one, r_script_two, r_script_three,
-                           doc_test_write_path, pdf_pickle_path, prod_delta_metadata)
+                           pdf_pickle_path, prod_delta_metadata)
 
 # date configuration
 d = str(datetime.today())[:10].replace("-","_")
@@ -62,6 +71,12 @@ DataMapping = NewType('DataMapping', Dict[File, MinedText])
 ####################################################################################################
 class FileParserInterface(metaclass=abc.ABCMeta):
     """File Parser Interface"""
+    parser_version: str = '1.1'     # bump when a parser's output changes to invalidate the cache
+    cache_options: tuple = ()       # attributes that change the output, part of the cache key
+
+    def output_options(self) -> dict:
+        """The options that change the extracted text, see ExtractionCache.cache_key"""
+        return {option: getattr(self, option) for option in self.cache_options}
 
     @abc.abstractmethod
     def extract_text(self, current_file):
@@ -76,19 +91,79 @@ class FileParserInterface(metaclass=abc.ABCMeta):
         pass
 
 
+class DirectoryScanner(object):
+    """Walk a directory once and bucket its files by extension.
+
+    # Data Structure #
+    {'docx': [DirEntry, ...], 'pdf': [DirEntry, ...], ...}
+    """
+
+    def __init__(self, file_path, recursive: bool = False):
+        self.file_path = file_path
+        self.recursive = recursive
+        self.buckets: Dict[str, List[os.DirEntry]] = None
+        self.lock = threading.Lock()
+
+    def scan(self) -> dict:
+        """List the directory tree, only on the first call. Concurrent parse steps
+        share the scanner, so the listing is only published once it is complete.
+        """
+        with self.lock:
+            if self.buckets is not None:
+                return self.buckets
+            buckets = {}
+            directories = [self.file_path]
+            while directories:
+                directory = directories.pop()
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            # is_dir and is_file use the file type cached by scandir
+                            if entry.is_dir(follow_symlinks=False):
+                                if self.recursive:
+                                    directories.append(entry.path)
+                            elif entry.is_file():
+                                dot = entry.name.rfind('.')
+                                file_ext = entry.name[dot + 1:] if dot > 0 else ''
+                                buckets.setdefault(file_ext, []).append(entry)
+                except OSError as e:
+                    logger.error(error=f"OSError: Could not scan directory: {directory}")
+                    logger.error(error=f"Python Exception: {e}")
+            self.buckets = buckets
+            return self.buckets
+
+    def entries(self, file_ext) -> list:
+        """DirEntry objects of the files with file_ext"""
+        return self.scan().get(file_ext, [])
+
+    def paths(self, file_ext) -> list:
+        """Full paths of the files with file_ext"""
+        return [entry.path for entry in self.entries(file_ext)]
+
+    def file_types(self) -> set:
+        """The unique set of file types, e.g. {'.docx', '.pdf'}"""
+        return {'.' + file_ext for file_ext in self.scan() if file_ext}
+
+
 class FileGenerator(object):
     """File Generator Interface"""
 
-    def __init__(self, file_path, file_ext):
+    def __init__(self, file_path, file_ext, scanner: DirectoryScanner = None):
         self.file_path = file_path
         self.file_ext = file_ext
+        self.scanner = scanner
 
     def __iter__(self):
         try:
-            if os.path.isdir(self.file_path):
-                for name in os.scandir(self.file_path):
-                    if os.path.splitext(os.path.basename(name))[-1] == '.'+self.file_ext:
-                        yield os.path.join(self.file_path, os.path.basename(name))
+            if self.scanner is not None:
+                # reuse the single pass of the scanner
+                yield from self.scanner.paths(self.file_ext)
+            elif os.path.isdir(self.file_path):
+                suffix = '.' + self.file_ext
+                with os.scandir(self.file_path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(suffix) and entry.name != suffix:
+                            yield os.path.join(self.file_path, entry.name)
         except StopIteration:
             print("Finished processing files")
 
@@ -121,9 +196,7 @@ class EmlParser(FileParserInterface):
                             soup = BeautifulSoup(part.get_content(), 'html.parser')
                             body = soup.findAll(text=True)  # extract the text
                             # process the text list into a formatted string
-                            body = ' '.join(body) \
-                                .translate(str.maketrans('', '', string.punctuation)) \
-                                .lower()
+                            body = normalize_text(' '.join(body))
                             self.mapping_dict.update({os.path.basename(current_file): body})
                             self.file_counter += 1
                             return {os.path.basename(current_file): body}
@@ -149,16 +222,83 @@ class EmlParser(FileParserInterface):
         """
         pass
 
+def clean_pdf_page_text(text: str) -> str:
+    """Process the text extracted from a pdf page"""
+    return normalize_text(str(text))
+
+
+# text layer of a pdf page: page number, text, error, number of images, seconds to extract
+PdfPage = namedtuple('PdfPage', ['page', 'text', 'error', 'images', 'seconds'])
+
+
+def read_pdf_pages(pdf_reader: PdfFileReader, start: int, stop: int):
+    """Yield a PdfPage for each page in range(start, stop)"""
+    for pg in range(start, stop):
+        start_time = time.perf_counter()
+        try:
+            page = pdf_reader.getPage(pg)
+            text = clean_pdf_page_text(page.extractText())
+            yield PdfPage(pg, text, None, count_page_images(page), time.perf_counter() - start_time)
+        except Exception as e:
+            yield PdfPage(pg, None, str(e), 0, time.perf_counter() - start_time)
+
+
+def extract_pdf_page_range(current_file: str, start: int, stop: int) -> list:
+    """Extract a range of pages of a pdf.
+    NOTE:
+        Runs inside a worker process, so it opens its own PdfFileReader.
+    """
+    with open(current_file, 'rb') as f:
+        return list(read_pdf_pages(PdfFileReader(f), start, stop))
+
+
+def page_record(current_file: str, pg: int, text: str, routing: dict = None) -> dict:
+    """Record of the by-page pdf output"""
+    record = {'filename': current_file, 'page': pg, 'text': text}
+    if routing is not None:
+        record.update(routing)
+    return record
+
+
 class PdfParser(FileParserInterface):
     """Pdf File Parser
     If the content of the pdf is an empty string
     use pytesseract. else: user PyPDF2
+
+    Pdfs with at least 2 * pages_per_task pages are split into page ranges that
+    are extracted by page_workers processes. If page_sink is set, every page is
+    appended to it as soon as it is extracted instead of to pdf_content_by_page.
+
+    Pages whose text layer has fewer than min_text_chars characters but do
+    have images are OCRed when ocr_workers is set (0 OCRs in this process).
+    The few characters of an OCRed page's text layer are kept ahead of its
+    OCR text, unless the OCR text already has them.
+    The route of every page ('text', 'ocr' or 'empty') and its timings are
+    recorded with the page.
     """
-    def __init__(self, file_path):
+    parser_version: str = '1.2'    # 1.2: keeps the text layer of the OCRed pages
+    def __init__(self, file_path, page_workers: int = None, pages_per_task: int = 25,
+                 page_sink: OutputSinkInterface = None, ocr_workers: int = None,
+                 min_text_chars: int = 20):
         self.file_path = file_path
         self.mapping_dict: DataMapping = {}
         self.pdf_content_by_page: List[Dict[AnyStr]] = []
         self.pdf_by_page_counter: int = 0
+        self.document_pages: dict = None    # pages of the last parsed pdf
+
+        # page parallel extraction
+        self.page_workers = page_workers
+        self.pages_per_task = pages_per_task
+        self.page_sink = page_sink
+        self.page_executor: ProcessPoolExecutor = None
+
+        # text layer detection
+        self.ocr_workers = ocr_workers
+        self.min_text_chars = min_text_chars
+        self.ocr_engine: OCREngine = None
+        self.text_page_counter: int = 0     # pages with a usable text layer
+        self.ocr_page_counter: int = 0      # image only pages routed to OCR
+        self.empty_page_counter: int = 0    # pages without text or images
 
         # file counters
         self.file_counter: int = 0  # count of the files successfully parsed
@@ -168,56 +308,163 @@ class PdfParser(FileParserInterface):
         # logging configuration
         logger.info(info='starting pdf parsing')
 
+    def output_options(self) -> dict:
+        # the number of OCR processes doesn't change the text, whether pages are OCRed does
+        return {'ocr': self.ocr_workers is not None, 'min_text_chars': self.min_text_chars}
+
     def extract_text_with_adobe(self):
         """Extract text using adobe Acrobat"""
 
+    def start_document(self, current_file: str):
+        """add current pdf to pdf_content_by_page"""
+        self.document_pages = {'filename': current_file}
+        if self.page_sink is None:
+            self.pdf_content_by_page.append(self.document_pages)  # added 5/2/2019
+
+    def add_page(self, current_file: str, pg: int, text: str, routing: dict = None):
+        """Record an extracted page, streaming it to the page sink if there is one"""
+        self.document_pages.update({f"page {pg}": text})
+        if routing is not None:
+            self.document_pages.setdefault('routing', {})[pg] = routing
+        if self.page_sink is not None:
+            self.page_sink.write_record(page_record(current_file, pg, text, routing))
+
+    def restore_pages(self, current_file: str, pages: dict):
+        """Record the pages of a pdf that was not parsed again, e.g. an extraction cache hit"""
+        self.start_document(current_file)
+        routing = pages.get('routing', {})
+        for key, text in pages.items():
+            if key.startswith('page '):
+                pg = int(key.split(' ')[-1])
+                self.add_page(current_file, pg, text, routing.get(pg))
+                route = (routing.get(pg) or {}).get('route')
+                if route == 'ocr':
+                    self.ocr_page_counter += 1
+                elif route == 'empty':
+                    self.empty_page_counter += 1
+                elif route == 'text':
+                    self.text_page_counter += 1
+        self.pdf_by_page_counter += 1
+
+    def route_page(self, page: PdfPage) -> dict:
+        """Decide whether the page's text layer is usable or the page has to be OCRed"""
+        chars = len(page.text.replace(' ', ''))
+        routing = {'route': 'text', 'chars': chars, 'images': page.images,
+                   'extract_seconds': round(page.seconds, 4)}
+        if chars < self.min_text_chars:
+            if page.images and self.ocr_workers is not None:
+                routing['route'] = 'ocr'
+            elif not chars:
+                routing['route'] = 'empty'
+        return routing
+
+    def ocr_pages(self, current_file: str, routed_pages: dict, text_layers: dict = None) -> dict:
+        """OCR the images of the pages routed to OCR. Returns {page number: text}
+        :param text_layers: {page number: text} of the pages' short text layers
+        """
+        if self.ocr_engine is None:
+            self.ocr_engine = OCREngine(workers=self.ocr_workers)
+        image_texts = {pg: [] for pg in routed_pages}
+        image_pages = {}    # {image name: page number}
+
+        def payloads():
+            with open(current_file, 'rb') as f:
+                pdf_reader = PdfFileReader(f)
+                for pg in sorted(routed_pages):
+                    for payload in page_images(pdf_reader.getPage(pg), f'page{pg}'):
+                        image_pages[payload.name] = pg
+                        yield payload
+
+        for name, text, error, seconds in self.ocr_engine.ocr_images(payloads()):
+            pg = image_pages[name]
+            routing = routed_pages[pg]
+            routing['ocr_seconds'] = round(routing.get('ocr_seconds', 0) + seconds, 4)
+            if error is not None:
+                logger.error(error=f"Error ocring image: {name} from file {os.path.basename(current_file)}")
+                logger.error(error=f"Python Exception: {error}")
+            else:
+                # sort the page's images by their position on the page
+                image_texts[pg].append((int(os.path.splitext(name)[0].split('_')[-1]), text))
+
+        pages = {}
+        for pg in sorted(routed_pages):
+            text = clean_pdf_page_text(' '.join(t for _, t in sorted(image_texts[pg])))
+            text_layer = (text_layers or {}).get(pg)
+            if text_layer and text_layer not in text:
+                # e.g. a typed claim number on a scanned form
+                text = clean_pdf_page_text(text_layer + ' ' + text)
+            self.add_page(current_file, pg, text, routed_pages[pg])
+            self.ocr_page_counter += 1
+            pages[pg] = text
+        return pages
+
+    def page_results(self, current_file: str, num_pages: int, pdf_reader: PdfFileReader):
+        """Yield the extracted pages of the current file as they finish"""
+        if not self.page_workers or self.page_workers < 2 or num_pages < 2 * self.pages_per_task:
+            yield from read_pdf_pages(pdf_reader, 0, num_pages)
+            return
+
+        if self.page_executor is None:
+            self.page_executor = ProcessPoolExecutor(max_workers=self.page_workers)
+        futures = [self.page_executor.submit(extract_pdf_page_range, current_file,
+                                             start, min(start + self.pages_per_task, num_pages))
+                   for start in range(0, num_pages, self.pages_per_task)]
+        for future in as_completed(futures):
+            yield from future.result()
+
+    def shutdown_page_pool(self):
+        """Stop the page and OCR worker processes"""
+        if self.page_executor is not None:
+            self.page_executor.shutdown()
+            self.page_executor = None
+        if self.ocr_engine is not None:
+            self.ocr_engine.shutdown()
+            self.ocr_engine = None
+
     def extract_text(self, current_file):
         try:
-            # add current pdf to pdf_content_by_page
-            self.pdf_content_by_page.append({'filename': current_file})  # added 5/2/2019
+            self.start_document(current_file)
 
             with open(current_file, 'rb') as f:
                 pdf_reader = PdfFileReader(f)
-                pages = []
-                pg = 0
-                while pg < pdf_reader.numPages:
-                    try:
-                        current_page = pdf_reader.getPage(pg)
-
-                        # extract the contents of the pdf
-                        text = list(str(current_page.extractText()).splitlines())
-                        text = ''.join(text)
-
-                        # process the text
-                        text = re.sub('(\s+|\t|\r|\n)', ' ', text) \
-                            .strip() \
-                            .lower()
-
-                        # remove punctuation from text
-                        text = text.translate((None, PUNCTUATION))
-                        text = ' '.join(text.split())
-
-                        # update the pdf_content_by_page
-                        self.pdf_content_by_page[self.pdf_by_page_counter].update({f"page {pg}": text}) # added 5/2/2019
-                        #self.pdf_content_by_page[current_file].update({pg: text}) # added 5/2/2019
-
-                        pages.append(text)
-                        pg += 1  # increment the page counter
-
-                    except Exception as e:
-                        logger.error(error=f"Error reading page: {pg} "
+                num_pages = pdf_reader.numPages
+                pages = {}
+                routed_pages = {}   # {page number: routing} of the pages without a text layer
+                text_layers = {}    # {page number: text} of the routed pages
+                for page in self.page_results(current_file, num_pages, pdf_reader):
+                    if page.error is not None:
+                        logger.error(error=f"Error reading page: {page.page} "
                                     f"from file {os.path.basename(current_file)}")
-                        logger.error(error=f"Python Exception: {e}")
+                        logger.error(error=f"Python Exception: {page.error}")
                         self.error_file_counter += 1
                         self.error_files.append(os.path.basename(current_file))
-                        # increment the page number
-                        pg += 1  # skip the page that raised an error
+                        continue  # skip the page that raised an error
+
+                    routing = self.route_page(page)
+                    if routing['route'] == 'ocr':
+                        routed_pages[page.page] = routing
+                        text_layers[page.page] = page.text
+                        continue
+                    elif routing['route'] == 'empty':
+                        self.empty_page_counter += 1
+                    else:
+                        self.text_page_counter += 1
+
+                    # update the pdf_content_by_page
+                    self.add_page(current_file, page.page, page.text, routing)
+                    pages[page.page] = page.text
+
+                if routed_pages:
+                    pages.update(self.ocr_pages(current_file, routed_pages, text_layers))
+
+                # pages from the page workers finish out of order
+                text = ''.join(pages[pg] for pg in sorted(pages))
 
                 # increment the page counter
                 self.pdf_by_page_counter += 1   # added 5/2/2019
-                self.mapping_dict.update({os.path.basename(current_file): ''.join(pages)})
+                self.mapping_dict.update({os.path.basename(current_file): text})
                 self.file_counter += 1
-                return {os.path.basename(current_file): ''.join(pages)}
+                return {os.path.basename(current_file): text}
         except OSError as e:
             if current_file in self.error_files:
                 pass
@@ -262,14 +509,8 @@ class TxtParser(FileParserInterface):
     def extract_text(self, current_file):
         try:
             with open(current_file, 'r', errors='replace', encoding='utf-8') as f:
-                text = f.read()
-                # text =  text.encode('utf-8')
-                text = SPACES.sub(" ", text)
-                text = text[6:]
-                text = BARS.sub("", text)
-                text = NEWLINE.sub(" ", text)
-                text = TABS.sub(" ", text)
-                text = text.translate(str.maketrans('', '', string.punctuation)).lower()
+                # skip the header of the converted csv file
+                text = normalize_text(f.read(), skip=6)
                 self.mapping_dict.update({os.path.basename(current_file): text})
                 self.file_counter += 1
                 return {os.path.basename(current_file): text}
@@ -287,8 +528,11 @@ class TxtParser(FileParserInterface):
 
 class RtfParser(FileParserInterface):
     """Rtf File Parser"""
-    def __init__(self, file_path):
+    parser_version: str = '1.2'    # 1.2: streaming decoder, code page aware
+
+    def __init__(self, file_path, chunk_size: int = 1024 * 1024):
         self.file_path = file_path
+        self.chunk_size = chunk_size    # bytes of the rtf file decoded at a time
         self.mapping_dict: DataMapping = {}
 
         # file counters
@@ -299,78 +543,21 @@ class RtfParser(FileParserInterface):
     def extract_text(self, current_file) -> dict:
         """Extract the current rtf file's text"""
         try:
-            with open(current_file, 'rb') as f:
-                text = f.read().decode('utf-8')
-                stack = []
-                ignorable = False
-                ucskip = 1
-                curskip = 0
-                out = []  # Output buffer.
-                for match in RTF_ENCODING.finditer(text):
-                    word, arg, hex, char, brace, tchar = match.groups()
-                    if brace:
-                        curskip = 0
-                        if brace == '{':
-                            # Push state
-                            stack.append((ucskip, ignorable))
-                        elif brace == '}':
-                            # Pop state
-                            ucskip, ignorable = stack.pop()
-                    elif char:  # \x (not a letter)
-                        curskip = 0
-                        if char == '~':
-                            if not ignorable:
-                                out.append('\xA0')
-                        elif char in '{}\\':
-                            if not ignorable:
-                                out.append(char)
-                        elif char == '*':
-                            ignorable = True
-                    elif word:  # \foo
-                        curskip = 0
-                        if word in destinations:
-                            ignorable = True
-                        elif ignorable:
-                            pass
-                        elif word in specialchars:
-                            out.append(specialchars[word])
-                        elif word == 'uc':
-                            ucskip = int(arg)
-                        elif word == 'u':
-                            c = int(arg)
-                            if c < 0: c += 0x10000
-                            if c > 127:
-                                out.append(chr(c))  # NOQA
-                            else:
-                                out.append(chr(c))
-                            curskip = ucskip
-                    elif hex:  # \'xx
-                        if curskip > 0:
-                            curskip -= 1
-                        elif not ignorable:
-                            c = int(hex, 16)
-                            if c > 127:
-                                out.append(chr(c))  # NOQA
-                            else:
-                                out.append(chr(c))
-                    elif tchar:
-                        if curskip > 0:
-                            curskip -= 1
-                        elif not ignorable:
-                            out.append(tchar)
-                    result = ''.join(out)
-                result = ''.join(ch for ch in result if ch not in PUNCTUATION)
-                result = SPACES.sub(" ", result)
-                result = ''.join(result)
-
-                # update self.fileDict
-                self.mapping_dict.update({os.path.basename(current_file): result.lower()})
-                self.file_counter += 1
-                return {os.path.basename(current_file): result.lower()}
-        except OSError as e:
+            result = normalize_text(''.join(decode_rtf_file(current_file, chunk_size=self.chunk_size)))
+
+            # update self.fileDict
+            self.mapping_dict.update({os.path.basename(current_file): result})
             self.file_counter += 1
+            return {os.path.basename(current_file): result}
+        except OSError as e:
+            self.error_file_counter += 1
             self.error_files.append(os.path.basename(current_file))  # added: 4/16/2019
-            logger.error(error=f"OSError: Could not parse email: {os.path.basename(current_file)}")
+            logger.error(error=f"OSError: Could not parse rtf: {os.path.basename(current_file)}")
+            logger.error(error=f"Python Exception: {e}")
+        except Exception as e:
+            self.error_file_counter += 1
+            self.error_files.append(os.path.basename(current_file))
+            logger.error(error=f"Exception: Could not parse rtf: {os.path.basename(current_file)}")
             logger.error(error=f"Python Exception: {e}")
 
     def load_metadata(self, file_path, metadata_file):
@@ -379,12 +566,59 @@ class RtfParser(FileParserInterface):
         """
         pass
 
+# word xml tags
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+PARA = WORD_NAMESPACE + 'p'
+TEXT = WORD_NAMESPACE + 't'
+
+# optional docx parts, e.g. word/header1.xml, word/footnotes.xml
+DOCX_EXTRA_PARTS = ('header', 'footer', 'footnotes', 'endnotes')
+
+
+def docx_parts(names: list, extra_parts: tuple = ()) -> list:
+    """The zip members to extract, word/document.xml first"""
+    parts = ['word/document.xml']
+    if extra_parts:
+        extra = re.compile(r'word/(%s)\d*\.xml' % '|'.join(extra_parts))
+        parts.extend(sorted(name for name in names if extra.fullmatch(name)))
+    return parts
+
+
+def iter_docx_paragraphs(xml_stream):
+    """Yield the text of each paragraph of a word xml part.
+    The part is parsed incrementally and every element is cleared once it
+    is read, together with the finished children of the root and the body,
+    so memory stays bounded by a single top level paragraph or table.
+    """
+    stack = []
+    texts = []
+    for event, elem in iterparse(xml_stream, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        if elem.tag == TEXT:
+            if elem.text:
+                texts.append(elem.text)
+        elif elem.tag == PARA and texts:
+            yield ' '.join(texts)
+            texts = []
+        elem.clear()
+        if 0 < len(stack) <= 2:
+            # drop the finished children of the document and its body
+            stack[-1].clear()
+
+
 class DocxParser(FileParserInterface):
     """Docx File Parser"""
+    parser_version: str = '1.2'    # 1.2: streaming iterparse
+    cache_options: tuple = ('extra_parts',)
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, extra_parts: tuple = ()):
         self.file_path = file_path
         self.mapping_dict: Dict[AnyStr] = {}
+        self.extra_parts = extra_parts  # any of DOCX_EXTRA_PARTS to extract after the body
 
         # file counters
         self.file_counter: int = 0  # count of the files successfully parsed
@@ -397,37 +631,19 @@ class DocxParser(FileParserInterface):
     def extract_text(self, current_file):
         """Extract the current docx file's text"""
         try:
-            WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
-            PARA = WORD_NAMESPACE + 'p'
-            TEXT = WORD_NAMESPACE + 't'
-
-            # unzip the current document and read its contents
+            # stream the document's xml parts out of the zip file
             if os.path.getsize(current_file) > 0:
-                document = zipfile.ZipFile(current_file)
-                for i, _ in enumerate(document.infolist()):
-                    if document.infolist()[i].filename == 'word/document.xml':
-                        xml_content = document.read('word/document.xml')
-                        document.close()
-                        tree = XML(xml_content)  # parse the xml document
-                        paragraphs = []
-                        for paragraph in tree.getiterator(PARA):
-                            texts = [
-                                node.text
-                                for node in paragraph.getiterator(TEXT)
-                                if node.text
-                            ]
-                            if texts:
-                                # process the text list into a formatted string
-                                texts = ' '.join(texts) \
-                                    .translate(str.maketrans('', '', string.punctuation)) \
-                                    .lower()
-                                paragraphs.append(texts)
-                        self.mapping_dict.update({os.path.basename(current_file): ''.join(paragraphs)})
-                        # increment the file counter
-                        self.file_counter += 1
-                        return {os.path.basename(current_file): ''.join(paragraphs)}
-                else:
-                    pass
+                paragraphs = []
+                with zipfile.ZipFile(current_file) as document:
+                    for part in docx_parts(document.namelist(), self.extra_parts):
+                        with document.open(part) as xml_stream:
+                            paragraphs.extend(iter_docx_paragraphs(xml_stream))
+                # process the paragraphs into a formatted string
+                text = normalize_text(' '.join(paragraphs))
+                self.mapping_dict.update({os.path.basename(current_file): text})
+                # increment the file counter
+                self.file_counter += 1
+                return {os.path.basename(current_file): text}
             else:
                 self.error_file_counter += 1
                 self.error_files.append(os.path.basename(current_file))  # added: 4/16/2019
@@ -452,6 +668,7 @@ class DocxParser(FileParserInterface):
 
 class DocParser(FileParserInterface):
     """Doc File Parser"""
+    parser_version: str = '1.2'    # 1.2: native .doc extraction
 
     def __init__(self, file_path):
         self.file_path = file_path
@@ -482,25 +699,28 @@ class DocParser(FileParserInterface):
                          filepath, time_out], shell=True)
 
     def extract_text(self, current_file: str):
-        """extract the contents from the converted .doc files"""
+        """extract the contents of a .doc file, or of a .doc file converted to .csv"""
         try:
-            with open(current_file, 'r', errors='replace', encoding='utf-8') as f:
-                text = f.read()
-                # text =  text.encode('utf-8')
-                text = SPACES.sub(" ", text)
-                text = text[6:]
-                text = BARS.sub("", text)
-                text = NEWLINE.sub(" ", text)
-                text = TABS.sub(" ", text)
-                text = text.translate(str.maketrans('', '', string.punctuation)).lower()
-                self.mapping_dict.update({os.path.basename(current_file): text})
-                self.file_counter += 1
-                return {os.path.basename(current_file): text}
+            if os.path.splitext(current_file)[-1].lower() == '.doc':
+                # read the text straight out of the ole compound file
+                text = normalize_text(extract_doc_text(current_file))
+            else:
+                with open(current_file, 'r', errors='replace', encoding='utf-8') as f:
+                    # skip the header of the converted csv file
+                    text = normalize_text(f.read(), skip=6)
+            self.mapping_dict.update({os.path.basename(current_file): text})
+            self.file_counter += 1
+            return {os.path.basename(current_file): text}
         except OSError:
             if current_file not in self.error_files:
                 self.error_file_counter += 1
                 self.error_files.append(os.path.basename(current_file))  # added: 4/16/2019
                 logger.error(error=f"OSError: Could not parse doc: {os.path.basename(current_file)}")
+        except Exception as e:
+            self.error_file_counter += 1
+            self.error_files.append(os.path.basename(current_file))
+            logger.error(error=f"Exception: Could not parse doc: {os.path.basename(current_file)}")
+            logger.error(error=f"Python Exception: {e}")
 
     def load_metadata(self, file_path: str, metadata_file: str):
         """Load the metadata file that contains the
@@ -572,11 +792,11 @@ def file_system_file_types(file_path: str) -> set:
     try:
         if os.path.isdir(file_path):
             # get the unique set of file types
-            all_file_types = set(
-                list(filter(lambda x: len(x) >= 3 and len(x) <= 5,
-                            list(map(lambda y: os.path.splitext(y)[-1],
-                                     os.listdir(file_path)))))
-            )
+            if ParserFactory.scanner is not None and ParserFactory.scanner.file_path == file_path:
+                scanner = ParserFactory.scanner
+            else:
+                scanner = DirectoryScanner(file_path)
+            all_file_types = set(filter(lambda x: len(x) >= 3 and len(x) <= 5, scanner.file_types()))
             return all_file_types
         else:
             raise OSError(f"OSError: file path: {file_path} does not exist.")
@@ -588,85 +808,453 @@ def file_system_file_types(file_path: str) -> set:
 
 
 
+# parallel parsing functions #
+####################################################################################################
+def build_parser(file_ext: str, file_path: str) -> FileParserInterface:
+    """Create the concrete parser for the file ext type"""
+    return globals()[f'{file_ext.title()}Parser'](file_path)
+
+
+def chunk_files(files, chunk_size: int):
+    """Group an iterable of files into lists of at most chunk_size files"""
+    chunk = []
+    for f in files:
+        chunk.append(f)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def until_stopped(files, stop_event: threading.Event):
+    """Yield the files until stop_event is set"""
+    for f in files:
+        if stop_event.is_set():
+            logger.info(info="Parsing stopped before all the files were parsed")
+            return
+        yield f
+
+
+def extract_file(parser: FileParserInterface, current_file: str, cache: ExtractionCache = None):
+    """Extract the current file's text, going through the extraction cache if there is one"""
+    if cache is None:
+        return parser.extract_text(current_file)
+    return cache.extract_text(parser, current_file)
+
+
+def parse_file_chunk(file_ext: str, file_path: str, files: list, cache: ExtractionCache = None,
+                     options: dict = None) -> dict:
+    """Run the concrete parser over a chunk of files.
+    options are set as attributes of the parser, e.g. {'ocr_workers': 0}.
+    NOTE:
+        Runs inside a worker process, so it has to be a module level function.
+    """
+    parser = build_parser(file_ext=file_ext, file_path=file_path)
+    for option, value in (options or {}).items():
+        setattr(parser, option, value)
+    if cache is not None:
+        cache.reset_counters()     # only report this chunk's counts
+    for f in files:
+        extract_file(parser, f, cache)
+    results = take_parser_results(parser, cache)
+    if hasattr(parser, 'pdf_content_by_page'):
+        parser.shutdown_page_pool()
+    if cache is not None:
+        cache.close()
+    return results
+
+
+def take_parser_results(parser: FileParserInterface, cache: ExtractionCache = None) -> dict:
+    """Move the text, counters and error files of parser into a results dict
+    for merge_parser_results, leaving parser ready for the next files.
+    """
+    results = {
+        'mapping_dict': parser.mapping_dict,
+        'file_counter': parser.file_counter,
+        'error_file_counter': parser.error_file_counter,
+        'error_files': parser.error_files,
+    }
+    parser.mapping_dict = {}
+    parser.file_counter = 0
+    parser.error_file_counter = 0
+    parser.error_files = []
+    if hasattr(parser, 'pdf_content_by_page'):
+        results['pdf_content_by_page'] = parser.pdf_content_by_page
+        results['page_counters'] = (parser.text_page_counter, parser.ocr_page_counter,
+                                    parser.empty_page_counter)
+        parser.pdf_content_by_page = []
+        parser.pdf_by_page_counter = 0
+        parser.text_page_counter = parser.ocr_page_counter = parser.empty_page_counter = 0
+    if cache is not None:
+        results['cache_hits'] = cache.hits
+        results['cache_misses'] = cache.misses
+        results['cache_evictions'] = cache.evictions
+        cache.reset_counters()
+    return results
+
+
+def merge_parser_results(parser: FileParserInterface, results: dict, cache: ExtractionCache = None) -> None:
+    """Merge the results of a parsed chunk into parser, and its cache counters into cache"""
+    parser.mapping_dict.update(results['mapping_dict'])
+    parser.file_counter += results['file_counter']
+    parser.error_file_counter += results['error_file_counter']
+    parser.error_files.extend(results['error_files'])
+    if 'pdf_content_by_page' in results:
+        parser.pdf_content_by_page.extend(results['pdf_content_by_page'])
+        parser.pdf_by_page_counter += len(results['pdf_content_by_page'])
+        parser.text_page_counter += results['page_counters'][0]
+        parser.ocr_page_counter += results['page_counters'][1]
+        parser.empty_page_counter += results['page_counters'][2]
+    if cache is not None and 'cache_hits' in results:
+        cache.hits += results['cache_hits']
+        cache.misses += results['cache_misses']
+        cache.evictions += results['cache_evictions']
+
+
+def stream_parser_output(parser: FileParserInterface, sink: OutputSinkInterface) -> None:
+    """Move the extracted text out of the parser and into the output sink"""
+    sink.write(parser.mapping_dict)
+    parser.mapping_dict.clear()
+
+
+def stream_pdf_pages(parser: PdfParser, page_sink: OutputSinkInterface) -> None:
+    """Move the pages collected by a worker's PdfParser into the by-page output"""
+    for document in parser.pdf_content_by_page:
+        routing = document.get('routing', {})
+        for key, text in document.items():
+            if key.startswith('page '):
+                pg = int(key.split(' ')[-1])
+                page_sink.write_record(page_record(document['filename'], pg, text, routing.get(pg)))
+    parser.pdf_content_by_page.clear()
+    parser.pdf_by_page_counter = 0
+
+
 # Factory Design Pattern #
 ####################################################################################################
 class ParserFactory:
-    """Factory class for building the file parsers"""
+    """Factory class for building the file parsers.
+    The results of a run are set on the instance, so one ParserFactory
+    per file ext can run concurrently, see dag_runner.
+    """
     file_parser: dict = None  # stores the final parsed dictionary
     file_extensions: list = ['doc', 'docx', 'eml', 'pdf', 'rtf']
     file_ext: str = None  # stores the current file extension
     #book = xlwt.Workbook(encoding='utf-8')  # excel workbook to store pipeline's results
     book = xlsxwriter.Workbook()
     current_parser_obj = None   # stores the current instance of the Parse class
-
-    def parse_file_ext(self, file_ext: str, file_path: str):
-        """Parse the file ext type"""
+    streamed: bool = False      # True if the last run wrote to an output sink
+    completed_files: list = []  # names of the files successfully parsed by the last run
+    scanner: DirectoryScanner = None    # single directory listing shared by every file ext
+    scanner_lock = threading.Lock()
+    checkpoint: RunCheckpoint = None    # checkpoint of the last run, if it had one
+    error_reasons: dict = {}    # {file name: reason} of the files killed by the sandbox
+
+    def parse_file_ext(self, file_ext: str, file_path: str, workers: int = None, chunk_size: int = 100,
+                       sink: OutputSinkInterface = None, cache: ExtractionCache = None,
+                       files: list = None, recursive: bool = False, page_workers: int = None,
+                       ocr_workers: int = None, checkpoint_dir: str = None,
+                       checkpoint_every: int = 500, resume: bool = False,
+                       file_timeout: float = None, max_rss_mb: int = None,
+                       stop_event: threading.Event = None):
+        """Parse the file ext type
+
+        :param workers: number of worker processes. None or 1 parses the files serially.
+        :param chunk_size: number of files handed to a worker process at a time.
+        :param sink: streaming mode. Every extracted text is appended to sink as soon
+            as it is produced instead of being kept in the mapping_dict.
+        :param cache: extraction cache. Files whose contents were already parsed
+            are not parsed again.
+        :param files: incremental mode. Parse only these files instead of every
+            file with file_ext in file_path, e.g. the files of DeltaSelector.select_files.
+        :param recursive: also parse the files in the sub directories of file_path.
+        :param page_workers: number of processes extracting the pages of a large pdf.
+            Only used when the files are parsed serially.
+        :param ocr_workers: OCR the pdf pages without a usable text layer with this
+            many OCR processes. Each worker OCRs its own pages when workers > 1.
+        :param checkpoint_dir: write a checkpoint of the done files and their text
+            to checkpoint_dir every checkpoint_every files.
+        :param resume: restore the files done by the last checkpointed run of the
+            day and skip them. Without resume the checkpoint starts over.
+        :param file_timeout: sandboxed mode. Parse every file in a supervised worker
+            process that is killed when the file takes more than file_timeout seconds.
+        :param max_rss_mb: sandboxed mode. Kill the worker when its resident memory
+            grows past max_rss_mb. The file is recorded in the error files with the
+            reason and the worker is replaced. workers sets the number of sandboxes.
+            Setting only one of file_timeout and max_rss_mb leaves the other unchecked.
+        :param stop_event: stop taking new files once it is set, e.g. DagRunner.cancel_event.
+            The files already handed to a worker are finished.
+        """
         if file_ext in ParserFactory.file_extensions:
-            ParserFactory.file_ext = file_ext
+            self.file_ext = file_ext
+            self.streamed = sink is not None
+            self.completed_files = []
+            self.error_reasons = {}
             # if file_ext  == 'csv':
             #     # special case
             #     parser = TxtParser(file_path=file_path)
             #     parser_generator = FileGenerator(file_path=file_path, file_ext='csv')
 
-            if file_ext == 'doc':    # added 5/2/2019
-                # special case
-                parser = DocParser(file_path=file_path)
-                ParserFactory.current_parser_obj = parser
-                parser.run_doc_to_csv_rscript(file_path=file_path, timeout=str(20))
-
-                # doc parser_generator should access the converted doc files
-                parser_generator = FileGenerator(file_path=doc_test_write_path, file_ext='csv')
-                # begin iteration
-                parser_iterator = parser_generator.__iter__()
-                while True:
-                    try:
-                        parser.extract_text(next(parser_iterator))
-                    except StopIteration:
-                        logger.info(info=f"Finished processing {file_ext} files.")
-                        break
-
+            # load the correct file parser
+            parser = build_parser(file_ext=file_ext, file_path=file_path)
+            self.current_parser_obj = parser
+            # load the parser generator
+            if files is not None:
+                parser_generator = files
+                logger.info(info=f"{file_ext.title()}: incremental run over {len(files)} files")
             else:
-                # load the correct file parser
-                parser = globals()[f'{file_ext.title()}Parser'](file_path)
-                # load the parser generator
-                parser_generator = FileGenerator(file_path=file_path, file_ext=file_ext)
-
-                # begin iteration
-                parser_iterator = parser_generator.__iter__()
-                while True:
-                    try:
-                        parser.extract_text(next(parser_iterator))
-                    except StopIteration:
-                        logger.info(info=f"Finished processing {file_ext} files.")
-                        break
-
-            # write the pdf_by_page list to a pickle file
+                parser_generator = FileGenerator(file_path=file_path, file_ext=file_ext,
+                                                 scanner=self.scan_directory(file_path, recursive))
+
+            if checkpoint_dir is not None and resume and isinstance(sink, ParquetSink):
+                # the parquet file of a crashed run has no footer and can't be appended to
+                raise ValueError("ValueError: resume requires a JsonLinesSink or no output sink")
+
+            # the pdf pages are streamed to the by-page output as they are extracted,
+            # a rerun overwrites the day's output unless it resumes from a checkpoint
+            page_sink = None
+            if cache is not None:
+                cache.reset_counters()
             if file_ext == 'pdf':   # 5/2/2019
-                pdf_by_pg_name =  ParserFactory.file_ext.title() + '_ByPage' + '_' + d + '.pickle'
-                os.chdir(pdf_pickle_path)
-                pickle.dump(parser.pdf_content_by_page, open(pdf_by_pg_name, "wb"))
+                page_name = file_ext.title() + '_ByPage' + '_' + d
+                if isinstance(sink, ParquetSink):
+                    page_sink = ParquetSink(write_path=pdf_pickle_path, file_name=page_name + '.parquet',
+                                            schema=PAGE_SCHEMA)
+                else:
+                    page_sink = JsonLinesSink(write_path=pdf_pickle_path, file_name=page_name + '.jsonl',
+                                              append=checkpoint_dir is not None and resume)
+                parser.page_sink = page_sink
+                parser.page_workers = page_workers
+                parser.ocr_workers = ocr_workers
+
+            # restore the files done before the last crash
+            checkpoint = None
+            self.checkpoint = None
+            if checkpoint_dir is not None:
+                checkpoint = RunCheckpoint(checkpoint_dir=checkpoint_dir, name=file_ext.title() + '_' + d,
+                                           checkpoint_every=checkpoint_every, partial_output=sink is None)
+                parser.mapping_dict.update(checkpoint.start(resume=resume, sink=sink, page_sink=page_sink))
+                self.checkpoint = checkpoint
+                done_files = checkpoint.files_with_status('ok')
+                done_errors = checkpoint.files_with_status('error')
+                parser.file_counter += len(done_files)
+                parser.error_file_counter += len(done_errors)
+                parser.error_files.extend(done_errors)
+                self.completed_files.extend(done_files)
+                if checkpoint.done:
+                    logger.info(info=f"{file_ext.title()}: resuming after {len(checkpoint.done)} done files")
+                parser_generator = (f for f in parser_generator if not checkpoint.is_done(f))
+
+            # begin iteration
+            if stop_event is not None:
+                parser_generator = until_stopped(parser_generator, stop_event)
+            parser_iterator = parser_generator.__iter__()
+            sandboxed = file_timeout is not None or max_rss_mb is not None
+            options = None
+            if file_ext == 'pdf' and (sandboxed or (workers is not None and workers > 1)):
+                if workers is None or workers == 1:
+                    # a single sandbox extracts and OCRs the pages with processes of its own
+                    options = {'page_workers': page_workers, 'ocr_workers': ocr_workers}
+                elif ocr_workers is not None:
+                    options = {'ocr_workers': 0}
+            try:
+                if sandboxed:
+                    # a limit left at None isn't checked, see FORMAT_LIMITS for the pipeline's limits
+                    self.parse_in_sandboxes(parser, file_ext, file_path, parser_iterator,
+                                            workers=workers or 1, sink=sink, page_sink=page_sink,
+                                            cache=cache, options=options, checkpoint=checkpoint,
+                                            limits={'timeout': file_timeout, 'max_rss_mb': max_rss_mb})
+                elif workers is not None and workers > 1:
+                    self.parse_in_process_pool(parser, file_ext, file_path, parser_iterator,
+                                               workers=workers, chunk_size=chunk_size,
+                                               sink=sink, page_sink=page_sink, cache=cache,
+                                               options=options, checkpoint=checkpoint)
+                else:
+                    while True:
+                        try:
+                            errors = len(parser.error_files)
+                            result = extract_file(parser, next(parser_iterator), cache)
+                            if result:
+                                self.completed_files.extend(result.keys())
+                            if sink is not None:
+                                stream_parser_output(parser, sink)
+                            if checkpoint is not None:
+                                checkpoint.add(result or {}, parser.error_files[errors:], sink=sink)
+                        except StopIteration:
+                            break
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close(sink=sink)
+                if sink is not None:
+                    sink.flush()
+                if page_sink is not None:
+                    parser.shutdown_page_pool()
+                    page_sink.close()
+            logger.info(info=f"Finished processing {file_ext} files.")
+            if cache is not None:
+                logger.info(info=f"{file_ext.title()}: Extraction cache hits: {cache.hits}, "
+                f"misses: {cache.misses}, evictions: {cache.evictions}")
+            if file_ext == 'pdf':
+                logger.info(info=f"Pdf: pages routed to text: {parser.text_page_counter}, "
+                f"ocr: {parser.ocr_page_counter}, empty: {parser.empty_page_counter}")
 
             # write the files that raised an error to an error file
             err_file = 'ErrorFile' + file_ext.title() + '_' + d + '.csv'
-            err_df = pd.DataFrame({file_ext.title() + 'ErrorFiles': parser.error_files})
+            err_df = pd.DataFrame({file_ext.title() + 'ErrorFiles': parser.error_files,
+                                   'Reason': [self.error_reasons.get(f, '') for f in parser.error_files]})
             err_df.to_csv(path_or_buf=os.path.join(error_file_path, err_file))
 
             # load the file ext dictionary
-            ParserFactory.file_parser = parser.mapping_dict
+            self.file_parser = parser.mapping_dict
 
             # write the number of successes and failures
             logger.info(info=f"{file_ext.title()}: Number of successes: {parser.file_counter}")
             logger.info(info=f"{file_ext.title()}: Number of failures: {parser.error_file_counter}")
 
-    def serialize_contents(self, write_path: str):
+    def scan_directory(self, file_path: str, recursive: bool = False,
+                       refresh: bool = False) -> DirectoryScanner:
+        """Return the scanner of file_path. The directory is listed once and
+        every file ext parsed from it reuses that listing.
+        """
+        with ParserFactory.scanner_lock:
+            scanner = ParserFactory.scanner
+            if refresh or scanner is None or scanner.file_path != file_path \
+                    or scanner.recursive != recursive:
+                scanner = DirectoryScanner(file_path=file_path, recursive=recursive)
+                file_counts = {k: len(v) for k, v in scanner.scan().items()
+                               if k in ParserFactory.file_extensions}
+                ParserFactory.scanner = scanner
+                logger.info(info=f"Scanned {file_path}: {file_counts}")
+        return scanner
+
+    def parse_in_process_pool(self, parser: FileParserInterface, file_ext: str, file_path: str,
+                              files, workers: int, chunk_size: int,
+                              sink: OutputSinkInterface = None,
+                              page_sink: OutputSinkInterface = None,
+                              cache: ExtractionCache = None, options: dict = None,
+                              checkpoint: RunCheckpoint = None) -> None:
+        """Parse chunks of files in a pool of worker processes and merge the
+        results of every chunk back into parser. At most 2 chunks per worker are
+        in flight and a chunk's future is dropped once it is merged, so in
+        streaming mode memory doesn't grow with the number of files.
+        """
+        chunks = chunk_files(files, chunk_size)
+        futures = {}    # {future: chunk} of the chunks in flight
+        chunk_counter = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                for chunk in chunks:
+                    futures[executor.submit(parse_file_chunk, file_ext, file_path, chunk, cache, options)] = chunk
+                    chunk_counter += 1
+                    if len(futures) >= 2 * workers:
+                        break
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.merge_chunk(parser, file_ext, future, futures.pop(future), sink=sink,
+                                     page_sink=page_sink, cache=cache, checkpoint=checkpoint)
+        logger.info(info=f"{file_ext.title()}: parsed {chunk_counter} chunks with {workers} workers")
+
+    def merge_chunk(self, parser: FileParserInterface, file_ext: str, future, chunk: list,
+                    sink: OutputSinkInterface = None, page_sink: OutputSinkInterface = None,
+                    cache: ExtractionCache = None, checkpoint: RunCheckpoint = None) -> None:
+        """Merge the results of a finished chunk into parser and stream them to the outputs"""
+        try:
+            results = future.result()
+            merge_parser_results(parser, results, cache)
+            self.completed_files.extend(results['mapping_dict'].keys())
+            if sink is not None:
+                stream_parser_output(parser, sink)
+            if page_sink is not None:
+                stream_pdf_pages(parser, page_sink)
+            if checkpoint is not None:
+                checkpoint.add(results['mapping_dict'], results['error_files'], sink=sink)
+        except Exception as e:
+            # the worker died, every file in the chunk is an error file
+            parser.error_file_counter += len(chunk)
+            parser.error_files.extend(os.path.basename(f) for f in chunk)
+            if checkpoint is not None:
+                checkpoint.add({}, [os.path.basename(f) for f in chunk], sink=sink)
+            logger.error(error=f"{file_ext.title()}: a worker failed while parsing "
+            f"a chunk of {len(chunk)} files")
+            logger.error(error=f"Python Exception: {e}")
+
+    def parse_in_sandboxes(self, parser: FileParserInterface, file_ext: str, file_path: str,
+                           files, workers: int, sink: OutputSinkInterface = None,
+                           page_sink: OutputSinkInterface = None, cache: ExtractionCache = None,
+                           options: dict = None, checkpoint: RunCheckpoint = None,
+                           limits: dict = None) -> None:
+        """Parse the files one at a time in workers supervised processes and merge
+        the results of every file back into parser. A file that runs over the limits
+        of SandboxedExtractor is recorded in the error files with the reason.
+        """
+        lock = threading.Lock()     # guards files, parser and the outputs
+
+        def supervise() -> SandboxedExtractor:
+            with SandboxedExtractor(file_ext, file_path, cache=cache, options=options,
+                                    **(limits or {})) as sandbox:
+                while True:
+                    with lock:
+                        current_file = next(files, None)
+                    if current_file is None:
+                        return sandbox
+                    results, reason = sandbox.extract(current_file)
+                    with lock:
+                        if results is None:
+                            file_name = os.path.basename(current_file)
+                            parser.error_file_counter += 1
+                            parser.error_files.append(file_name)
+                            self.error_reasons[file_name] = reason
+                            logger.error(error=f"File: {current_file} was killed by the sandbox, {reason}")
+                            results = {'mapping_dict': {}, 'error_files': [file_name]}
+                        else:
+                            merge_parser_results(parser, results, cache)
+                            self.completed_files.extend(results['mapping_dict'].keys())
+                        if sink is not None:
+                            stream_parser_output(parser, sink)
+                        if page_sink is not None:
+                            stream_pdf_pages(parser, page_sink)
+                        if checkpoint is not None:
+                            checkpoint.add(results['mapping_dict'], results['error_files'], sink=sink)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sandbox') as executor:
+            sandboxes = [f.result() for f in [executor.submit(supervise) for _ in range(workers)]]
+        logger.info(info=f"{file_ext.title()}: sandbox kills, timeout: {sum(s.timeout_counter for s in sandboxes)}, "
+        f"memory: {sum(s.memory_counter for s in sandboxes)}, "
+        f"crashed: {sum(s.crash_counter for s in sandboxes)}")
+
+    def open_sink(self, file_ext: str, write_path: str, file_format: str = 'parquet',
+                  resume: bool = False) -> OutputSinkInterface:
+        """Create the streaming output of file_ext, e.g. Docx_2019_05_08.parquet.
+        With resume the jsonl output of the last run is kept, for parse_file_ext
+        to cut back to its last checkpoint, otherwise it is overwritten.
+        """
+        name = file_ext.title() + '_' + d + '.' + file_format
+        if file_format == 'parquet':
+            return ParquetSink(write_path=write_path, file_name=name)
+        elif file_format == 'jsonl':
+            return JsonLinesSink(write_path=write_path, file_name=name, append=resume)
+        raise ValueError(f"Unknown output format: {file_format}")
+
+    def serialize_contents(self, write_path: str, file_format: str = 'pickle'):
+        if self.streamed:
+            logger.info(info=f"{self.file_ext.title()}: contents were streamed "
+            f"to the output sink, nothing to serialize.")
+            return
+        if file_format != 'pickle':
+            # columnar output, e.g. Docx_2019_05_08.parquet
+            with self.open_sink(self.file_ext, write_path, file_format) as sink:
+                sink.write(self.file_parser)
+            return
         # create the file name
-        pkl_name = ParserFactory.file_ext.title() + '_' + d + '.pickle'
+        pkl_name = self.file_ext.title() + '_' + d + '.pickle'
         try:
             os.chdir(write_path)
-            pickle.dump(ParserFactory.file_parser, open(pkl_name, "wb"))
+            pickle.dump(self.file_parser, open(pkl_name, "wb"))
         except pickle.PicklingError:
             logger.error(error=f"PicklingError: An error occurred while "
-            f"trying to serialize the {ParserFactory.file_ext} dictionary.")
+            f"trying to serialize the {self.file_ext} dictionary.")
             print("PicklingError: Could not pickle the file\n")
 
 
@@ -679,10 +1267,10 @@ class ParserFactory:
             # create the excel workbook
             workbook = xlsxwriter.Workbook(os.path.join(wb_path, wb_name))
             worksheet = workbook.add_worksheet(name=file_ext.title())
-            for i, method in enumerate(list(ParserFactory.current_parser_obj.__dict__.keys())):
-                if str(ParserFactory.current_parser_obj.__dict__[method]).split(' ')[0].lstrip('<') == 'function' \
-                        and '__' not in list(ParserFactory.current_parser_obj.__dict__.keys())[i]:
-                        worksheet.write(0, i, list(ParserFactory.current_parser_obj.__dict__.keys())[i])
+            for i, method in enumerate(list(self.current_parser_obj.__dict__.keys())):
+                if str(self.current_parser_obj.__dict__[method]).split(' ')[0].lstrip('<') == 'function' \
+                        and '__' not in list(self.current_parser_obj.__dict__.keys())[i]:
+                        worksheet.write(0, i, list(self.current_parser_obj.__dict__.keys())[i])
             workbook.close()
 
         else:
@@ -0,0 +1,151 @@
+"""
+extraction_cache
+~~~~~~~~~~~~~~~~
+Persistent cache of extracted text.
+
+Entries are keyed by the sha256 of the file's bytes, the parser's class,
+the parser's version and a digest of the parser options that change its
+output (FileParserInterface.output_options, e.g. whether pdf pages are
+OCRed), so a "changed" document whose bytes did not change is never parsed
+twice. Bumping FileParserInterface.parser_version on a parser invalidates
+all of its entries. A file whose parse recorded errors, e.g. a pdf page that
+could not be read, is not cached, so it is parsed and reported again.
+
+# Data Structure #
+key: sha256(file bytes):ParserName:parser_version:sha256(output options)[:16]
+value: pickle.dumps((raw_text, PdfParser.document_pages or None))
+"""
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+from datetime import datetime
+from data_processing_pipeline_2019_04_30.logging_config import BaseLogger
+from data_processing_pipeline_2019_04_30.configuration import log_file_path
+
+# the pipeline's log file of the day, configured by data_preprocessing
+logger = BaseLogger(log_file_path, "data_pipeline_log_" + str(datetime.today())[:10].replace("-", "_"))
+
+
+class ExtractionCache(object):
+    """On-disk extraction cache with size based, least recently used, eviction"""
+
+    CACHE_FILE: str = 'extraction_cache.sqlite'
+    READ_SIZE: int = 1024 * 1024    # bytes read at a time while hashing a file
+
+    def __init__(self, cache_path: str, max_bytes: int = 5 * 1024 ** 3):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.conn: sqlite3.Connection = None
+        self.total_bytes: int = 0
+
+        # cache counters
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def __getstate__(self):
+        # the sqlite connection can't be sent to a worker process
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+    def connect(self):
+        """open the cache database, creating it the first time"""
+        if self.conn is None:
+            self.conn = sqlite3.connect(os.path.join(self.cache_path, self.CACHE_FILE), timeout=60)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                              'key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+            self.conn.commit()
+            self.total_bytes = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cache_key(self, parser, current_file: str) -> str:
+        """hash the file's contents together with the parser's version and output options"""
+        sha = hashlib.sha256()
+        with open(current_file, 'rb') as f:
+            for block in iter(lambda: f.read(self.READ_SIZE), b''):
+                sha.update(block)
+        options = parser.output_options() if hasattr(parser, 'output_options') else {}
+        options_digest = hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{sha.hexdigest()}:{parser.__class__.__name__}:{parser.parser_version}:{options_digest[:16]}"
+
+    def get(self, key: str):
+        conn = self.connect()
+        row = conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        conn.commit()
+        return pickle.loads(row[0])
+
+    def put(self, key: str, value):
+        conn = self.connect()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                     (key, blob, len(blob), time.time()))
+        conn.commit()
+        self.total_bytes += len(blob)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """remove the least recently used entries until the cache is back under 90% of max_bytes"""
+        conn = self.connect()
+        # other processes may share the cache, so recount before evicting
+        self.total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        rows = conn.execute('SELECT key, size FROM cache ORDER BY last_used')
+        expired = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            expired.append((key,))
+            self.total_bytes -= size
+        conn.executemany('DELETE FROM cache WHERE key = ?', expired)
+        conn.commit()
+        self.evictions += len(expired)
+
+    def extract_text(self, parser, current_file: str):
+        """Wrap parser.extract_text, returning the cached text on a hit"""
+        try:
+            key = self.cache_key(parser, current_file)
+            cached = self.get(key)
+        except (OSError, sqlite3.Error, pickle.UnpicklingError) as e:
+            logger.error(error=f"CacheError: could not read the cache for {os.path.basename(current_file)}: {e}")
+            return parser.extract_text(current_file)
+
+        file_name = os.path.basename(current_file)
+        if cached is not None:
+            self.hits += 1
+            raw_text, pdf_page = cached
+            parser.mapping_dict.update({file_name: raw_text})
+            parser.file_counter += 1
+            if pdf_page is not None:
+                parser.restore_pages(current_file, pdf_page)
+            return {file_name: raw_text}
+
+        self.misses += 1
+        errors = len(parser.error_files)
+        result = parser.extract_text(current_file)
+        if result and len(parser.error_files) == errors:
+            pdf_page = getattr(parser, 'document_pages', None)
+            try:
+                self.put(key, (result[file_name], pdf_page))
+            except (sqlite3.Error, pickle.PicklingError) as e:
+                logger.error(error=f"CacheError: could not cache {file_name}: {e}")
+        return result
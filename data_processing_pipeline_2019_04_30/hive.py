@@ -2,47 +2,58 @@
 hive
 ~~~~
 """
-import os
-import socket
+import re
+import time
+import uuid
+import shlex
 import paramiko
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from data_processing_pipeline_2019_04_30.configuration import (
     username, password, host, port
 )
+from data_processing_pipeline_2019_04_30.connection_pool import ConnectionPool, connection_pool
 
 
 # SSHConnection(Parent Class) #
 ####################################################################################################
 class SSHConnection(object):
-    """Creates an ssh connection"""
-    def __init__(self, username: str, password: str, host: str, port: int):
+    """Creates an ssh connection on a transport of the shared connection pool"""
+    def __init__(self, username: str, password: str, host: str, port: int,
+                 pool: ConnectionPool = None):
         self.username = username
         self.password = password
         self.host = host
         self.port = int(port)
-        self.ssh = paramiko.SSHClient()
+        self.pool = pool or connection_pool
         self.connected = False
 
     def connect(self):
-        """connect to a remote server via ssh"""
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-        self.ssh.connect(
-            hostname=self.host,
-            username=self.username,
-            password=self.password
-        )
-        if socket.gethostname():
-            self.connected = True
-            print(socket.gethostname())
-            print(socket.getfqdn())
-            print(socket.gethostbyaddr(self.host))
+        """connect to a remote server via ssh, reusing the pool's transport"""
+        self.pool.get_transport(self.host, self.port, self.username, self.password)
+        self.connected = True
+
+    def exec_command(self, command: str, timeout: float = None):
+        """run command on a new channel of the pooled transport,
+        same return value as paramiko.SSHClient.exec_command
+        """
+        channel = self.pool.open_channel(self.host, self.port, self.username, self.password)
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        stdin_ = channel.makefile('wb')
+        stdout_ = channel.makefile('r')
+        stderr_ = channel.makefile_stderr('r')
+        return stdin_, stdout_, stderr_
 
 # Child Classes #
 ####################################################################################################
 class HivCli(SSHConnection):
     """Connect to Hive command line interface."""
 
-    def __init__(self, username: str, password: str, host: str, port: int):
-        super().__init__(username, password, host, port)
+    def __init__(self, username: str, password: str, host: str, port: int,
+                 pool: ConnectionPool = None):
+        super().__init__(username, password, host, port, pool)
         self.host: str = host
         self.port: int = int(port)
         self.username: str = username
@@ -55,156 +66,408 @@ class HivCli(SSHConnection):
         cmd_end = ';"'
 
 
+# hive -v echoes every statement, then reports e.g. "Time taken: 1.2 seconds, Fetched: 3 row(s)"
+TIME_TAKEN = re.compile(r'Time taken: ([\d.]+) seconds(?:, Fetched: (\d+) row)?')
+
+# columnar table formats and the table property that sets their compression
+STORED_FORMATS = {'ORC': 'orc.compress', 'PARQUET': 'parquet.compression'}
+
+# result of a statement of a HiveBatch
+HiveResult = namedtuple('HiveResult', ['statement', 'status', 'seconds', 'rows', 'output'])
+
+
+class HiveBatch(object):
+    """Hive statements queued to run as a single hive -f script"""
+
+    def __init__(self, hive, database: str = 'drw'):
+        self.hive = hive
+        self.database = database
+        self.statements: list = [f'USE {database}']
+        self.results: list = []     # HiveResult of each statement, after run()
+        self.exit_status: int = None
+        self.seconds: float = None  # wall clock time of the whole script
+
+    def add(self, statement: str, database: str = None):
+        """queue a statement, switching database first if needed"""
+        if database is not None and database != self.database:
+            self.database = database
+            self.statements.append(f'USE {database}')
+        self.statements.append(statement.strip().rstrip(';'))
+        return self
+
+    def script(self) -> str:
+        return ''.join(statement + ';\n' for statement in self.statements)
+
+    def run(self) -> list:
+        """upload the script over sftp, run it in one hive invocation and
+        return the HiveResult of every statement
+        """
+        hive = self.hive
+        script_file = f'/tmp/hive_batch_{uuid.uuid4().hex}.hql'
+        sftp = hive.pool.open_sftp(hive.host, hive.port, hive.username, hive.password)
+        try:
+            with sftp.open(script_file, 'w') as f:
+                f.write(self.script())
+        finally:
+            sftp.close()
+
+        start_time = time.time()
+        # hive reports timings on stderr, merge it so they stay in order with the statements
+        stdin_, stdout_, stderr_ = hive.exec_command(
+            f'hive -v -f {script_file} 2>&1; status=$?; rm -f {script_file}; exit $status')
+        lines = stdout_.read().decode('utf-8', errors='replace').splitlines()
+        self.exit_status = stdout_.channel.recv_exit_status()
+        self.seconds = time.time() - start_time
+        self.results = parse_hive_output(self.statements, lines)
+        for result in self.results:
+            print(f"Hive: {result.status} in {result.seconds}s: {result.statement[:80]}")
+        return self.results
+
+
+def parse_hive_output(statements: list, lines: list) -> list:
+    """Split the output of hive -v -f into the HiveResult of each statement.
+    The statements run in order and each one ends with a "Time taken" line,
+    or with a FAILED line that stops the script.
+    """
+    results = []
+    output = []
+    for line in lines:
+        if len(results) == len(statements):
+            break
+        statement = statements[len(results)]
+        match = TIME_TAKEN.search(line)
+        if match is not None:
+            rows = int(match.group(2)) if match.group(2) else None
+            results.append(HiveResult(statement, 'ok', float(match.group(1)), rows, output))
+            output = []
+        elif line.startswith('FAILED'):
+            results.append(HiveResult(statement, 'failed', None, None, output + [line]))
+            output = []
+            break
+        elif line.strip() and line.strip() != 'OK' and line.strip() not in statement:
+            output.append(line)     # skip the echoed statement
+    for statement in statements[len(results):]:
+        results.append(HiveResult(statement, 'not run', None, None, []))
+    return results
+
+
 class Hive(SSHConnection):
     """Connect to Hive remotely"""
 
-    def __init__(self, username: str, password: str, host: str, port: int):
-        super().__init__(username, password, host, port)
+    def __init__(self, username: str, password: str, host: str, port: int,
+                 pool: ConnectionPool = None):
+        super().__init__(username, password, host, port, pool)
         self.host: str = host
         self.port: int = int(port)
         self.username: str = username
         self.password: str = password
         self.query_string: str = "Hello"
+        self.batch: HiveBatch = None    # the open session, see session()
         self.connect() # connect to the remote server
 
-    def build_hive_query(self, query_method: str, table_name: str):
-        """build and submit a hive query"""
-        if query_method in Hive.__dict__:
-            cmd_start = 'hive -e "use drw; '
-            cmd_end = ';"'
-            # run the desired function
-            Hive.__dict__[query_method](self, table_name=table_name)
-
-    def create_hive_table(self, *args, table_name: str, database: str, **kwargs):
-        """create a hive table"""
+    @contextmanager
+    def session(self, database: str = 'drw'):
+        """queue the statements of the Hive methods called in the with block
+        and run them as one script when it exits, e.g.
+
+            with hive.session() as batch:
+                hive.create_hive_table(...)
+                hive.load_hive_table(...)
+            batch.results
+        """
+        batch = self.batch = HiveBatch(self, database=database)
+        try:
+            yield batch
+        finally:
+            self.batch = None
+        batch.run()
+
+    def submit(self, query_string: str, database: str = None):
+        """queue query_string in the open session, or run it with hive -e.
+        database defaults to the session's database, or drw outside a session.
+        """
+        if self.batch is not None:
+            self.batch.add(query_string, database=database)
+            return
+
+        database = database or 'drw'
         cmd_start = f'hive -e "use {database}; '
         cmd_end = ';"'
-        table_values = ' '.join(k+ ' ' + kwargs[k] + ',' for k in kwargs).rstrip(', ')
-        query_string = f"CREATE TABLE IF NOT EXISTS {table_name}({table_values})"\
-            f"ROW FORMAT DELIMITED FIELDS TERMINATED BY ','"
-
-        # create the correct query string
         output = cmd_start + query_string + cmd_end
-        print(output)
 
         if not self.connected:
             self.connect()
 
         # make hive query
-        stdin_, stdout_, stderr_ = self.ssh.exec_command(output)
+        stdin_, stdout_, stderr_ = self.exec_command(output)
         stdout_.channel.recv_exit_status()
         lines = stdout_.readlines()
         # check query output
         for line in lines:
             print(line)
 
-    def load_hive_table(self, file_path: str, file_name: str, table_name: str):
-        """load data into the specified hive table"""
-        cmd_start = 'hive -e "use drw; '
-        cmd_end = ';"'
-        query_string = f'LOAD DATA LOCAL INPATH "{os.path.join(file_path, file_name)}"\
-        OVERWRITE INTO TABLE {table_name}'
-        output = cmd_start + query_string + cmd_end
-
-        if not self.connected:
-            self.connect()
+    def build_hive_query(self, query_method: str, table_name: str):
+        """build and submit a hive query"""
+        if query_method in Hive.__dict__:
+            # run the desired function
+            Hive.__dict__[query_method](self, table_name=table_name)
 
-        # make hive query
-        stdin_, stdout_, stderr_ = self.ssh.exec_command(output)
-        stdout_.channel.recv_exit_status()
-        lines = stdout_.readlines()
-        # check query output
-        for line in lines:
-            print(line)
+    def create_hive_table(self, *args, table_name: str, database: str, partitioned_by: dict = None,
+                          stored_as: str = None, compression: str = 'SNAPPY', **kwargs):
+        """create a hive table. kwargs are the table's {column: type}.
+        :param partitioned_by: {column: type} of the partition columns, e.g. {'load_date': 'String'}
+        :param stored_as: 'ORC' or 'PARQUET' for a compressed columnar table,
+            None for a comma delimited text table
+        """
+        table_values = ' '.join(k+ ' ' + kwargs[k] + ',' for k in kwargs).rstrip(', ')
+        query_string = f"CREATE TABLE IF NOT EXISTS {table_name}({table_values})"
+        if partitioned_by:
+            partition_values = ', '.join(k + ' ' + v for k, v in partitioned_by.items())
+            query_string += f" PARTITIONED BY ({partition_values})"
+        if stored_as is None:
+            query_string += " ROW FORMAT DELIMITED FIELDS TERMINATED BY ','"
+        else:
+            stored_as = stored_as.upper()
+            if stored_as not in STORED_FORMATS:
+                raise ValueError(f"ValueError: stored_as must be one of {list(STORED_FORMATS)}")
+            query_string += f" STORED AS {stored_as} "\
+                f"TBLPROPERTIES ('{STORED_FORMATS[stored_as]}'='{compression}')"
+        print(query_string)
+        self.submit(query_string, database=database)
+
+    def load_hive_table(self, file_path: str, file_name: str, table_name: str, local: bool = True):
+        """load data into the specified hive table. local is False for a file in hdfs"""
+        query_string = f'LOAD DATA {"LOCAL " if local else ""}INPATH "{file_path}/{file_name}"\
+        OVERWRITE INTO TABLE {table_name}'
+        self.submit(query_string)
+
+    def load_hive_partition(self, file_path: str, file_name: str, table_name: str, columns: list,
+                            partition: dict, local: bool = True, overwrite: bool = True):
+        """load a csv file with a header row into a partition of a partitioned table.
+        The file is loaded into a text staging table read with OpenCSVSerde, so
+        quoted values with commas stay in one column, then inserted into the partition.
+        Only that partition is written. It is replaced, so rerunning a day's load
+        doesn't duplicate its rows. overwrite=False appends to it instead, which is
+        not idempotent.
+        :param columns: the columns of the csv file, in order, same names as the table's
+        :param partition: {column: value} of the partition, e.g. {'load_date': '2019_05_08'}
+        """
+        staging_table = table_name + '_staging'
+        staging_values = ', '.join(c + ' String' for c in columns)
+        self.submit(f"CREATE TABLE IF NOT EXISTS {staging_table}({staging_values}) "
+                    f"ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde' STORED AS TEXTFILE "
+                    f"TBLPROPERTIES ('skip.header.line.count'='1')")
+        self.load_hive_table(file_path=file_path, file_name=file_name, table_name=staging_table, local=local)
+        partition_values = ', '.join(f"{k}='{v}'" for k, v in partition.items())
+        self.submit(f"INSERT {'OVERWRITE' if overwrite else 'INTO'} TABLE {table_name} "
+                    f"PARTITION ({partition_values}) SELECT {', '.join(columns)} FROM {staging_table}")
+        self.submit(f"DROP TABLE IF EXISTS {staging_table}")
 
     def update_hive_table(self, table_name: str):
         """update specified hive table"""
-        cmd_start = 'hive -e "use drw; '
-        cmd_end = ';"'
         query_string = f'DROP TABLE IF EXISTS {table_name}'
-        output = cmd_start + query_string + cmd_end
-
-        if not self.connected:
-            self.connect()
-
-        # make hive query
-        stdin_, stdout_, stderr_ = self.ssh.exec_command(output)
-        stdout_.channel.recv_exit_status()
-        lines = stdout_.readlines()
-        # check query output
-        for line in lines:
-            print(line)
-
+        self.submit(query_string)
 
     def drop_hive_table(self, table_name: str):
         """remove specified hive table"""
-        cmd_start = 'hive -e "use drw; '
-        cmd_end = ';"'
-
         query_string = f'DROP TABLE IF EXISTS {table_name}'
-        output = cmd_start + query_string + cmd_end
-
-        if not self.connected:
-            self.connect()
-
-        # make hive query
-        stdin_, stdout_, stderr_ = self.ssh.exec_command(output)
-        stdout_.channel.recv_exit_status()
-        lines = stdout_.readlines()
-        # check query output
-        for line in lines:
-            print(line)
-
-
+        self.submit(query_string)
 
     def query_hive_table(self, *args, table_name: str):
         """query specified hive table"""
-        cmd_start = 'hive -e "use drw; '
-        cmd_end = ';"'
         hive_commands = ' '.join(a for a in args)
-        output = cmd_start \
-                 + hive_commands \
-                 + cmd_end
+        self.submit(hive_commands)
 
-        if not self.connected:
-            self.connect()
 
-        # make hive query
-        stdin_, stdout_, stderr_ = self.ssh.exec_command(output)
-        stdout_.channel.recv_exit_status()
-        lines = stdout_.readlines()
-        # check query output
-        for line in lines:
-            print(line)
+class CommandInputStream(object):
+    """Binary write stream into the stdin of a remote command.
+    close() waits for the command to exit and raises IOError if it failed.
+    """
+
+    def __init__(self, channel, command: str):
+        self.channel = channel
+        self.command = command
+        self.stdin = channel.makefile('wb')
+        self.closed: bool = False
+
+    def write(self, data: bytes) -> int:
+        self.stdin.write(data)
+        return len(data)
+
+    def flush(self):
+        self.stdin.flush()
 
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stdin.flush()
+        self.channel.shutdown_write()   # end of file for the command's stdin
+        exit_status = self.channel.recv_exit_status()
+        stderr_ = self.channel.makefile_stderr('r').read()
+        self.channel.close()
+        if exit_status != 0:
+            raise IOError(f"IOError: {self.command} exited with status {exit_status}: {stderr_}")
 
 
 class HDFS(SSHConnection):
     """Load data into HDFS"""
 
-    def __init__(self, file_path: str, username: str, password: str, host: str, port: int, ):
-        super().__init__(username, password, host, port)
+    def __init__(self, file_path: str, username: str, password: str, host: str, port: int,
+                 pool: ConnectionPool = None):
+        super().__init__(username, password, host, port, pool)
         self.file_path = file_path
         self.host = host
         self.port = port
         self.username = username
         self.password = password
 
+    def open_put_stream(self, hdfs_file: str, overwrite: bool = True) -> CommandInputStream:
+        """Open a write stream into hdfs_file through hdfs dfs -put's stdin, e.g. for GzipCsvSink"""
+        command = f'hdfs dfs -put {"-f " if overwrite else ""}- {shlex.quote(hdfs_file)}'
+        channel = self.pool.open_channel(self.host, self.port, self.username, self.password)
+        channel.exec_command(command)
+        return CommandInputStream(channel, command)
+
     def load_into_hdfs(self, hdfs_path: str, *files):
-        """load files into hdfs"""
+        """load files into hdfs, one put per file, waiting for each one"""
+        try:
+            if not self.connected:
+                self.connect()
+        except (OSError, EOFError, paramiko.SSHException):
+            print(f"A connection error occurred: not connected to server: {self.host}")
+            return
+        for data in files:
+            result = self.put_files(hdfs_path=hdfs_path + '/' + data, files=[data])
+            if result['exit_status'] != 0:
+                print(f"HDFSLoadError: Failed to load {data} into HDFS: {result['error']}")
+
+    def put_files(self, hdfs_path: str, files: list, overwrite: bool = False) -> dict:
+        """run a single hdfs dfs -put of files, relative to file_path, and wait for it to exit"""
+        sources = ' '.join(shlex.quote(self.file_path + '/' + f) for f in files)
+        command = f'hdfs dfs -put {"-f " if overwrite else ""}{sources} {shlex.quote(hdfs_path)}'
+        start_time = time.time()
+        try:
+            stdin_, stdout_, stderr_ = self.exec_command(command)
+            exit_status = stdout_.channel.recv_exit_status()
+            error = stderr_.read().decode('utf-8', errors='replace').strip()
+        except (OSError, EOFError, paramiko.SSHException) as e:
+            exit_status, error = -1, str(e)
+        return {'files': files, 'exit_status': exit_status, 'error': error,
+                'seconds': time.time() - start_time}
+
+    def remote_sizes(self, files: list) -> dict:
+        """{file: size} of files in file_path on the server, from a single sftp listing.
+        The size of a file that isn't there is None.
+        """
+        sftp = self.pool.open_sftp(self.host, self.port, self.username, self.password)
         try:
-            if self.connected:
-                data_to_load = [f for f in files]
-                for data in data_to_load:
-                    payload = self.file_path + '/' + data
-                    hdfs_dir = hdfs_path + '/' + data
-                    try:
-                        stdin_, stdout_, stderr_ = self.ssh.exec_command(
-                            f'hdfs dfs -put {payload} {hdfs_dir}'
-                        )
-                    except:
-                        print(f"HDFSLoadError: Failed to load {data} into HDFS.")
-            else:
-                raise ConnectionError(f"Not connected to server: {self.host}")
-        except ConnectionError:
-            print("A connection error occurred.")
+            sizes = {attr.filename: attr.st_size for attr in sftp.listdir_attr(self.file_path)}
+        finally:
+            sftp.close()
+        return {f: sizes.get(f) for f in files}
+
+    def hdfs_sizes(self, hdfs_path: str) -> dict:
+        """{file: size} of the files in the hdfs_path directory, from a single hdfs dfs -ls"""
+        stdin_, stdout_, stderr_ = self.exec_command(f'hdfs dfs -ls {shlex.quote(hdfs_path)}')
+        lines = stdout_.read().decode('utf-8', errors='replace').splitlines()
+        if stdout_.channel.recv_exit_status() != 0:
+            print(f"HDFSLoadError: could not list {hdfs_path}")
+        return parse_hdfs_listing(lines)
+
+    def bulk_load(self, hdfs_path: str, files: list, workers: int = 4, overwrite: bool = False,
+                  small_file_bytes: int = 64 * 1024 ** 2, batch_bytes: int = 256 * 1024 ** 2,
+                  retries: int = 1) -> list:
+        """Put files from file_path into the hdfs_path directory with at most workers
+        concurrent puts. Files under small_file_bytes are batched into one put of up
+        to batch_bytes, which saves a hdfs client JVM start per file.
+        A put that fails part way still lands some of its files, so every file is
+        checked against a listing of hdfs_path after the puts, and the files that
+        didn't land are put again with -f, up to retries times. Without overwrite,
+        the files already in hdfs_path with the same size are skipped.
+        Returns a result dict per file: status ('loaded', 'skipped', 'missing' from
+        file_path or 'failed'), bytes, put_seconds (wall clock time of the put that
+        carried the file, shared by the files of a batch) and error.
+        """
+        if not self.connected:
+            self.connect()
+        sizes = self.remote_sizes(files)
+        results = {f: {'file': f, 'status': 'missing', 'bytes': 0, 'put_seconds': None,
+                       'error': f"{self.file_path}/{f} not found"}
+                   for f, size in sizes.items() if size is None}
+        pending = {f: size for f, size in sizes.items() if size is not None}
+        mkdir = self.exec_command(f'hdfs dfs -mkdir -p {shlex.quote(hdfs_path)}')[1]
+        if mkdir.channel.recv_exit_status() != 0:
+            print(f"HDFSLoadError: could not create {hdfs_path}")
+        if not overwrite and pending:
+            landed = self.hdfs_sizes(hdfs_path)
+            for f in [f for f, size in pending.items() if landed.get(f) == size]:
+                results[f] = {'file': f, 'status': 'skipped', 'bytes': pending.pop(f),
+                              'put_seconds': None, 'error': None}
+
+        start_time = time.time()
+        put_seconds = []
+        for attempt in range(retries + 1):
+            if not pending:
+                break
+            if attempt > 0:
+                print(f"HDFS: putting {len(pending)} files again")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # a retry overwrites whatever the failed put left in hdfs_path
+                futures = [executor.submit(self.put_files, hdfs_path, batch, overwrite or attempt > 0)
+                           for batch in plan_put_batches(pending, small_file_bytes, batch_bytes)]
+                puts = [future.result() for future in as_completed(futures)]
+            landed = self.hdfs_sizes(hdfs_path)
+            for put in puts:
+                put_seconds.append(put['seconds'])
+                for f in put['files']:
+                    status = 'loaded' if landed.get(f) == pending[f] else 'failed'
+                    results[f] = {'file': f, 'status': status, 'bytes': pending[f], 'put_seconds': put['seconds'],
+                                  'error': None if status == 'loaded' else put['error'] or 'not in hdfs after the put'}
+            pending = {f: size for f, size in pending.items() if results[f]['status'] == 'failed'}
+        for f in pending:
+            print(f"HDFSLoadError: Failed to load {f} into HDFS: {results[f]['error']}")
+
+        # load window sizing
+        seconds = time.time() - start_time
+        results = [results[f] for f in files]
+        loaded = [r for r in results if r['status'] == 'loaded']
+        total = sum(r['bytes'] for r in loaded)
+        put_seconds = sorted(put_seconds) or [0.0]
+        print(f"HDFS: loaded {len(loaded)}/{len(results)} files, {total / 1024 ** 2:.1f}MB in {seconds:.1f}s "
+              f"({total / 1024 ** 2 / max(seconds, 1e-9):.1f}MB/s), per put latency "
+              f"median {put_seconds[len(put_seconds) // 2]:.1f}s, max {put_seconds[-1]:.1f}s")
+        return results
+
+
+def parse_hdfs_listing(lines: list) -> dict:
+    """{file: size} of the files in the output of hdfs dfs -ls, e.g.
+    -rw-r--r--   3 etl hadoop      1024 2019-05-08 10:00 /data/claims/Docx_2019_05_08.csv
+    The directories and the "Found n items" line are skipped.
+    """
+    sizes = {}
+    for line in lines:
+        parts = line.split(None, 7)
+        if len(parts) == 8 and parts[0].startswith('-'):
+            sizes[parts[7].rsplit('/', 1)[-1]] = int(parts[4])
+    return sizes
+
+
+def plan_put_batches(sizes: dict, small_file_bytes: int, batch_bytes: int, max_files: int = 200) -> list:
+    """Group the files of {file: size} into puts: a large file is put alone,
+    small files share a put of up to batch_bytes and max_files files
+    """
+    batches = []
+    batch, batch_size = [], 0
+    for f, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        if size >= small_file_bytes:
+            batches.append([f])
+            continue
+        if batch and (batch_size + size > batch_bytes or len(batch) >= max_files):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(f)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
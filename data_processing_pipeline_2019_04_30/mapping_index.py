@@ -0,0 +1,94 @@
+"""
+mapping_index
+~~~~~~~~~~~~~
+Hash index over a mapping file, used to join the parser output
+to the mapping file without building a DataFrame of both sides.
+
+# Mapping File #
+files,<value column>
+file.docx,value, which may contain commas
+"""
+import os
+import pandas as pd
+
+
+class MappingIndex(object):
+    """Index of a mapping file on its filename key"""
+
+    def __init__(self, key: str = 'files'):
+        self.key = key
+        self.columns: list = None       # columns of the mapping file
+        self.value_column: str = None   # the column that is not the key
+        self.index: dict = {}           # {filename: value or [values]}
+        self.row_counter: int = 0
+
+    def load(self, file_path: str, file_name: str, chunk_size: int = 1024 * 1024):
+        """Stream the mapping file into the index, chunk_size bytes of lines at a time"""
+        with open(os.path.join(file_path, file_name), 'r', errors='replace') as f:
+            self.columns = f.readline().rstrip('\r\n').split(',', 1)
+            if self.key not in self.columns:
+                raise KeyError(f"KeyError: {file_name} has no {self.key} column: {self.columns}")
+            key_position = self.columns.index(self.key)
+            self.value_column = self.columns[1 - key_position]
+
+            index = self.index
+            while True:
+                lines = f.readlines(chunk_size)
+                if not lines:
+                    break
+                for line in lines:
+                    row = line.rstrip('\r\n').split(',', 1)
+                    if len(row) != 2:
+                        continue    # blank or malformed row
+                    key, value = row[key_position], row[1 - key_position]
+                    if key not in index:
+                        index[key] = value
+                    elif isinstance(index[key], list):
+                        index[key].append(value)
+                    else:
+                        index[key] = [index[key], value]
+                self.row_counter += len(lines)
+        return self
+
+    def lookup(self, key: str) -> list:
+        """Mapping values of key, empty if the key is not mapped"""
+        values = self.index.get(key)
+        if values is None:
+            return []
+        return values if isinstance(values, list) else [values]
+
+    def join(self, records):
+        """Inner join an iterable of parser records, e.g. iter_json_lines or
+        iter_parquet_output, against the index. Yields the merged records
+        with the mapping file's columns first.
+        """
+        for record in records:
+            for value in self.lookup(record[self.key]):
+                merged = {column: record[self.key] if column == self.key else value
+                          for column in self.columns}
+                merged.update((k, v) for k, v in record.items() if k != self.key)
+                yield merged
+
+    def merge(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Inner join a DataFrame with a key column, same result as
+        load_mapping_file(...).merge(df, how='inner').
+        """
+        values = df[self.key].map(self.index)
+        matched = values.notnull()
+        merged = df[matched].assign(**{self.value_column: values[matched]})
+        # a key mapped more than once produces one row per value
+        merged = merged.explode(self.value_column)
+        other_columns = [c for c in df.columns if c not in self.columns]
+        return merged[self.columns + other_columns].reset_index(drop=True)
+
+
+# mapping files are loaded once per run
+_mapping_indexes: dict = {}
+
+
+def load_mapping_index(file_path: str, file_name: str, key: str = 'files') -> MappingIndex:
+    """Load the index of a mapping file, reusing it if it was already loaded"""
+    index_key = (os.path.join(file_path, file_name), key)
+    if index_key not in _mapping_indexes:
+        _mapping_indexes[index_key] = MappingIndex(key=key).load(file_path, file_name)
+    return _mapping_indexes[index_key]
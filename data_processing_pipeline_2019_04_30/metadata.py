@@ -5,6 +5,7 @@ Load in the metadata file to configure updates.
 """
 import os
 import abc
+import csv
 import xlrd
 import pickle
 import tempfile
@@ -197,6 +198,118 @@ class MetaData(MetaDataInterface):
 
 
 
+# Incremental Delta Selection #
+####################################################################################################
+PARSED_EXTENSIONS: tuple = ('doc', 'docx', 'eml', 'pdf', 'rtf', 'csv')
+
+
+def file_name_of(object_name: str, file_ext: str) -> str:
+    """File name of a metadata object for file_ext, None if it is a file of another ext.
+    Object names with a parsed extension are file names already, the others get file_ext.
+    """
+    name = os.path.basename(str(object_name).strip())
+    ext = os.path.splitext(name)[1].lstrip('.').lower()
+    if ext in PARSED_EXTENSIONS:
+        return name if ext == file_ext.lower() else None
+    return name + '.' + file_ext
+
+
+class DeltaSelector(object):
+    """Select the new and changed documents of a delta from its metadata file and
+    keep a watermark of the files that were already processed, by full file name,
+    so the docx and pdf of an object are tracked apart.
+
+    A changed document replaces its Prior_Version_Object_Name. Once it is processed
+    the prior version is recorded as superseded and is never selected again, and a
+    prior version is dropped from a delta that also selects its successor.
+
+    # Watermark File #
+    metadata_date,file_name,superseded_by
+    20190502,Neutral_381977_Allstate Policy.docx,
+    20190503,Neutral_381977_Allstate Policy v2.docx,
+    20190503,Neutral_381977_Allstate Policy.docx,Neutral_381977_Allstate Policy v2.docx
+    """
+    NEW: str = 'new'
+    CHANGED: str = 'changed'
+
+    def __init__(self, metadata: LoadMetaData, watermark_path: str):
+        self.metadata = metadata
+        self.metadata_date: str = metadata.last_used_metadata_file
+        self.watermark_path = watermark_path
+        self.WATERMARK_FILE: str = 'processed_objects_watermark.csv'
+        self.prior_versions: dict = {}  # {file name: file name of its prior version} of the selected files
+
+    def load_watermark(self) -> (dict, dict):
+        """Load the watermark as {file name: set of metadata dates it was processed for}
+        and {file name: file name of its successor} of the superseded files
+        """
+        processed, superseded = {}, {}
+        try:
+            with open(os.path.join(self.watermark_path, self.WATERMARK_FILE), 'r', newline='') as f:
+                for row in csv.reader(f):
+                    if len(row) > 2 and row[2]:
+                        superseded[row[1]] = row[2]
+                    elif len(row) > 1:
+                        processed.setdefault(row[1], set()).add(row[0])
+        except FileNotFoundError:
+            pass    # first incremental run
+        return processed, superseded
+
+    def files_to_parse(self, file_ext: str) -> set:
+        """File names of the delta's file_ext files that still need to be parsed.
+        New files are skipped once they were processed by any run.
+        Changed files are skipped only if they were processed for this delta.
+        Superseded files and the prior versions of the selected files are skipped.
+        """
+        df = self.metadata.current_metadata_file
+        if df is None:
+            raise ValueError("No metadata file loaded, run LoadMetaData.load_metadata first.")
+
+        status = df['new/changed'].astype(str).str.strip().str.lower()
+        delta_df = df[status.isin([self.NEW, self.CHANGED])]
+        processed, superseded = self.load_watermark()
+
+        to_parse = set()
+        self.prior_versions = {}
+        for object_name, prior_name, state in zip(delta_df['Object_name'], delta_df['Prior_Version_Object_Name'],
+                                                  status[delta_df.index]):
+            file_name = file_name_of(object_name, file_ext)
+            if file_name is None or file_name in superseded:
+                continue
+            processed_for = processed.get(file_name, set())
+            if state == self.NEW and processed_for:
+                continue
+            if self.metadata_date in processed_for:
+                continue
+            if state == self.CHANGED and pd.notnull(prior_name):
+                prior_file_name = file_name_of(prior_name, file_ext)
+                if prior_file_name is not None and prior_file_name != file_name:
+                    self.prior_versions[file_name] = prior_file_name
+            to_parse.add(file_name)
+        return to_parse - set(self.prior_versions.values())
+
+    def select_files(self, file_path: str, file_ext: str) -> list:
+        """Build the paths of the delta's files with file_ext without scanning file_path"""
+        files = []
+        for file_name in self.files_to_parse(file_ext):
+            if os.path.isfile(os.path.join(file_path, file_name)):
+                files.append(os.path.join(file_path, file_name))
+        return files
+
+    def update_watermark(self, processed_files: list):
+        """Record the successfully processed files so reruns skip them,
+        and the prior versions they supersede
+        """
+        try:
+            with open(os.path.join(self.watermark_path, self.WATERMARK_FILE), 'a', newline='') as f:
+                writer = csv.writer(f)
+                for file_name in map(os.path.basename, processed_files):
+                    writer.writerow([self.metadata_date, file_name, ''])
+                    if file_name in self.prior_versions:
+                        writer.writerow([self.metadata_date, self.prior_versions[file_name], file_name])
+        except OSError as e:
+            print(e)
+
 
 def main():
     metadata = LoadMetaData()
@@ -0,0 +1,211 @@
+"""
+ole_doc
+~~~~~~~
+In-process text extraction for Word 97-2003 (.doc) files.
+
+A .doc file is an OLE compound file (CFB): a small FAT file system whose
+streams hold the document. The text is read without converting the file:
+    1. the CFB header, DIFAT, FAT, mini FAT and directory locate the
+       WordDocument stream and the 0Table or 1Table stream
+    2. the File Information Block (FIB) at the start of WordDocument
+       gives the position of the Clx in the table stream
+    3. the Clx's piece table maps character positions to the bytes of
+       WordDocument, each piece is cp1252 (compressed) or utf-16
+    4. field codes are removed and control characters become spaces
+
+# Reference #
+[MS-CFB] Compound File Binary File Format
+[MS-DOC] Word (.doc) Binary File Format
+"""
+import re
+import mmap
+import struct
+
+CFB_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# sector numbers above MAXREGSECT end a chain (ENDOFCHAIN, FREESECT, ...)
+MAXREGSECT = 0xFFFFFFFA
+
+# directory entry types
+STREAM_OBJECT = 2
+ROOT_STORAGE = 5
+
+# FIB offsets
+WORD_IDENT = 0xA5EC
+FIB_FLAGS = 0x000A
+FIB_CCP_TEXT = 0x004C   # characters of the main document
+FIB_FC_CLX = 0x01A2     # position and size of the Clx in the table stream
+FIB_ENCRYPTED = 0x0100
+FIB_WHICH_TABLE = 0x0200
+
+# field begin 0x13, separator 0x14, end 0x15: keep the field's result, drop its code
+FIELD_MARKS = re.compile('([\x13\x14\x15])')
+# cell marks, page breaks, drawn objects etc. are separators in the text
+CONTROL_CHARS = str.maketrans({ch: ' ' for ch in map(chr, range(0x20))})
+
+
+class CompoundFile(object):
+    """Read only view of the streams of an OLE compound file"""
+
+    def __init__(self, data):
+        if data[:8] != CFB_SIGNATURE:
+            raise ValueError("not an OLE compound file")
+        self.data = data
+        (self.sector_shift, self.mini_sector_shift) = struct.unpack_from('<HH', data, 0x1E)
+        self.sector_size = 1 << self.sector_shift
+        self.mini_sector_size = 1 << self.mini_sector_shift
+        (num_fat_sectors, first_dir_sector, _, self.mini_stream_cutoff, first_mini_fat_sector,
+         num_mini_fat_sectors, first_difat_sector, num_difat_sectors) = struct.unpack_from('<8I', data, 0x2C)
+        # the number of sectors bounds every chain, so a corrupt file can't loop forever
+        self.max_sectors = max(0, (len(data) - 512) // self.sector_size) + 1
+
+        self.fat = self.load_fat(first_difat_sector, num_difat_sectors, num_fat_sectors)
+        self.entries = self.load_directory(first_dir_sector)
+        root = self.entries[0]
+        if root['type'] != ROOT_STORAGE:
+            raise ValueError("the compound file has no root entry")
+        self.mini_fat = self.sector_array(first_mini_fat_sector) if num_mini_fat_sectors else []
+        self.mini_stream = self.read_chain(root['start'], root['size'])
+
+    def sector(self, n: int):
+        offset = (n + 1) << self.sector_shift
+        return self.data[offset:offset + self.sector_size]
+
+    def chain(self, start: int, table: list):
+        """The sector numbers of a chain in the FAT or mini FAT"""
+        sectors = []
+        n = start
+        while n <= MAXREGSECT:
+            if n >= len(table) or len(sectors) > self.max_sectors:
+                raise ValueError("corrupt sector chain")
+            sectors.append(n)
+            n = table[n]
+        return sectors
+
+    def sector_array(self, start: int) -> list:
+        """The uint32 entries of every sector of a FAT chain"""
+        return [n for sector in self.chain(start, self.fat)
+                for n in struct.unpack(f'<{self.sector_size // 4}I', self.sector(sector))]
+
+    def load_fat(self, first_difat_sector: int, num_difat_sectors: int, num_fat_sectors: int) -> list:
+        # the first 109 FAT sectors are listed in the header, the rest in DIFAT sectors
+        fat_sectors = list(struct.unpack_from('<109I', self.data, 0x4C))
+        per_sector = self.sector_size // 4 - 1
+        n = first_difat_sector
+        for _ in range(num_difat_sectors):
+            if n > MAXREGSECT:
+                break
+            entries = struct.unpack(f'<{per_sector + 1}I', self.sector(n))
+            fat_sectors.extend(entries[:per_sector])
+            n = entries[per_sector]
+        fat = []
+        for n in fat_sectors[:num_fat_sectors]:
+            if n > MAXREGSECT:
+                continue
+            fat.extend(struct.unpack(f'<{self.sector_size // 4}I', self.sector(n)))
+        return fat
+
+    def load_directory(self, first_dir_sector: int) -> list:
+        directory = b''.join(self.sector(n) for n in self.chain(first_dir_sector, self.fat))
+        entries = []
+        for offset in range(0, len(directory) - 127, 128):
+            name_length, entry_type = struct.unpack_from('<HB', directory, offset + 64)
+            start, size = struct.unpack_from('<IQ', directory, offset + 116)
+            if self.sector_size == 512:
+                size &= 0xFFFFFFFF    # version 3 files may leave garbage in the high bits
+            entries.append({
+                'name': directory[offset:offset + max(0, name_length - 2)].decode('utf-16-le', 'replace'),
+                'type': entry_type, 'start': start, 'size': size,
+            })
+        return entries
+
+    def read_chain(self, start: int, size: int) -> bytes:
+        return b''.join(self.sector(n) for n in self.chain(start, self.fat))[:size]
+
+    def read_mini_chain(self, start: int, size: int) -> bytes:
+        shift = self.mini_sector_shift
+        return b''.join(self.mini_stream[n << shift:(n + 1) << shift]
+                        for n in self.chain(start, self.mini_fat))[:size]
+
+    def open_stream(self, name: str) -> bytes:
+        """The contents of the stream called name"""
+        for entry in self.entries:
+            if entry['type'] == STREAM_OBJECT and entry['name'] == name:
+                if entry['size'] < self.mini_stream_cutoff:
+                    return self.read_mini_chain(entry['start'], entry['size'])
+                return self.read_chain(entry['start'], entry['size'])
+        raise KeyError(f"KeyError: the compound file has no {name} stream")
+
+
+def piece_table(table_stream: bytes, fc_clx: int, lcb_clx: int) -> bytes:
+    """The PlcPcd of the Clx, skipping its Prc property entries"""
+    pos = fc_clx
+    end = fc_clx + lcb_clx
+    while pos < end:
+        clxt = table_stream[pos]
+        if clxt == 0x01:    # Prc
+            cb_grpprl, = struct.unpack_from('<h', table_stream, pos + 1)
+            pos += 3 + cb_grpprl
+        elif clxt == 0x02:  # Pcdt
+            lcb, = struct.unpack_from('<I', table_stream, pos + 1)
+            return table_stream[pos + 5:pos + 5 + lcb]
+        else:
+            break
+    raise ValueError("the Clx has no piece table")
+
+
+def read_pieces(word_document: bytes, plc_pcd: bytes, ccp_text: int) -> str:
+    """Decode the pieces of the main document's ccp_text characters"""
+    n = (len(plc_pcd) - 4) // 12
+    cps = struct.unpack_from(f'<{n + 1}I', plc_pcd, 0)
+    text = []
+    for i in range(n):
+        cp_start, cp_end = cps[i], min(cps[i + 1], ccp_text)
+        if cp_start >= cp_end:
+            break
+        fc, = struct.unpack_from('<I', plc_pcd, 4 * (n + 1) + 8 * i + 2)
+        length = cp_end - cp_start
+        if fc & 0x40000000:
+            # compressed piece, one cp1252 byte per character
+            offset = (fc & 0x3FFFFFFF) // 2
+            text.append(word_document[offset:offset + length].decode('cp1252', 'replace'))
+        else:
+            offset = fc & 0x3FFFFFFF
+            text.append(word_document[offset:offset + 2 * length].decode('utf-16-le', 'replace'))
+    return ''.join(text)
+
+
+def clean_doc_text(text: str) -> str:
+    """Remove the field codes and control characters of the document's text"""
+    out = []
+    fields = []     # one entry per open field, True while its code is being read
+    for part in FIELD_MARKS.split(text):
+        if part == '\x13':
+            fields.append(True)
+        elif part == '\x14':
+            if fields:
+                fields[-1] = False
+        elif part == '\x15':
+            if fields:
+                fields.pop()
+        elif not any(fields):
+            out.append(part)
+    return ''.join(out).translate(CONTROL_CHARS)
+
+
+def extract_doc_text(file_name: str) -> str:
+    """Extract the main document text of a .doc file"""
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        ole = CompoundFile(data)
+        word_document = ole.open_stream('WordDocument')
+        w_ident, = struct.unpack_from('<H', word_document, 0)
+        if w_ident != WORD_IDENT:
+            raise ValueError("the WordDocument stream has no Word FIB")
+        flags, = struct.unpack_from('<H', word_document, FIB_FLAGS)
+        if flags & FIB_ENCRYPTED:
+            raise ValueError("the document is encrypted")
+        table_stream = ole.open_stream('1Table' if flags & FIB_WHICH_TABLE else '0Table')
+        ccp_text, = struct.unpack_from('<i', word_document, FIB_CCP_TEXT)
+        fc_clx, lcb_clx = struct.unpack_from('<II', word_document, FIB_FC_CLX)
+        plc_pcd = piece_table(table_stream, fc_clx, lcb_clx)
+        return clean_doc_text(read_pieces(word_document, plc_pcd, ccp_text))
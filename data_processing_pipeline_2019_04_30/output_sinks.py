@@ -0,0 +1,212 @@
+"""
+output_sinks
+~~~~~~~~~~~~
+Append-only outputs for the extracted text.
+
+Records are written as soon as a parser produces them, so the
+size of a run no longer depends on holding every mapping_dict in memory.
+
+# Data Structure #
+{'files': 'file.docx', 'raw_text': 'extracted text'}
+"""
+import io
+import os
+import abc
+import csv
+import gzip
+import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# Parquet schemas #
+####################################################################################################
+if pa is not None:
+    # extracted text, same columns as load_serialized_data
+    TEXT_SCHEMA = pa.schema([('files', pa.string()), ('raw_text', pa.large_string())])
+
+    # by-page pdf output, see PdfParser.route_page
+    PAGE_SCHEMA = pa.schema([
+        ('filename', pa.string()), ('page', pa.int32()), ('text', pa.large_string()),
+        ('route', pa.string()), ('chars', pa.int64()), ('images', pa.int32()),
+        ('extract_seconds', pa.float64()), ('ocr_seconds', pa.float64()),
+    ])
+else:
+    TEXT_SCHEMA = PAGE_SCHEMA = None
+
+
+# Interfaces #
+####################################################################################################
+class OutputSinkInterface(metaclass=abc.ABCMeta):
+    """An interface for append-only parser outputs"""
+
+    @abc.abstractmethod
+    def write_record(self, record: dict):
+        """Append a single record to the output."""
+        pass
+
+    @abc.abstractmethod
+    def flush(self):
+        """Push the buffered records to the output."""
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        """Flush and close the output."""
+        pass
+
+    def write(self, mapping: dict):
+        """Append the {filename: raw_text} output of extract_text"""
+        for file_name, raw_text in mapping.items():
+            self.write_record({'files': file_name, 'raw_text': raw_text})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Concrete Sinks #
+####################################################################################################
+class JsonLinesSink(OutputSinkInterface):
+    """Write records to a JSON Lines file. An existing file is overwritten,
+    unless append is set, e.g. to resume a checkpointed run.
+    """
+
+    def __init__(self, write_path: str, file_name: str, flush_every: int = 1000,
+                 append: bool = False):
+        self.write_path = write_path
+        self.file_name = file_name
+        self.flush_every = flush_every
+        self.record_counter: int = 0     # count of the records written
+        self.f = open(os.path.join(write_path, file_name), 'a' if append else 'w', encoding='utf-8')
+
+    def write_record(self, record: dict):
+        self.f.write(json.dumps(record) + '\n')
+        self.record_counter += 1
+        if self.record_counter % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def tell(self) -> int:
+        """Bytes written to the file, including the buffered records"""
+        self.f.flush()
+        return os.path.getsize(os.path.join(self.write_path, self.file_name))
+
+    def truncate(self, size: int):
+        """Cut the file back to size bytes, e.g. to the last checkpoint of a crashed run"""
+        self.f.flush()
+        if self.tell() > size:
+            self.f.truncate(size)
+            self.f.seek(size)
+            self.flush()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+
+def iter_json_lines(file_path: str, file_name: str):
+    """Lazily load the records of a JSON Lines output"""
+    with open(os.path.join(file_path, file_name), 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line of a crashed run can be incomplete
+                print(f"ValueError: skipping a malformed record in {file_name}")
+
+
+class ParquetSink(OutputSinkInterface):
+    """Append records to a compressed Parquet file, one row group per
+    row_group_size records, so the file can be read lazily by column.
+    """
+
+    def __init__(self, write_path: str, file_name: str, schema=None,
+                 row_group_size: int = 5000, compression: str = 'zstd'):
+        if pa is None:
+            raise ImportError("ParquetSink requires pyarrow: pip install pyarrow")
+        self.write_path = write_path
+        self.file_name = file_name
+        self.schema = schema or TEXT_SCHEMA
+        self.row_group_size = row_group_size
+        self.record_counter: int = 0     # count of the records written
+        self.records: list = []          # records of the next row group
+        self.writer = pq.ParquetWriter(os.path.join(write_path, file_name),
+                                       schema=self.schema, compression=compression)
+
+    def write_record(self, record: dict):
+        self.records.append(record)
+        self.record_counter += 1
+        if len(self.records) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            self.writer.write_table(pa.Table.from_pylist(self.records, schema=self.schema))
+            self.records = []
+
+    def close(self):
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+
+
+class GzipCsvSink(OutputSinkInterface):
+    """Write records as gzip compressed csv rows to a binary file object, e.g.
+    SftpConnection.open_remote_file or HDFS.open_put_stream, so the merged
+    output is compressed on the fly and never staged on the local disk.
+    Rows have the same layout as write_dataframe_to_csv: a header, no index.
+    """
+
+    def __init__(self, fileobj, columns: list, compresslevel: int = 6):
+        self.fileobj = fileobj
+        self.columns = columns
+        self.record_counter: int = 0     # count of the records written
+        self.gzip = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel)
+        self.text = io.TextIOWrapper(self.gzip, encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.text, fieldnames=columns, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write_record(self, record: dict):
+        self.writer.writerow(record)
+        self.record_counter += 1
+
+    def flush(self):
+        self.text.flush()
+
+    def close(self):
+        if not self.text.closed:
+            # closing the text wrapper writes the gzip trailer, the file object is closed after it
+            self.text.close()
+            self.fileobj.close()
+
+
+def load_parquet_output(file_path: str, file_name: str, columns: list = None):
+    """Load a Parquet output into a pandas DataFrame.
+    The file is memory mapped and only the projected columns are read.
+    """
+    if pq is None:
+        raise ImportError("load_parquet_output requires pyarrow: pip install pyarrow")
+    table = pq.read_table(os.path.join(file_path, file_name), columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def iter_parquet_output(file_path: str, file_name: str, columns: list = None, batch_size: int = 5000):
+    """Lazily load the records of a Parquet output, one batch at a time"""
+    if pq is None:
+        raise ImportError("iter_parquet_output requires pyarrow: pip install pyarrow")
+    parquet_file = pq.ParquetFile(os.path.join(file_path, file_name), memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield from batch.to_pylist()
@@ -10,7 +10,7 @@ Optical Character Recognition(OCR) for PDF text.
 # Data Structure #
 [
     {'File Name': file.pdf,
-     'Page_0': {'Text': 'text string', 'Image File 1': img.png, ...}
+     'Page_0': {'Text': 'text string', 'Images': {'file_Page0_0.png': 'ocr text', ...}}
     }
 
 ]
@@ -23,13 +23,209 @@ import time
 import PyPDF2
 import pytesseract
 from PIL import Image
-from wand.image import Image as wand_img
-from data_processing_pipeline_2019_04_30.configuration import extracted_pdf_images
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    # tesseract's C API, keeps one tesseract instance alive per process. Required for
+    # production runs: without it every image is OCRed by a new tesseract process
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 # path to tesseract executable
 pytesseract.pytesseract.tesseract_cmd = 'C:\\Program Files\\Tesseract-OCR\\tesseract'
 
 
+# An image handed to the OCR engine.
+# Decoded pixels: ImagePayload(name, 'RGB', (width, height), raw bytes)
+# Encoded image file (.jpg, .jp2, .png): ImagePayload(name, None, None, file bytes)
+ImagePayload = namedtuple('ImagePayload', ['name', 'mode', 'size', 'data'])
+
+
+def payload_to_image(payload: ImagePayload) -> Image.Image:
+    """Build a PIL image from a payload without re-encoding it"""
+    if payload.mode is not None:
+        return Image.frombytes(payload.mode, payload.size, payload.data)
+    return Image.open(io.BytesIO(payload.data))
+
+
+def count_page_images(page) -> int:
+    """Count the image XObjects of a pdf page without decoding them"""
+    try:
+        xObject = page['/Resources']['/XObject'].getObject()
+    except KeyError:
+        return 0
+    return sum(1 for obj in xObject if xObject[obj].get('/Subtype') == '/Image')
+
+
+def page_images(page, name_prefix: str) -> list:
+    """Decode the image XObjects of a pdf page in memory"""
+    try:
+        xObject = page['/Resources']['/XObject'].getObject()
+    except KeyError:
+        return []   # no images on the page
+
+    payloads = []
+    m = 0   # sub page counter
+    for obj in xObject:
+        image = xObject[obj]
+        if image.get('/Subtype') != '/Image':
+            continue
+        image_filter = image.get('/Filter')
+        if image_filter == '/FlateDecode':
+            # raw pixels
+            size = (image['/Width'], image['/Height'])
+            if image.get('/ColorSpace') == '/DeviceRGB':
+                mode = "RGB"
+            elif image.get('/ColorSpace') == '/DeviceGray':
+                mode = "L"
+            else:
+                mode = "P"
+            payloads.append(ImagePayload(f'{name_prefix}_{m}.png', mode, size, image.getData()))
+        elif image_filter == '/DCTDecode':
+            # .jpg
+            payloads.append(ImagePayload(f'{name_prefix}_{m}.jpg', None, None, image._data))
+        elif image_filter == '/JPXDecode':
+            # .jp2
+            payloads.append(ImagePayload(f'{name_prefix}_{m}.jp2', None, None, image._data))
+        else:
+            continue
+        m += 1
+    return payloads
+
+
+def write_image_payload(payload: ImagePayload, write_path: str):
+    """Debug sink: write an image payload to disk"""
+    os.makedirs(write_path, exist_ok=True)
+    if payload.mode is not None:
+        payload_to_image(payload).save(os.path.join(write_path, payload.name))
+    else:
+        with open(os.path.join(write_path, payload.name), 'wb') as img:
+            img.write(payload.data)
+
+
+# OCR worker process state #
+####################################################################################################
+_tess_api = None    # tesserocr.PyTessBaseAPI of the current worker process
+_ocr_lang = 'eng'
+
+
+def init_ocr_worker(lang: str, tesseract_cmd: str):
+    """Load tesseract once per process. With workers=0 OCREngine.start calls this
+    for every document, so the loaded instance is reused while lang is the same.
+    """
+    global _tess_api, _ocr_lang
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    if tesserocr is not None and (_tess_api is None or _ocr_lang != lang):
+        if _tess_api is not None:
+            _tess_api.End()
+        _tess_api = tesserocr.PyTessBaseAPI(lang=lang)
+    _ocr_lang = lang
+
+
+def ocr_image_batch(payloads: list) -> list:
+    """OCR a batch of images inside a worker process.
+    Returns [(name, text, error, seconds), ...]
+    """
+    results = []
+    for payload in payloads:
+        start = time.perf_counter()
+        try:
+            img = payload_to_image(payload)
+            if _tess_api is not None:
+                _tess_api.SetImage(img)
+                text = _tess_api.GetUTF8Text()
+            else:
+                # no tesserocr, fall back to a tesseract process per image
+                text = pytesseract.image_to_string(img, lang=_ocr_lang)
+            results.append((payload.name, text, None, time.perf_counter() - start))
+        except Exception as e:
+            results.append((payload.name, None, str(e), time.perf_counter() - start))
+    return results
+
+
+class OCREngine(object):
+    """A pool of long-lived tesseract worker processes that OCR batches of images.
+    With workers=0 the images are OCRed in the current process, e.g. when the
+    engine is used inside a ParserFactory worker process.
+    """
+
+    def __init__(self, workers: int = None, batch_size: int = 8, lang: str = 'eng'):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.batch_size = batch_size
+        self.lang = lang
+        self.executor: ProcessPoolExecutor = None
+
+        # throughput counters
+        self.image_counter: int = 0
+        self.error_counter: int = 0
+        self.seconds: float = 0.0
+
+    def start(self):
+        if self.workers == 0:
+            init_ocr_worker(self.lang, pytesseract.pytesseract.tesseract_cmd)
+        elif self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=init_ocr_worker,
+                initargs=(self.lang, pytesseract.pytesseract.tesseract_cmd)
+            )
+        return self
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def ocr_images(self, payloads):
+        """OCR an iterable of ImagePayloads, yielding (name, text, error, seconds)
+        as the batches finish. Results are not in input order.
+        At most 2 batches per worker are in flight, so payloads are pulled
+        from the iterable only as fast as they are OCRed.
+        """
+        self.start()
+        start = time.perf_counter()
+        if self.workers == 0:
+            for payload in payloads:
+                yield from self.count_results(ocr_image_batch([payload]))
+            self.seconds += time.perf_counter() - start
+            return
+        pending = set()
+        batch = []
+        for payload in payloads:
+            batch.append(payload)
+            if len(batch) == self.batch_size:
+                pending.add(self.executor.submit(ocr_image_batch, batch))
+                batch = []
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self.batch_results(done)
+        if batch:
+            pending.add(self.executor.submit(ocr_image_batch, batch))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from self.batch_results(done)
+        self.seconds += time.perf_counter() - start
+
+    def batch_results(self, futures):
+        for future in futures:
+            yield from self.count_results(future.result())
+
+    def count_results(self, results: list):
+        for name, text, error, seconds in results:
+            self.image_counter += 1
+            if error is not None:
+                self.error_counter += 1
+            yield name, text, error, seconds
+
+    def images_per_second(self) -> float:
+        return self.image_counter / self.seconds if self.seconds else 0.0
 
 
 
@@ -53,120 +249,87 @@ class PdfOCR(OCRInterface):
         self.extracted_pdfs = []
         self.pdf_contents   = []
 
-    def extract_pdf_images(self, file_path: str):
+    def extract_pdf_images(self, file_path: str, engine: OCREngine = None, debug_path: str = None):
+        """OCR the images of every pdf in file_path in memory.
+        Images are only written to disk if debug_path is set, e.g. extracted_pdf_images.
+        """
         try:
             if os.path.exists(file_path):
-                for f in os.listdir(file_path):
-                    print(f'Current Pdf: {f}')
-                    if os.path.splitext(f)[-1] == '.pdf':
-                        # open the current pdf
-                        pdf_reader = PyPDF2.PdfFileReader(
-                            open(os.path.join(file_path, f), 'rb')
-                        )
-                        # get the number of pages
-                        num_pages = pdf_reader.getNumPages()
-                        # create a dictionary for the current pdf
-                        current_pdf = {}
-                        print(f'number of pages: {num_pages}')
-                        # iterate through each page and extract the pdf's contents
-                        n = 0
-                        while n < num_pages:
-                            # get the current page
-                            page = pdf_reader.getPage(n)
-                            # get the xObject
-                            xObject = page['/Resources']['/XObject'].getObject()
-                            # get any text that may exist on the page
-                            text = page.extractText()
-                            # sub page counter
-                            m = 0
-
-                            # iterate through the xObject's elements
-                            for obj in xObject:
-                                if xObject[obj]['/Subtype'] == '/Image':
-                                    size = (xObject[obj]['/Width'], xObject[obj]['/Height'])
-                                    data = xObject[obj]._data
-                                    if xObject[obj]['/ColorSpace'] == '/DeviceRGB':
-                                        mode = "RGB"
-                                    else:
-                                        mode = "P"
-
-                                if xObject[obj]['/Filter'] == '/FlateDecode':
-                                    # .png
-                                    # create a directory for the image
-                                    pdf_name = os.path.basename(os.path.splitext(f)[0])  # current pdf
-
-                                    if not os.path.exists(os.path.join(extracted_pdf_images, pdf_name)):
-                                        # create a directory for the current pdf
-                                        new_dir = os.path.join(extracted_pdf_images, pdf_name)
-                                        os.mkdir(new_dir)
-                                        time.sleep(4)
-
-                                    # save the image file
-                                    img = Image.frombytes(mode, size, data)
-                                    img.save(os.path.join(new_dir, f'ImgFilePage{n}_{m}.png'))
-                                    m += 1
-
-                                elif xObject[obj]['/Filter'] == '/DCTDecode':
-                                    # .jpg
-                                    # create a directory for the image
-                                    pdf_name = os.path.basename(os.path.splitext(f)[0])  # current pdf
-
-                                    if not os.path.exists(os.path.join(extracted_pdf_images, pdf_name)):
-                                        # create a directory for the current pdf
-                                        new_dir = os.path.join(extracted_pdf_images, pdf_name)
-                                        os.mkdir(new_dir)
-                                        time.sleep(4)
-
-                                    # save the image file
-                                    img = open(os.path.join(new_dir, f'ImgFilePage{n}_{m}.jpg'), "wb")
-                                    img.write(data)
-                                    img.close()
-                                    m += 1
-
-                                elif xObject[obj]['/Filter'] == '/JPXDecode':
-                                    # .jp2
-                                    # create a directory for the image
-                                    pdf_name = os.path.basename(os.path.splitext(f)[0])  # current pdf
-
-                                    if not os.path.exists(os.path.join(extracted_pdf_images, pdf_name)):
-                                        # create a directory for the current pdf
-                                        new_dir = os.path.join(extracted_pdf_images, pdf_name)
-                                        os.mkdir(new_dir)
-                                        time.sleep(4)
-
-                                    # save the image file
-                                    img = open(os.path.join(new_dir,  f'ImgFilePage{n}_{m}.jp2'), "wb")
-                                    img.write(data)
-                                    img.close()
-                                    m += 1
-                                else:
-                                    print(f'File: {f}: No images on page: {n}')
-                            # increment the page counter
-                            n += 1
+                own_engine = engine is None
+                engine = (engine or OCREngine()).start()
+                try:
+                    for f in os.listdir(file_path):
+                        if os.path.splitext(f)[-1] == '.pdf':
+                            print(f'Current Pdf: {f}')
+                            self.pdf_contents.append(
+                                self.ocr_pdf(os.path.join(file_path, f), engine, debug_path)
+                            )
+                finally:
+                    if own_engine:
+                        engine.shutdown()
         except:
             print('An error has occurred')
 
+    def ocr_pdf(self, pdf_file: str, engine: OCREngine, debug_path: str = None) -> dict:
+        """OCR the images of a single pdf, streaming them from the pdf to the engine"""
+        pdf_name = os.path.basename(os.path.splitext(pdf_file)[0])  # current pdf
+        current_pdf = {'File Name': os.path.basename(pdf_file)}
+        image_pages = {}    # {image name: page number}
+
+        def images():
+            with open(pdf_file, 'rb') as f:
+                pdf_reader = PyPDF2.PdfFileReader(f)
+                num_pages = pdf_reader.getNumPages()
+                print(f'number of pages: {num_pages}')
+                for n in range(num_pages):
+                    page = pdf_reader.getPage(n)
+                    current_pdf[f'Page_{n}'] = {'Text': page.extractText(), 'Images': {}}
+                    payloads = page_images(page, f'{pdf_name}_Page{n}')
+                    if not payloads:
+                        print(f'File: {pdf_name}: No images on page: {n}')
+                    for payload in payloads:
+                        image_pages[payload.name] = n
+                        if debug_path is not None:
+                            write_image_payload(payload, os.path.join(debug_path, pdf_name))
+                        yield payload
+
+        for name, text, error, _ in engine.ocr_images(images()):
+            if error is not None:
+                print(f'An error occurred while ocring image: {name}')
+            else:
+                current_pdf[f'Page_{image_pages[name]}']['Images'][name] = text
+        self.extracted_pdfs.append(pdf_file)
+        return current_pdf
 
-    def ocr_image_file(self, img_file_path: str):
+    def ocr_image_file(self, img_file_path: str, engine: OCREngine = None):
         try:
             if os.path.isdir(img_file_path):
-                for f in os.listdir(img_file_path):
-                    print(f'Extracting text from file: {f}')
-                    try:
-                        img_ = wand_img(filename=os.path.join(img_file_path, f), resolution=300)
-                        wnd_img = wand_img(image=img_).make_blob(
-                            os.path.splitext(f)[-1].lstrip('.')
-                        )
-                        im = Image.open(io.BytesIO(wnd_img))
-                        text = pytesseract.image_to_string(im, lang='eng')
-                        self.extracted_pdfs.append(text)
-                    except:
-                        print(f'An error occurred while ocring image: {f}')
+                payloads = self.load_image_files(img_file_path)
+                if engine is None:
+                    with OCREngine() as engine:
+                        self.collect_ocr_results(engine.ocr_images(payloads))
+                else:
+                    self.collect_ocr_results(engine.ocr_images(payloads))
+                print(f'OCR throughput: {engine.images_per_second():.2f} images per second')
             else:
                 raise OSError(f'OSError: Path, {img_file_path} not found.')
         except OSError as e:
             print(e)
 
+    def load_image_files(self, img_file_path: str):
+        """Read the image files of a directory as encoded payloads"""
+        for f in os.listdir(img_file_path):
+            print(f'Extracting text from file: {f}')
+            with open(os.path.join(img_file_path, f), 'rb') as img:
+                yield ImagePayload(f, None, None, img.read())
+
+    def collect_ocr_results(self, results):
+        for name, text, error, _ in results:
+            if error is not None:
+                print(f'An error occurred while ocring image: {name}')
+            else:
+                self.extracted_pdfs.append(text)
+
 
 img_file = "Y:\\Shared\\USD\\Business Data and Analytics\\Claims_Pipeline_Files" \
            "\\BDA_Cliams_Pipeline\\extracted_pdf_images" \
@@ -176,9 +339,7 @@ img_file = "Y:\\Shared\\USD\\Business Data and Analytics\\Claims_Pipeline_Files"
 
 def ocr_image(file_name: str):
     """Ocr an image"""
-    img_ = wand_img(filename=file_name, resolution=300)
-    wnd_img = wand_img(image=img_).make_blob("jpg")
-    im = Image.open(io.BytesIO(wnd_img))
+    im = Image.open(file_name)
     text = pytesseract.image_to_string(im, lang='eng')
     print(text)
 
@@ -0,0 +1,184 @@
+"""
+rtf_decoder
+~~~~~~~~~~~
+Linear time, streaming rtf to text decoder.
+
+The file is read in chunks of bytes and every chunk is tokenized once:
+    - text is emitted as it is decoded, never re-joined per token
+    - ignorable destinations ({\\*...}, \\pict, \\fonttbl, ...) are skipped
+      by scanning for braces only, without decoding their contents
+    - \\bin data is skipped by its byte count
+    - plain text and \\'xx bytes are decoded with the document's code page
+      (\\ansicpg, \\ansi, \\mac, \\pc, \\pca) instead of utf-8
+"""
+import re
+import codecs
+from data_processing_pipeline_2019_04_30.file_encoders import destinations, specialchars
+
+# control word, hex byte, control symbol, brace, raw newline or a run of plain text
+RTF_TOKEN = re.compile(
+    rb"\\([a-zA-Z]{1,32})(-?\d{1,10})? ?|\\'([0-9a-fA-F]{2})|\\([^a-zA-Z])|([{}])|[\r\n]+|([^\\{}\r\n]+)",
+    re.S
+)
+# inside an ignorable destination only braces, escapes and binary data matter
+RTF_SKIP = re.compile(rb"\\bin(-?\d{1,10}) ?|\\.|[{}]", re.S)
+
+# character set control words
+CHARSETS = {'ansi': 'cp1252', 'mac': 'mac_roman', 'pc': 'cp437', 'pca': 'cp850'}
+
+# a control word is at most 45 bytes long, keep the tail of a chunk that may hold a partial one
+TOKEN_TAIL = 64
+
+
+class RtfDecoder(object):
+    """Incremental rtf decoder. feed() the file's bytes in chunks, then close()"""
+
+    def __init__(self):
+        self.stack: list = []           # (ucskip, ignorable) of the enclosing groups
+        self.ignorable: bool = False
+        self.ucskip: int = 1            # characters to skip after a \u character
+        self.curskip: int = 0
+        self.codepage: str = 'cp1252'
+        self.skip_bytes: int = 0        # \bin bytes still to skip
+        self.pending = bytearray()      # code page bytes not decoded yet
+        self.out: list = []             # decoded text of the current feed
+        self.tail: bytes = b''          # bytes held back from the last feed
+
+    def feed(self, data: bytes, final: bool = False) -> str:
+        """Decode a chunk of the rtf file and return the text it produced"""
+        buf = self.tail + data
+        end = len(buf)
+        if not final:
+            # hold back a control word that may continue in the next chunk
+            start = max(0, end - TOKEN_TAIL)
+            while start > 0 and buf[start - 1:start] == b'\\':
+                start -= 1
+            cut = buf.find(b'\\', start)
+            if cut != -1:
+                end = cut
+        self.tail = buf[end:]
+        self.decode(buf, end)
+        self.flush()
+        text = ''.join(self.out)
+        self.out = []
+        return text
+
+    def close(self) -> str:
+        return self.feed(b'', final=True)
+
+    def flush(self):
+        """Decode the pending code page bytes"""
+        if self.pending:
+            self.out.append(self.pending.decode(self.codepage, errors='replace'))
+            self.pending.clear()
+
+    def emit(self, text: str):
+        self.flush()
+        self.out.append(text)
+
+    def set_codepage(self, codepage: str):
+        try:
+            codecs.lookup(codepage)
+        except LookupError:
+            return  # unknown code page, keep the current one
+        self.flush()
+        self.codepage = codepage
+
+    def pop_group(self):
+        self.curskip = 0
+        if self.stack:
+            self.ucskip, self.ignorable = self.stack.pop()
+        else:
+            self.ignorable = False
+
+    def decode(self, buf: bytes, end: int):
+        pos = 0
+        while pos < end:
+            if self.skip_bytes:
+                skipped = min(self.skip_bytes, end - pos)
+                self.skip_bytes -= skipped
+                pos += skipped
+                continue
+
+            if self.ignorable:
+                match = RTF_SKIP.search(buf, pos, end)
+                if match is None:
+                    break
+                pos = match.end()
+                token = match.group()
+                if token == b'{':
+                    self.stack.append((self.ucskip, self.ignorable))
+                elif token == b'}':
+                    self.pop_group()
+                elif match.group(1) is not None:
+                    self.skip_bytes = max(0, int(match.group(1)))
+                continue
+
+            match = RTF_TOKEN.match(buf, pos, end)
+            if match is None:
+                pos += 1    # a lone backslash at the end of the file
+                continue
+            pos = match.end()
+            word, arg, hex_byte, char, brace, text = match.groups()
+
+            if text is not None:
+                if self.curskip:
+                    skipped = min(self.curskip, len(text))
+                    self.curskip -= skipped
+                    text = text[skipped:]
+                self.pending += text
+            elif hex_byte is not None:
+                if self.curskip:
+                    self.curskip -= 1
+                else:
+                    self.pending.append(int(hex_byte, 16))
+            elif brace is not None:
+                self.curskip = 0
+                if brace == b'{':
+                    # Push state
+                    self.stack.append((self.ucskip, self.ignorable))
+                else:
+                    # Pop state
+                    self.pop_group()
+            elif char is not None:  # \x (not a letter)
+                self.curskip = 0
+                if char == b'~':
+                    self.emit('\xA0')
+                elif char in b'{}\\':
+                    self.emit(char.decode('ascii'))
+                elif char == b'*':
+                    self.ignorable = True
+            elif word is not None:  # \foo
+                self.curskip = 0
+                word = word.decode('ascii')
+                if word in destinations:
+                    self.ignorable = True
+                elif word in specialchars:
+                    self.emit(specialchars[word])
+                elif word == 'uc':
+                    self.ucskip = int(arg or 1)
+                elif word == 'u' and arg:
+                    c = int(arg)
+                    if c < 0:
+                        c += 0x10000
+                    self.emit(chr(c))
+                    self.curskip = self.ucskip
+                elif word == 'ansicpg' and arg:
+                    self.set_codepage('cp' + arg.decode('ascii'))
+                elif word in CHARSETS:
+                    self.set_codepage(CHARSETS[word])
+                elif word == 'bin' and arg:
+                    self.skip_bytes = max(0, int(arg))
+
+
+def decode_rtf_file(file_name: str, chunk_size: int = 1024 * 1024):
+    """Yield the text of an rtf file as each chunk is decoded"""
+    decoder = RtfDecoder()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            text = decoder.feed(chunk)
+            if text:
+                yield text
+    text = decoder.close()
+    if text:
+        yield text
@@ -5,7 +5,6 @@ Run the unstructured data pipeline.
 """
 import os
 import sys
-import time
 from pprint import pprint
 from datetime import datetime, timedelta
 # from data_processing_pipeline_2019_04_30.configuration import (
@@ -23,11 +22,14 @@ from data_processing_pipeline_2019_04_30.config import (
 
 from data_processing_pipeline_2019_04_30.data_preprocessing import (
     EmlParser, RtfParser, DocParser, DocxParser, PdfParser, ParserFactory,
-    load_mapping_file, load_serialized_data , write_dataframe_to_csv
+    load_serialized_data , write_dataframe_to_csv
 )
+from data_processing_pipeline_2019_04_30.mapping_index import MappingIndex, load_mapping_index
+from data_processing_pipeline_2019_04_30.output_sinks import GzipCsvSink
 from data_processing_pipeline_2019_04_30.server import SftpConnection
 from data_processing_pipeline_2019_04_30.hive import Hive, HivCli, HDFS
-from data_processing_pipeline_2019_04_30.metadata import LoadMetaData, TEST_METADATA_FILE
+from data_processing_pipeline_2019_04_30.metadata import LoadMetaData, DeltaSelector, TEST_METADATA_FILE
+from data_processing_pipeline_2019_04_30.dag_runner import DagRunner
 
 
 
@@ -46,89 +48,296 @@ def compare_delta_to_metadata():
     """
 
 
-def create_hive_table(table_name: str, database: str) -> None:
+def create_hive_table(table_name: str, database: str, table: Hive = None) -> None:
     """
     Creates a Hive table with the following format:
     Columns: object_id(Integer), claim_id(Integer), filename(String), file_extension(String), extracted_text(String)
+    :param table: the Hive connection to use, e.g. one with an open session
     :return:
     """
 
-    table = Hive(username=username, password=password, host=host, port=int(port))
+    table = table or Hive(username=username, password=password, host=host, port=int(port))
     # build the ExtractedText Table
     table.create_hive_table(table_name=table_name, database=database,
                             object_id='String', claim_id='String',
                             filename='String', file_extension='String',
                             extracted_text='String')
 
-def load_data_into_hive(file_name: str, table_name: str) -> None:
+def load_data_into_hive(file_name: str, table_name: str, hdfs_path: str = None,
+                        table: Hive = None) -> None:
     """
     Load the raw data set into the hive table.
     :param table_name:
     :param database:
+    :param hdfs_path: load the file from this hdfs directory instead of the
+        edge node's claims_insights_remote_path
+    :param table: the Hive connection to use, e.g. one with an open session
     :return:
     """
+    table = table or Hive(username=username, password=password, host=host, port=int(port))
+    if hdfs_path is not None:
+        table.load_hive_table(file_path=hdfs_path, file_name=file_name,
+                              table_name=table_name, local=False)
+    else:
+        table.load_hive_table(file_path=claims_insights_remote_path,
+                              file_name=file_name, table_name=table_name)
+
+
+def create_and_load_hive_table(file_name: str, table_name: str, database: str = 'drw',
+                               hdfs_path: str = None, columns: list = None, partition: dict = None,
+                               stored_as: str = 'ORC') -> list:
+    """
+    Create the hive table and load file_name into it in a single hive invocation.
+    :param columns: the columns of the csv file. With partition, the table gets
+        these String columns and is stored_as a compressed ORC or PARQUET table
+    :param partition: {column: value} of the partition the file replaces, e.g.
+        {'load_date': d, 'file_format': 'docx'}, so a rerun of the day doesn't
+        duplicate its rows. None for the text table of create_hive_table, which
+        the file overwrites
+    :return: the HiveResult of each statement
+    """
     table = Hive(username=username, password=password, host=host, port=int(port))
-    table.load_hive_table(file_path=claims_insights_remote_path,
-                          file_name=file_name, table_name=table_name)
+    with table.session(database=database) as batch:
+        if partition is None:
+            create_hive_table(table_name=table_name, database=database, table=table)
+            load_data_into_hive(file_name=file_name, table_name=table_name,
+                                hdfs_path=hdfs_path, table=table)
+        else:
+            table.create_hive_table(table_name=table_name, database=database,
+                                    partitioned_by={k: 'String' for k in partition},
+                                    stored_as=stored_as, **{c: 'String' for c in columns})
+            table.load_hive_partition(file_path=hdfs_path or claims_insights_remote_path,
+                                      file_name=file_name, table_name=table_name, columns=columns,
+                                      partition=partition, local=hdfs_path is None)
+    failed = [r for r in batch.results if r.status != 'ok']
+    if failed:
+        print(f"HiveError: {failed[0].statement[:80]} {failed[0].status}: {failed[0].output}")
+    return batch.results
+
+
+def stream_merged_records(records, mapping_index: MappingIndex, file_name: str,
+                          hdfs_path: str = None) -> int:
+    """
+    Join the parser records to the mapping file and stream them as a gzip
+    compressed csv file straight to claims_insights_remote_path over sftp,
+    or to hdfs_path through hdfs dfs -put. Nothing is written locally.
+    :param records: iterable of {'files', 'raw_text'} records, e.g. iter_json_lines
+    :return: the number of rows written
+    """
+    sftp_conn = None
+    if hdfs_path is not None:
+        hdfs = HDFS(file_path=hdfs_path, username=username, password=password, host=host, port=int(port))
+        remote_file = hdfs.open_put_stream(hdfs_file=hdfs_path + '/' + file_name)
+    else:
+        sftp_conn = SftpConnection(root_path=docx_write_path, remote_path=claims_insights_remote_path)
+        remote_file = sftp_conn.open_remote_file(file_name=file_name)
+
+    try:
+        with GzipCsvSink(remote_file, columns=mapping_index.columns + ['raw_text']) as sink:
+            for record in mapping_index.join(records):
+                sink.write_record(record)
+    finally:
+        if sftp_conn is not None:
+            sftp_conn.close()   # the sftp session of remote_file, the transport stays in the pool
+    print(f"Streamed {sink.record_counter} rows to {file_name}")
+    return sink.record_counter
+
+
+
+def select_delta_files(raw_files: str, file_ext: str) -> (list, DeltaSelector):
+    """Select the new and changed files of yesterday's delta metadata file"""
+    metadata = LoadMetaData()
+    metadata.load_metadata(file_path=prod_delta)
+    selector = DeltaSelector(metadata=metadata, watermark_path=pickle_path)
+    return selector.select_files(file_path=raw_files, file_ext=file_ext), selector
+
+
+def run_docx_parser(raw_files: str, incremental: bool = False, stream: bool = False,
+                    hdfs_path: str = None):
+    """run docx parser
+    :param stream: merge the parsed text in memory and stream it to the server as
+        Docx_MergedDataFrame_<date>.csv.gz, without the local pickle and csv files
+    :param hdfs_path: with stream, write the merged file to this hdfs directory
+    """
+    # extract the text and write to a pickle file
+    if incremental:
+        files, selector = select_delta_files(raw_files=raw_files, file_ext='docx')
+        parser_factory.parse_file_ext(file_path=raw_files, file_ext='docx', files=files)
+    else:
+        parser_factory.parse_file_ext(file_path=raw_files, file_ext='docx')
 
+    # load the mapping file index
+    mapping_index = load_mapping_index(file_path=mapping_file, file_name='DocxMappingFile.csv')
 
+    if stream:
+        docx_merged_df = 'Docx_MergedDataFrame_' + d + '.csv.gz'
+        records = ({'files': k, 'raw_text': v} for k, v in parser_factory.file_parser.items())
+        stream_merged_records(records, mapping_index, file_name=docx_merged_df, hdfs_path=hdfs_path)
+    else:
+        parser_factory.serialize_contents(write_path=pickle_path)
 
-def run_docx_parser(raw_files: str):
-    """run docx parser"""
-    # extract the text and write to a pickle file
-    parser_factory.parse_file_ext(file_path=raw_files, file_ext='docx')
-    parser_factory.serialize_contents(write_path=pickle_path)
+        # load the pickle file dataframe
+        f_name = 'Docx_' + d + '.pickle'
+        pkl_df = load_serialized_data(file_path=pickle_path, file_name=f_name)
 
-    # load the mapping file dataframe
-    mapping_df = load_mapping_file(file_path=mapping_file, file_name='DocxMappingFile.csv')
+        # merge the dataframe
+        docx_df = mapping_index.merge(pkl_df)
 
-    # load the pickle file dataframe
-    f_name = 'Docx_' + d + '.pickle'
-    pkl_df = load_serialized_data(file_path=pickle_path, file_name=f_name)
+        # write dataframe to csv file
+        write_dataframe_to_csv(
+            docx_df, write_path=docx_write_path,
+            file_name='MergedDataFrame', file_ext='docx'
+        )
 
-    # merge the dataframe
-    docx_df = mapping_df.merge(pkl_df, how='inner')
+        # write_dataframe_to_csv returns once the file is written, it only has to exist
+        docx_merged_df = 'Docx_MergedDataFrame_' + d + '.csv'
+        if not os.path.exists(os.path.join(docx_write_path, docx_merged_df)):
+            print(f'FileNotFoundError: {docx_merged_df} was not written.')
+            return
 
-    # write dataframe to csv file
-    write_dataframe_to_csv(
-        docx_df, write_path=docx_write_path,
-        file_name='MergedDataFrame', file_ext='docx'
-    )
+        # push the dataset to the linux server via sftp
+        sftp_conn = SftpConnection(root_path=docx_write_path,
+                                       remote_path=claims_insights_remote_path)
+        sftp_conn.connect(filename=docx_merged_df, filepath=docx_write_path)
 
-    # wait util Docx_MergedDataFrame_2019_mm_dd exists
-    docx_merged_df = 'Docx_MergedDataFrame_' + d + '.csv'
-    while os.path.exists(os.path.join(docx_write_path, docx_merged_df)) == False:
-        time.sleep(1)
-    else:
-        print(f'File: {docx_merged_df} exists.')
+    # append the dataset to today's docx partition of the extracted text table
+    create_and_load_hive_table(file_name=docx_merged_df, table_name='personal_umbrella_extracted_text',
+                               database='drw', hdfs_path=hdfs_path if stream else None,
+                               columns=mapping_index.columns + ['raw_text'],
+                               partition={'load_date': d, 'file_format': 'docx'}, stored_as='ORC')
 
-    # push the dataset to the linux server via sftp
-    sftp_conn = SftpConnection(root_path=docx_write_path,
-                                   remote_path=claims_insights_remote_path)
-    sftp_conn.connect(filename=docx_merged_df, filepath=docx_write_path)
+    # the delta's files are loaded, reruns can skip them
+    if incremental:
+        selector.update_watermark(processed_files=parser_factory.completed_files)
 
-    # create a hive table for the docx dataset
-    create_hive_table(table_name='personal_umbrealla_docx_5_8_2019',database='drw')
-    time.sleep(5)
 
-    # load the dataset into hive
-    load_data_into_hive(file_name=docx_merged_df, table_name='personal_umbrealla_docx_5_8_2019')
 
 
 
 
 
+# Pipeline steps #
+####################################################################################################
+# parse_file_ext options of each file ext: processes parsing the files, and for pdf the
+# processes extracting the pages of large files and OCRing the pages without text.
+# Each file is parsed in a sandbox killed after file_timeout seconds or max_rss_mb MB,
+# a limit left out of a file ext's options isn't checked
+FORMAT_LIMITS: dict = {
+    'pdf': {'workers': 4, 'ocr_workers': 2, 'file_timeout': 900, 'max_rss_mb': 4096},
+    'doc': {'workers': 2, 'file_timeout': 300, 'max_rss_mb': 2048},
+    'docx': {'workers': 2, 'file_timeout': 300, 'max_rss_mb': 2048},
+    'rtf': {'workers': 2, 'file_timeout': 300, 'max_rss_mb': 2048},
+    'eml': {'workers': 2, 'file_timeout': 120, 'max_rss_mb': 1024},
+}
+# slowest file exts are parsed first, so the quick ones fill in around them
+PARSE_ORDER: list = ['pdf', 'doc', 'docx', 'rtf', 'eml']
+# number of uploads and hive sessions that can run at once
+IO_SLOTS: dict = {'upload': 2, 'hive': 1}
+
+
+def parse_step(file_ext: str, raw_files: str, incremental: bool = False,
+               parse_options: dict = None) -> (ParserFactory, DeltaSelector):
+    """Parse the file_ext files of raw_files with a ParserFactory of their own"""
+    factory = ParserFactory()
+    selector = None
+    if incremental:
+        files, selector = select_delta_files(raw_files=raw_files, file_ext=file_ext)
+        factory.parse_file_ext(file_path=raw_files, file_ext=file_ext, files=files, **(parse_options or {}))
+    else:
+        factory.parse_file_ext(file_path=raw_files, file_ext=file_ext, **(parse_options or {}))
+    return factory, selector
+
+
+def upload_step(parsed: tuple, file_ext: str, hdfs_path: str = None) -> (str, list):
+    """Merge the parsed text with the file ext's mapping file and stream it to the server"""
+    factory, selector = parsed
+    mapping_index = load_mapping_index(file_path=mapping_file, file_name=file_ext.title() + 'MappingFile.csv')
+    merged_file = file_ext.title() + '_MergedDataFrame_' + d + '.csv.gz'
+    records = ({'files': k, 'raw_text': v} for k, v in factory.file_parser.items())
+    stream_merged_records(records, mapping_index, file_name=merged_file, hdfs_path=hdfs_path)
+    return merged_file, mapping_index.columns + ['raw_text']
+
+
+def load_step(uploaded: tuple, parsed: tuple, file_ext: str, hdfs_path: str = None) -> list:
+    """Replace today's file_ext partition with the uploaded file, then move the watermark"""
+    merged_file, columns = uploaded
+    results = create_and_load_hive_table(file_name=merged_file, table_name='personal_umbrella_extracted_text',
+                                         database='drw', hdfs_path=hdfs_path, columns=columns,
+                                         partition={'load_date': d, 'file_format': file_ext})
+    if any(r.status != 'ok' for r in results):
+        raise RuntimeError(f"RuntimeError: the {file_ext} hive load failed")
+
+    # the delta's files are loaded, reruns can skip them
+    factory, selector = parsed
+    if selector is not None:
+        selector.update_watermark(processed_files=factory.completed_files)
+    if factory.checkpoint is not None:
+        factory.checkpoint.remove()
+    return results
+
+
+def build_pipeline_dag(raw_files: str, file_exts: list, incremental: bool = False,
+                       hdfs_path: str = None, cpu_workers: int = 2, io_workers: int = 4,
+                       format_limits: dict = None, io_slots: dict = None,
+                       checkpoint_dir: str = None, resume: bool = False) -> DagRunner:
+    """
+    Parse -> upload -> load, for each file ext. At most cpu_workers file exts
+    are parsed at once, slowest first, each with its format_limits. The upload
+    and load of a file ext run on the io executor, within io_slots, while the
+    next file exts are parsed. With checkpoint_dir the parse steps checkpoint
+    their progress, and with resume they skip the files done before a crash.
+    """
+    format_limits = FORMAT_LIMITS if format_limits is None else format_limits
+    dag = DagRunner(cpu_workers=cpu_workers, io_workers=io_workers,
+                    slots=IO_SLOTS if io_slots is None else io_slots)
+    order = {file_ext: i for i, file_ext in enumerate(PARSE_ORDER)}
+    for file_ext in sorted(file_exts, key=lambda ext: order.get(ext, len(order))):
+        parse, upload = 'parse_' + file_ext, 'upload_' + file_ext
+        # a parse step still running at the deadline stops after its current files
+        parse_options = dict(format_limits.get(file_ext) or {}, stop_event=dag.cancel_event)
+        if checkpoint_dir is not None:
+            parse_options.update(checkpoint_dir=checkpoint_dir, resume=resume)
+        dag.add(parse, parse_step, file_ext, raw_files, incremental, parse_options, executor='cpu')
+        dag.add(upload, upload_step, dag.output(parse), file_ext, hdfs_path, depends_on=[parse],
+                slot='upload')
+        dag.add('load_' + file_ext, load_step, dag.output(upload), dag.output(parse), file_ext, hdfs_path,
+                depends_on=[upload], slot='hive')
+    return dag
+
+
+def run_pipeline(raw_files: str, file_exts: list = None, incremental: bool = False,
+                 hdfs_path: str = None, deadline_hours: float = None, **dag_options) -> dict:
+    """
+    Run every file ext of raw_files through parse, merge, upload and load.
+    :param file_exts: defaults to every ParserFactory.file_extensions
+    :param deadline_hours: the steps that haven't started by then are cancelled and
+        the running parse steps stop after their current files, their files stay
+        behind the watermark for the next run. A running upload or hive load
+        can't be interrupted, the process exits once it finishes
+    :param dag_options: cpu_workers, io_workers, format_limits, io_slots, checkpoint_dir
+        and resume of build_pipeline_dag
+    :return: the TaskResult of every step
+    """
+    file_exts = ParserFactory.file_extensions if file_exts is None else file_exts
+    dag = build_pipeline_dag(raw_files, file_exts, incremental=incremental, hdfs_path=hdfs_path, **dag_options)
+    results = dag.run(deadline=deadline_hours * 3600 if deadline_hours is not None else None)
+    failed = [r for r in results.values() if r.status != 'ok']
+    for result in failed:
+        print(f"PipelineError: {result.name} {result.status}: {result.error}")
+    print(f"Pipeline: {len(results) - len(failed)}/{len(results)} steps finished")
+    return results
 
 
 def run_eml_parser(file_path: str, is_historical=False):
-    """Run the eml parser"""
-    if is_historical:
-        pass
-
+    """Run the eml parser: the whole of file_path if is_historical, else yesterday's delta"""
+    return run_pipeline(raw_files=file_path, file_exts=['eml'], incremental=not is_historical)
 
 
 def main():
-    run_docx_parser(raw_files=personal_umbrella)
+    # the daily delta of every file ext, within a 6 hour window. A rerun
+    # after a crash picks up from the last checkpoint of the day
+    run_pipeline(raw_files=personal_umbrella, incremental=True, deadline_hours=6,
+                 checkpoint_dir=pickle_path, resume=True)
 
 if __name__ == '__main__':
     main()
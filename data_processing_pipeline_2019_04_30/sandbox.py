@@ -0,0 +1,196 @@
+"""
+sandbox
+~~~~~~~
+Supervised worker processes for the parsers.
+
+A SandboxedExtractor parses one file at a time in a worker process and
+watches it from the parent:
+    - wall clock: a file that takes longer than timeout seconds
+    - memory: a worker whose RSS, with its page and OCR processes, grows
+      past max_rss_mb, measured with psutil
+Either way the worker and its children are killed, the file is returned
+with the reason, and the next file starts a new worker. A limit that is
+None isn't checked. Without psutil the worker's address space is capped
+with resource.setrlimit instead, where the platform has it.
+
+# Example #
+with SandboxedExtractor('pdf', raw_files, timeout=300, max_rss_mb=2048) as sandbox:
+    results, reason = sandbox.extract(current_file)
+"""
+import time
+import multiprocessing
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on windows
+
+# the workers are started from the supervising threads, and forking a threaded
+# process can deadlock the child on a lock held by another thread
+SPAWN = multiprocessing.get_context('spawn')
+
+
+def limit_address_space(max_rss_mb: int):
+    """Cap the worker's address space when its RSS can't be watched"""
+    if psutil is None and resource is not None and max_rss_mb is not None:
+        limit = max_rss_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def sandbox_worker(conn, file_ext: str, file_path: str, cache=None, options: dict = None,
+                   max_rss_mb: int = None):
+    """Parse the files received on conn and send back the results of each one.
+    NOTE:
+        Runs inside the worker process, so it has to be a module level function.
+    """
+    from data_processing_pipeline_2019_04_30.data_preprocessing import (build_parser, extract_file,
+                                                                        take_parser_results)
+    limit_address_space(max_rss_mb)
+    parser = build_parser(file_ext=file_ext, file_path=file_path)
+    for option, value in (options or {}).items():
+        setattr(parser, option, value)
+    try:
+        while True:
+            try:
+                current_file = conn.recv()
+            except EOFError:
+                break   # the parent is gone
+            if current_file is None:
+                break
+            extract_file(parser, current_file, cache)
+            conn.send(take_parser_results(parser, cache))
+    finally:
+        if hasattr(parser, 'shutdown_page_pool'):
+            parser.shutdown_page_pool()
+        if cache is not None:
+            cache.close()
+        conn.close()
+
+
+class SandboxedExtractor(object):
+    """Parse files in a worker process with per-file time and memory limits"""
+
+    def __init__(self, file_ext: str, file_path: str, cache=None, options: dict = None,
+                 timeout: float = None, max_rss_mb: int = None, poll_interval: float = 0.5):
+        self.file_ext = file_ext
+        self.file_path = file_path
+        self.cache = cache
+        self.options = options
+        self.timeout = timeout              # seconds a single file may take, None for no limit
+        self.max_rss_mb = max_rss_mb        # MB of resident memory the worker may use, None for no limit
+        self.poll_interval = poll_interval  # seconds between the checks of the worker
+        self.process: SPAWN.Process = None
+        self.conn = None
+
+        # sandbox counters
+        self.timeout_counter: int = 0   # count of the files killed for taking too long
+        self.memory_counter: int = 0    # count of the files killed for using too much memory
+        self.crash_counter: int = 0     # count of the files whose worker died
+        self.worker_counter: int = 0    # count of the workers started
+
+    def start(self):
+        """Start a new worker process. It isn't a daemon, so the pdf parser can
+        start its page and OCR processes. kill() and close() stop it instead.
+        """
+        self.conn, child_conn = SPAWN.Pipe()
+        self.process = SPAWN.Process(
+            target=sandbox_worker, name=f'sandbox_{self.file_ext}',
+            args=(child_conn, self.file_ext, self.file_path, self.cache, self.options, self.max_rss_mb))
+        self.process.start()
+        child_conn.close()
+        self.worker_counter += 1
+
+    def rss_mb(self) -> float:
+        """Resident memory of the worker and its children, 0 without psutil"""
+        if psutil is None:
+            return 0
+        try:
+            worker = psutil.Process(self.process.pid)
+            processes = [worker] + worker.children(recursive=True)
+            return sum(p.memory_info().rss for p in processes) / (1024 * 1024)
+        except psutil.Error:
+            return 0
+
+    def kill(self):
+        """Kill the worker and the page and OCR processes it started"""
+        if self.process is None:
+            return
+        children = []
+        if psutil is not None:
+            try:
+                children = psutil.Process(self.process.pid).children(recursive=True)
+            except psutil.Error:
+                pass
+        self.process.kill()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def extract(self, current_file: str) -> (dict, str):
+        """Parse current_file in the worker.
+        :return: (results, None) where results are those of take_parser_results,
+            or (None, reason) when the worker was killed or died
+        """
+        if self.process is None:
+            self.start()
+        start_time = time.time()
+        try:
+            self.conn.send(current_file)
+            while True:
+                if self.conn.poll(self.poll_interval):
+                    return self.conn.recv(), None
+                if not self.process.is_alive():
+                    raise EOFError("the worker exited")
+                if self.timeout is not None and time.time() - start_time > self.timeout:
+                    self.timeout_counter += 1
+                    reason = f"timeout: took more than {self.timeout}s"
+                    break
+                if self.max_rss_mb is not None:
+                    rss = self.rss_mb()
+                    if rss > self.max_rss_mb:
+                        self.memory_counter += 1
+                        reason = f"memory: rss {rss:.0f}MB over the {self.max_rss_mb}MB limit"
+                        break
+        except (EOFError, OSError) as e:
+            # the worker died, e.g. a segfault in a native library or a MemoryError
+            # at the address space limit
+            self.crash_counter += 1
+            self.process.join(timeout=self.poll_interval)
+            if self.process.exitcode is not None:
+                reason = f"crash: worker exited with code {self.process.exitcode}"
+            else:
+                reason = f"crash: {e.__class__.__name__}: {e}"
+        # the next file starts a new worker
+        self.kill()
+        return None, reason
+
+    def close(self):
+        """Stop the worker once it finishes its current file"""
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=self.timeout)
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+            self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
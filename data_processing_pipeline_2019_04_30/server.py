@@ -3,100 +3,203 @@ server
 ~~~~~~
 """
 import os
-import socket
-import socks
+import time
+import queue
+import hashlib
 import paramiko
+from concurrent.futures import ThreadPoolExecutor
 from data_processing_pipeline_2019_04_30.configuration import (
     host, port, username, password, eml_write_path,
     rtf_write_path, docx_write_path, doc_write_path,
     pdf_write_path
 )
+from data_processing_pipeline_2019_04_30.connection_pool import ConnectionPool, connection_pool
+
+# size of the local reads and pipelined sftp writes
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
 
 # Sftp setup #
 ####################################################################################################
 class SftpConnection(object):
-    """Transfer data via sftp"""
+    """Transfer data via sftp over a transport of the shared connection pool"""
 
-    def __init__(self, root_path: str, remote_path: str):
+    def __init__(self, root_path: str, remote_path: str, pool: ConnectionPool = None):
         self.username = username
         self.password = password
         self.root_path = root_path
         self.remote_path = remote_path
         self.host = host
         self.port = int(port)
+        self.pool = pool or connection_pool
 
-        self.sock: socks.socksocket = socks.socksocket()
-        self.sftp: paramiko.Transport = None
-        self.client: paramiko.SFTPClient.from_transport = None
-        self.is_connected: bool = False
+        self.client: paramiko.SFTPClient = None
         self.sftp_connected: bool = False
         self.client_connected: bool = False
 
+    def open_client(self) -> paramiko.SFTPClient:
+        """Return the sftp client, opening a new session if the last one was closed"""
+        channel = self.client.get_channel() if self.client is not None else None
+        if channel is None or channel.closed or not channel.get_transport().is_active():
+            self.client = self.pool.open_sftp(self.host, self.port, self.username, self.password)
+            self.sftp_connected = True
+            self.client_connected = True
+        return self.client
+
+    def close(self):
+        """close the sftp session, the transport stays in the pool"""
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.client_connected = False
 
     def connect(self, filename: str, filepath: str):
-        """connect to the remote server"""
+        """connect to the remote server, transfer filename and close the sftp session"""
         try:
-            # set proxy connection values
-            self.sock.set_proxy(
-                proxy_type=None,
-                addr=self.host,
-                port=self.port,
-                username=self.username,
-                password=self.password
-            )
-            # connect the socket
-            self.sock.connect((self.host, self.port))
-            if socket.gethostname():
-                self.is_connected = True
-                print(f"Sftp connection to : {self.host} successful")
-                # create transport
-                self.sftp = paramiko.Transport(self.sock)
-                try:
-                    self.sftp.connect(
-                        username=self.username,
-                        password=self.password
-                    )
-                    # check if connection is live
-                    if self.sftp.is_alive():
-                        print("Transport is live")
-                        self.sftp_connected = True
-
-                        # create client and connect
-                        try:
-                            self.client = paramiko.SFTPClient.from_transport(self.sftp)
-                            print(f"Client is: {self.client}")
-                            self.client_connected = True
-                            os.chdir(self.root_path)
-                            self.transport_payload(filename=filename, filepath=filepath)
-                            self.client.close()
-                            print("closing client")
-
-                            self.sftp.close()
-                            print("closing sftp")
-
-                            self.sock.close()
-                            print("closing socket")
-
-                        except:
-                            print("A client error occurred")
-                except:
-                    print("An sftp error occurred")
-        except:
-            print("A socket error occurred")
+            self.open_client()
+        except Exception as e:
+            print(f"An sftp error occurred: {e}")
+            return
+        try:
+            self.transport_payload(filename=filename, filepath=filepath)
+        finally:
+            self.close()
 
     def transport_payload(self, filename: str, filepath: str):
-        """Transport data to the remote server"""
+        """Transport data to the remote server, overwriting the remote file"""
         if self.sftp_connected and self.client_connected:
+            try:
+                result = self.upload_file(self.client, os.path.join(filepath, filename), verify=False)
+                print(f"Successfully loaded {filename} to {result['remote_file']}")
+            except (OSError, paramiko.SSHException) as e:
+                print(f"An error occurred while transporting payload: {e}")
+
+    def open_remote_file(self, file_name: str) -> paramiko.SFTPFile:
+        """Open remote_path/file_name for pipelined writing, e.g. for GzipCsvSink.
+        The file is written on the connection's sftp session, close() it once the file is closed.
+        """
+        remote_file = self.open_client().open(self.remote_path + '/' + file_name, 'wb')
+        remote_file.set_pipelined(True)
+        return remote_file
+
+    def remote_file(self, local_file: str) -> str:
+        return self.remote_path + '/' + os.path.basename(local_file)
+
+    def upload_file(self, client: paramiko.SFTPClient, local_file: str, verify: bool = False,
+                    progress=None) -> dict:
+        """Upload local_file with pipelined writes of UPLOAD_BLOCK_SIZE bytes.
+        With verify, a remote file whose md5 matches the start of local_file is
+        resumed from its size, or skipped when it is complete. Otherwise the
+        remote file is overwritten, e.g. a csv regenerated by a rerun.
+        """
+        start_time = time.time()
+        remote_file = self.remote_file(local_file)
+        size = os.path.getsize(local_file)
+        offset = 0
+        if verify:
+            try:
+                offset = client.stat(remote_file).st_size
+            except FileNotFoundError:
+                offset = 0
+            if offset > size or (offset and not same_prefix(client, local_file, remote_file, offset)):
+                offset = 0  # the remote file is not a prefix of the local file, start over
+        status = 'skipped' if offset and offset == size else 'resumed' if offset else 'uploaded'
+
+        sent = 0
+        if status != 'skipped':
+            with open(local_file, 'rb') as f, client.open(remote_file, 'r+b' if offset else 'wb') as rf:
+                # don't wait for the server to acknowledge every write
+                rf.set_pipelined(True)
+                f.seek(offset)
+                rf.seek(offset)
+                for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+                    rf.write(block)
+                    sent += len(block)
+                    if progress is not None:
+                        progress(local_file, offset + sent, size)
+            remote_size = client.stat(remote_file).st_size
+            if remote_size != size:
+                raise IOError(f"IOError: {remote_file} is {remote_size} bytes, expected {size}")
+        return {'file': local_file, 'remote_file': remote_file, 'status': status,
+                'bytes': sent, 'seconds': time.time() - start_time}
+
+    def upload_files(self, files: list, filepath: str, channels: int = 4, verify: bool = False,
+                     progress=None) -> list:
+        """Upload files from filepath to remote_path over channels concurrent sftp sessions.
+        Each session runs on a pooled transport of its own, so the uploads don't
+        share one tcp connection and cipher stream.
+        With verify, files already on the remote server are resumed or skipped,
+        otherwise they are overwritten, see upload_file.
+        Returns a result dict per file, with the error of the files that failed.
+        """
+        pending = queue.Queue()
+        for f in sorted(files, key=lambda f: os.path.getsize(os.path.join(filepath, f)), reverse=True):
+            pending.put(os.path.join(filepath, f))   # largest first, so the channels finish together
+
+        results = []
+        start_time = time.time()
+
+        def upload_worker(transport_index: int):
+            try:
+                client = self.pool.open_sftp(self.host, self.port, self.username, self.password,
+                                             transport_index=transport_index)
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                print(f"SftpError: could not open an sftp channel: {e}")
+                return
             try:
                 while True:
-                    os.chdir(filepath)
-                    payload = filename
-                    destination = self.remote_path + '/' + filename
-                    self.client.put(
-                        localpath=payload,
-                        remotepath=destination
-                    )
-                    print(f"Successfully loaded {filename} to {destination}")
-                    break
-            except:
-                print("An error occurred while transporting payload")
+                    try:
+                        local_file = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        result = self.upload_file(client, local_file, verify=verify, progress=progress)
+                        print(f"{result['status'].title()} {os.path.basename(local_file)}: "
+                              f"{result['bytes'] / 1024 ** 2:.1f}MB in {result['seconds']:.1f}s")
+                    except (OSError, EOFError, paramiko.SSHException) as e:
+                        result = {'file': local_file, 'remote_file': self.remote_file(local_file),
+                                  'status': 'error', 'error': str(e), 'bytes': 0, 'seconds': 0.0}
+                        print(f"SftpError: could not upload {os.path.basename(local_file)}: {e}")
+                    results.append(result)
+            finally:
+                client.close()
+
+        with ThreadPoolExecutor(max_workers=channels) as executor:
+            for future in [executor.submit(upload_worker, i) for i in range(max(1, channels))]:
+                future.result()
+        while not pending.empty():
+            # no channel could be opened for these files
+            local_file = pending.get_nowait()
+            results.append({'file': local_file, 'remote_file': self.remote_file(local_file),
+                            'status': 'error', 'error': 'no sftp channel', 'bytes': 0, 'seconds': 0.0})
+
+        seconds = time.time() - start_time
+        total = sum(r['bytes'] for r in results)
+        print(f"Uploaded {len(results)} files, {total / 1024 ** 2:.1f}MB in {seconds:.1f}s "
+              f"({total / 1024 ** 2 / max(seconds, 1e-9):.1f}MB/s)")
+        return results
+
+
+def file_md5(f, length: int) -> str:
+    """md5 of the first length bytes of an open file"""
+    md5 = hashlib.md5()
+    while length > 0:
+        block = f.read(min(UPLOAD_BLOCK_SIZE, length))
+        if not block:
+            break
+        md5.update(block)
+        length -= len(block)
+    return md5.hexdigest()
+
+
+def same_prefix(client: paramiko.SFTPClient, local_file: str, remote_file: str, length: int) -> bool:
+    """check the first length bytes of remote_file against local_file"""
+    with open(local_file, 'rb') as f:
+        local_md5 = file_md5(f, length)
+    with client.open(remote_file, 'rb') as rf:
+        try:
+            # servers with the check-file extension hash the file remotely
+            return rf.check('md5', 0, length).hex() == local_md5
+        except IOError:
+            rf.prefetch(length)
+            return file_md5(rf, length) == local_md5
@@ -0,0 +1,79 @@
+"""
+text_normalizer
+~~~~~~~~~~~~~~~
+Single pass text normalization shared by every parser.
+
+normalize_text replaces the chains of SPACES/BARS/NEWLINE/TABS
+substitutions, punctuation filters and split/join calls each parser
+used to run over the whole document:
+    1. one str.translate with a precompiled table: punctuation is
+       deleted and every other whitespace character becomes a space
+    2. str.lower
+    3. one regex that collapses runs of spaces to a single space
+
+Run this module to benchmark normalize_text against the old chains.
+"""
+import re
+import string
+import timeit
+
+# punctuation is deleted, tabs, newlines and all other whitespace become spaces
+NORMALIZE_TABLE = str.maketrans(
+    {**{ch: None for ch in string.punctuation},
+     **{ch: ' ' for ch in '\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f\x85\xa0\u1680\u2000\u2001\u2002\u2003'
+                          '\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'}}
+)
+# only spaces are left after the translation, which is much cheaper to match than \s+
+SPACE_RUNS = re.compile(r'  +')
+
+
+def normalize_text(text: str, skip: int = 0) -> str:
+    """Normalize extracted text: remove punctuation, lower case and
+    collapse whitespace. skip drops that many characters from the
+    start of the raw text, e.g. the header of a converted csv file.
+    """
+    if skip:
+        text = text[skip:]
+    return SPACE_RUNS.sub(' ', text.translate(NORMALIZE_TABLE).lower()).strip()
+
+
+# Benchmark #
+####################################################################################################
+def legacy_txt_chain(text: str) -> str:
+    """TxtParser/DocParser normalization before normalize_text"""
+    from data_processing_pipeline_2019_04_30.file_encoders import SPACES, BARS, NEWLINE, TABS
+    text = SPACES.sub(" ", text)
+    text = text[6:]
+    text = BARS.sub("", text)
+    text = NEWLINE.sub(" ", text)
+    text = TABS.sub(" ", text)
+    return text.translate(str.maketrans('', '', string.punctuation)).lower()
+
+
+def legacy_rtf_chain(text: str) -> str:
+    """RtfParser normalization before normalize_text"""
+    from data_processing_pipeline_2019_04_30.file_encoders import SPACES, PUNCTUATION
+    result = ''.join(ch for ch in text if ch not in PUNCTUATION)
+    return SPACES.sub(" ", result).lower()
+
+
+def benchmark(size_mb: int = 50, number: int = 3) -> dict:
+    """Time normalize_text against the legacy chains on a size_mb document"""
+    line = "Claim #4521 | Policy: PU-99, (Umbrella)\tinsured's \"home\"; loss-date 05/02/2019.\r\n"
+    text = line * (size_mb * 1024 * 1024 // len(line))
+    timings = {
+        'normalize_text': timeit.timeit(lambda: normalize_text(text, skip=6), number=number) / number,
+        'legacy_txt_chain': timeit.timeit(lambda: legacy_txt_chain(text), number=number) / number,
+        'legacy_rtf_chain': timeit.timeit(lambda: legacy_rtf_chain(text), number=number) / number,
+    }
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.3f}s for {size_mb}MB ({size_mb / seconds:.1f} MB/s)")
+    return timings
+
+
+def main():
+    benchmark()
+
+
+if __name__ == '__main__':
+    main()
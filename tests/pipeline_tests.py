@@ -2,17 +2,22 @@
 tests
 ~~~~~
 """
+import io
 import os
 import sys
 import random
+import tempfile
 import unittest
+import paramiko
+import pandas as pd
 from pprint import pprint
 from unittest.mock import patch, Mock
 from test import support, regrtest
 from functools import wraps, reduce, partial
+from types import SimpleNamespace
 from data_processing_pipeline_2019_04_30.data_preprocessing import (
     PdfParser, EmlParser, RtfParser, DocParser, DocxParser, TxtParser,
-    ParserFactory, FileGenerator
+    ParserFactory, FileGenerator, DirectoryScanner, chunk_files, merge_parser_results, PdfPage
 )
 from data_processing_pipeline_2019_04_30.configuration import (
     personal_umbrella, global_business_data, sa, pickle_path,
@@ -21,6 +26,21 @@ rtf_write_path, docx_write_path, doc_test_write_path, doc_write_path,
 pdf_write_path, r_path, r_script_three, r_script_two, r_executable,
 r_script_one, claims_insights_remote_path, pdf_pickle_path
 )
+from data_processing_pipeline_2019_04_30.mapping_index import MappingIndex
+from data_processing_pipeline_2019_04_30.output_sinks import (GzipCsvSink, JsonLinesSink, iter_json_lines, ParquetSink,
+                                                              load_parquet_output, iter_parquet_output, pq)
+from data_processing_pipeline_2019_04_30.extraction_cache import ExtractionCache
+from data_processing_pipeline_2019_04_30.text_normalizer import normalize_text
+from data_processing_pipeline_2019_04_30.rtf_decoder import RtfDecoder
+from data_processing_pipeline_2019_04_30.ole_doc import CompoundFile, clean_doc_text
+from data_processing_pipeline_2019_04_30.hive import (plan_put_batches, parse_hive_output, parse_hdfs_listing,
+                                                      HDFS)
+from data_processing_pipeline_2019_04_30.server import SftpConnection
+from data_processing_pipeline_2019_04_30.connection_pool import ConnectionPool
+from data_processing_pipeline_2019_04_30.dag_runner import DagRunner
+from data_processing_pipeline_2019_04_30.checkpoint import RunCheckpoint
+from data_processing_pipeline_2019_04_30.sandbox import SandboxedExtractor
+from data_processing_pipeline_2019_04_30.metadata import LoadMetaData, DeltaSelector
 
 
 class TestDataPaths(unittest.TestCase):
@@ -245,5 +265,871 @@ class TestSampleSet(unittest.TestCase):
 
 
 
+class TestParallelParsing(unittest.TestCase):
+    """Test the helpers of the process pool execution mode"""
+
+    def test_chunk_files(self):
+        """check that chunks keep every file and respect the chunk size"""
+        chunks = list(chunk_files(iter(range(10)), 4))
+        self.assertEqual(chunks, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_merge_parser_results(self):
+        """check that chunk results are merged into a single parser"""
+        parser = DocxParser(personal_umbrella)
+        for i in range(2):
+            merge_parser_results(parser, {
+                'mapping_dict': {f'file_{i}.docx': 'text'},
+                'file_counter': 1,
+                'error_file_counter': 1,
+                'error_files': [f'error_{i}.docx'],
+            })
+        self.assertEqual(len(parser.mapping_dict), 2)
+        self.assertEqual(parser.file_counter, 2)
+        self.assertEqual(parser.error_file_counter, 2)
+        self.assertEqual(parser.error_files, ['error_0.docx', 'error_1.docx'])
+
+
+class TestDirectoryScanner(unittest.TestCase):
+    """Test the single pass directory scanner"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sub_dir = os.path.join(self.tmp_dir.name, 'sub')
+        os.mkdir(sub_dir)
+        for name in ['a.docx', 'b.docx', 'c.pdf', '.hidden', 'no_ext']:
+            open(os.path.join(self.tmp_dir.name, name), 'w').close()
+        open(os.path.join(sub_dir, 'd.docx'), 'w').close()
+
+    def test_buckets(self):
+        """check that files are bucketed by extension"""
+        scanner = DirectoryScanner(self.tmp_dir.name)
+        self.assertEqual(len(scanner.entries('docx')), 2)
+        self.assertEqual(len(scanner.entries('pdf')), 1)
+        self.assertEqual(scanner.file_types(), {'.docx', '.pdf'})
+
+    def test_recursive(self):
+        """check that sub directories are only walked when recursive"""
+        scanner = DirectoryScanner(self.tmp_dir.name, recursive=True)
+        self.assertEqual(len(scanner.entries('docx')), 3)
+
+    def test_concurrent_scan(self):
+        """check that parse steps sharing a scanner only see the complete listing"""
+        from concurrent.futures import ThreadPoolExecutor
+        for i in range(50):
+            open(os.path.join(self.tmp_dir.name, f'claim_{i}.docx'), 'w').close()
+        scanner = DirectoryScanner(self.tmp_dir.name, recursive=True)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            counts = list(executor.map(lambda _: len(scanner.entries('docx')), range(8)))
+        self.assertEqual(counts, [53] * 8)
+
+    def test_file_generator_matches_scanner(self):
+        """check that the FileGenerator yields the same files with and without a scanner"""
+        scanner = DirectoryScanner(self.tmp_dir.name)
+        self.assertEqual(sorted(FileGenerator(self.tmp_dir.name, 'docx')),
+                         sorted(FileGenerator(self.tmp_dir.name, 'docx', scanner=scanner)))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestMappingIndex(unittest.TestCase):
+    """Test the mapping file index"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp_dir.name, 'MappingFile.csv'), 'w') as f:
+            f.write('files,claim_info\n'
+                    'a.docx,1,claim one\n'
+                    'b.docx,2\n'
+                    'b.docx,3\n')
+        self.index = MappingIndex().load(self.tmp_dir.name, 'MappingFile.csv')
+
+    def test_lookup(self):
+        """check that rows are split on the first comma only"""
+        self.assertEqual(self.index.lookup('a.docx'), ['1,claim one'])
+        self.assertEqual(self.index.lookup('b.docx'), ['2', '3'])
+        self.assertEqual(self.index.lookup('c.docx'), [])
+
+    def test_join(self):
+        """check the inner join of streamed records"""
+        records = [{'files': 'a.docx', 'raw_text': 'text a'},
+                   {'files': 'c.docx', 'raw_text': 'text c'}]
+        self.assertEqual(list(self.index.join(records)),
+                         [{'files': 'a.docx', 'claim_info': '1,claim one', 'raw_text': 'text a'}])
+
+    def test_merge(self):
+        """check that merge matches the keyless DataFrame merge"""
+        import pandas as pd
+        df = pd.DataFrame({'files': ['a.docx', 'b.docx', 'c.docx'], 'raw_text': ['a', 'b', 'c']})
+        merged = self.index.merge(df)
+        self.assertEqual(list(merged.columns), ['files', 'claim_info', 'raw_text'])
+        self.assertEqual(len(merged), 3)
+
+    def test_join_to_gzip_csv(self):
+        """check that joined records stream to a gzip csv file object"""
+        import csv
+        import gzip
+        csv_file = os.path.join(self.tmp_dir.name, 'merged.csv.gz')
+        records = [{'files': 'a.docx', 'raw_text': 'text a'}]
+        with GzipCsvSink(open(csv_file, 'wb'), columns=self.index.columns + ['raw_text']) as sink:
+            for record in self.index.join(records):
+                sink.write_record(record)
+        with gzip.open(csv_file, 'rt', newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows, [['files', 'claim_info', 'raw_text'], ['a.docx', '1,claim one', 'text a']])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestOutputSinks(unittest.TestCase):
+    """Test the streaming outputs of the parsers"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def test_json_lines_rerun(self):
+        """check that a rerun overwrites the output and only a resumed run appends to it"""
+        for append in (False, False, True):
+            with JsonLinesSink(self.tmp_dir.name, 'Docx_test.jsonl', append=append) as sink:
+                sink.write({'a.docx': 'claim a'})
+        records = list(iter_json_lines(self.tmp_dir.name, 'Docx_test.jsonl'))
+        self.assertEqual(records, [{'files': 'a.docx', 'raw_text': 'claim a'}] * 2)
+
+    @unittest.skipIf(pq is None, "the Parquet output requires pyarrow")
+    def test_parquet_round_trip(self):
+        """check the row groups, column projection and lazy loading of a Parquet output"""
+        mapping = {f'claim_{i}.docx': f'claim text {i}' for i in range(5)}
+        with ParquetSink(self.tmp_dir.name, 'Docx_test.parquet', row_group_size=2) as sink:
+            sink.write(mapping)
+        self.assertEqual(pq.ParquetFile(os.path.join(self.tmp_dir.name, 'Docx_test.parquet')).num_row_groups, 3)
+        df = load_parquet_output(self.tmp_dir.name, 'Docx_test.parquet')
+        self.assertEqual(dict(zip(df['files'], df['raw_text'])), mapping)
+        files = load_parquet_output(self.tmp_dir.name, 'Docx_test.parquet', columns=['files'])
+        self.assertEqual(list(files.columns), ['files'])
+        records = list(iter_parquet_output(self.tmp_dir.name, 'Docx_test.parquet', batch_size=2))
+        self.assertEqual(records, [{'files': k, 'raw_text': v} for k, v in mapping.items()])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class CountingParser(object):
+    """Parser that counts the files it really parses"""
+    parser_version: str = '1.0'
+
+    def __init__(self, suffix: str = ''):
+        self.mapping_dict: dict = {}
+        self.file_counter: int = 0
+        self.parse_counter: int = 0
+        self.error_files: list = []
+        self.suffix = suffix    # changes the output, like PdfParser's OCR
+        self.page_error = False     # record an error but return the text, like a bad pdf page
+
+    def output_options(self) -> dict:
+        return {'suffix': self.suffix}
+
+    def extract_text(self, current_file):
+        self.parse_counter += 1
+        with open(current_file) as f:
+            text = f.read() + self.suffix
+        if self.page_error:
+            self.error_files.append(os.path.basename(current_file))
+        self.mapping_dict[os.path.basename(current_file)] = text
+        self.file_counter += 1
+        return {os.path.basename(current_file): text}
+
+
+class TestExtractionCache(unittest.TestCase):
+    """Test the persistent extraction cache"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for i in range(3):
+            self.files.append(os.path.join(self.tmp_dir.name, f'claim_{i}.txt'))
+            with open(self.files[-1], 'w') as f:
+                f.write(f'claim {i} ' * 100)
+        self.cache = ExtractionCache(self.tmp_dir.name)
+
+    def test_hit_and_miss(self):
+        """check that a file is only parsed the first time"""
+        parser = CountingParser()
+        first = self.cache.extract_text(parser, self.files[0])
+        second = self.cache.extract_text(parser, self.files[0])
+        self.assertEqual(first, second)
+        self.assertEqual((parser.parse_counter, self.cache.misses, self.cache.hits), (1, 1, 1))
+
+    def test_version_and_options(self):
+        """check that a new parser version or output option misses the cache"""
+        self.cache.extract_text(CountingParser(), self.files[0])
+        bumped = CountingParser()
+        bumped.parser_version = '1.1'
+        self.cache.extract_text(bumped, self.files[0])
+        ocr = CountingParser(suffix=' ocr')
+        result = self.cache.extract_text(ocr, self.files[0])
+        self.assertEqual((bumped.parse_counter, ocr.parse_counter), (1, 1))
+        self.assertTrue(result['claim_0.txt'].endswith(' ocr'))
+
+    def test_errors_not_cached(self):
+        """check that a file whose parse recorded errors is parsed and reported again"""
+        parser = CountingParser()
+        parser.page_error = True
+        self.cache.extract_text(parser, self.files[0])
+        self.cache.extract_text(parser, self.files[0])
+        self.assertEqual((parser.parse_counter, self.cache.hits), (2, 0))
+        self.assertEqual(parser.error_files, ['claim_0.txt'] * 2)
+
+    def test_pdf_hit(self):
+        """check that a pdf cache hit restores its pages and page routes"""
+        pdf_file = os.path.join(self.tmp_dir.name, 'claim.pdf')
+        write_pdf(pdf_file, ['Claim page one with a text layer', ''])
+        parser = PdfParser(self.tmp_dir.name)
+        first = self.cache.extract_text(parser, pdf_file)
+        second = self.cache.extract_text(parser, pdf_file)
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual((parser.text_page_counter, parser.empty_page_counter), (2, 2))
+        self.assertEqual(parser.pdf_content_by_page[0], parser.pdf_content_by_page[1])
+
+    def test_eviction(self):
+        """check that the least recently used entries are evicted"""
+        parser = CountingParser()
+        self.cache.extract_text(parser, self.files[0])
+        self.cache.max_bytes = self.cache.total_bytes * 2
+        self.cache.extract_text(parser, self.files[1])
+        self.cache.extract_text(parser, self.files[0])     # claim_1 is now the oldest
+        self.cache.extract_text(parser, self.files[2])
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertIsNone(self.cache.get(self.cache.cache_key(parser, self.files[1])))
+        self.assertIsNotNone(self.cache.get(self.cache.cache_key(parser, self.files[2])))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+
+class TestTextNormalizer(unittest.TestCase):
+    """Test the shared text normalizer"""
+
+    def test_normalize_text(self):
+        """check punctuation, case and whitespace handling"""
+        self.assertEqual(normalize_text("Claim #4521 |\tPolicy:\r\n  PU-99 (Umbrella)\u00a0"),
+                         "claim 4521 policy pu99 umbrella")
+
+    def test_skip(self):
+        """check that skip drops the start of the raw text"""
+        self.assertEqual(normalize_text('"x"\n"Some Text"', skip=4), "some text")
+
+
+class TestRtfDecoder(unittest.TestCase):
+    """Test the streaming rtf decoder"""
+
+    rtf = (rb"{\rtf1\ansi\ansicpg1251{\fonttbl{\f0 Arial;}}{\*\generator x}"
+           rb"\pard Hello \'cf\'f0\'e8 world\par{\pict\bin3 }{}}\u1046?x \{ok\}}")
+
+    def test_decode(self):
+        """check code page bytes, unicode characters and skipped destinations"""
+        self.assertEqual(RtfDecoder().feed(self.rtf, final=True), "Hello \u041f\u0440\u0438 world\n\u0416x {ok}")
+
+    def test_chunk_boundaries(self):
+        """check that the text does not depend on where the chunks are split"""
+        expected = RtfDecoder().feed(self.rtf, final=True)
+        for chunk_size in (1, 2, 3, 7):
+            decoder = RtfDecoder()
+            text = ''.join(decoder.feed(self.rtf[i:i + chunk_size]) for i in range(0, len(self.rtf), chunk_size))
+            self.assertEqual(text + decoder.close(), expected)
+
+
+class TestDocxStreaming(unittest.TestCase):
+    """Test the streaming docx extraction"""
+
+    def setUp(self):
+        import zipfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.docx_file = os.path.join(self.tmp_dir.name, 'sample.docx')
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        with zipfile.ZipFile(self.docx_file, 'w') as document:
+            document.writestr('word/document.xml',
+                              f'<w:document {w}><w:body><w:p><w:r><w:t>Claim</w:t></w:r>'
+                              f'<w:r><w:t>Text.</w:t></w:r></w:p><w:tbl><w:tr><w:tc><w:p><w:r>'
+                              f'<w:t>Cell</w:t></w:r></w:p></w:tc></w:tr></w:tbl></w:body></w:document>')
+            document.writestr('word/header1.xml', f'<w:hdr {w}><w:p><w:r><w:t>Header</w:t></w:r></w:p></w:hdr>')
+
+    def test_body(self):
+        """check that only the body is extracted by default"""
+        result = DocxParser(self.tmp_dir.name).extract_text(self.docx_file)
+        self.assertEqual(result, {'sample.docx': 'claim text cell'})
+
+    def test_extra_parts(self):
+        """check that the headers are extracted after the body"""
+        result = DocxParser(self.tmp_dir.name, extra_parts=('header',)).extract_text(self.docx_file)
+        self.assertEqual(result, {'sample.docx': 'claim text cell header'})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestOleDoc(unittest.TestCase):
+    """Test the native .doc extraction"""
+
+    def test_clean_doc_text(self):
+        """check that field codes are dropped and their results kept"""
+        text = 'See \x13 HYPERLINK "http://x" \x14the \x13 PAGE \x145\x15 link\x15\x07cell\r'
+        self.assertEqual(clean_doc_text(text), 'See the 5 link cell ')
+
+    def test_not_a_compound_file(self):
+        """check that a file without the cfb signature is rejected"""
+        with self.assertRaises(ValueError):
+            CompoundFile(b'{\\rtf1 not a doc file}' + bytes(512))
+
+
+class FakeTransport(object):
+    """paramiko.Transport whose sessions are refused with error"""
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def is_authenticated(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+    def open_session(self):
+        if self.error is not None:
+            raise self.error
+        return 'channel'
+
+    def close(self):
+        self.active = False
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Test the reconnects of the shared ssh transports"""
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.key = ('edge', 22, 'user', 0)
+
+    def test_refused_channel(self):
+        """check that a channel refused by the server keeps the transport"""
+        transport = self.pool.transports[self.key] = FakeTransport(paramiko.ChannelException(1, 'refused'))
+        with patch.object(self.pool, 'open_transport') as open_transport:
+            self.assertRaises(paramiko.ChannelException, self.pool.open_channel, 'edge', 22, 'user', 'pw')
+        open_transport.assert_not_called()
+        self.assertTrue(transport.active)
+        self.assertIs(self.pool.transports[self.key], transport)
+
+    def test_dropped_transport(self):
+        """check that a dropped transport is reconnected once"""
+        transport = self.pool.transports[self.key] = FakeTransport()
+
+        def drop():
+            transport.active = False
+            raise EOFError()
+        transport.open_session = drop
+        with patch.object(self.pool, 'open_transport', return_value=FakeTransport()):
+            self.assertEqual(self.pool.open_channel('edge', 22, 'user', 'pw'), 'channel')
+        self.assertIsNot(self.pool.transports[self.key], transport)
+
+
+class FakeSftpFile(io.BytesIO):
+    """In memory remote file of FakeSftpClient"""
+
+    def __init__(self, files: dict, name: str, mode: str):
+        super().__init__(files.get(name, b'') if 'r' in mode else b'')
+        self.files = files
+        self.name = name
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def prefetch(self, length=None):
+        pass
+
+    def check(self, hash_algorithm, offset=0, length=0):
+        raise IOError("the server has no check-file extension")
+
+    def close(self):
+        if not self.closed:
+            self.files[self.name] = self.getvalue()
+        super().close()
+
+
+class FakeSftpClient(object):
+    """The part of paramiko.SFTPClient used by SftpConnection.upload_file"""
+
+    def __init__(self, files: dict = None):
+        self.files = {} if files is None else files
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def stat(self, name: str):
+        if name not in self.files:
+            raise FileNotFoundError(name)
+        return SimpleNamespace(st_size=len(self.files[name]))
+
+    def open(self, name: str, mode: str = 'rb'):
+        return FakeSftpFile(self.files, name, mode)
+
+
+class TestSftpUpload(unittest.TestCase):
+    """Test the sftp uploads against a fake sftp client"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.local_file = os.path.join(self.tmp_dir.name, 'Docx_MergedDataFrame.csv')
+        with open(self.local_file, 'wb') as f:
+            f.write(b'files,raw_text\nclaim.docx,new text\n')
+        self.sftp = SftpConnection(root_path=self.tmp_dir.name, remote_path='/remote')
+        self.remote_file = '/remote/Docx_MergedDataFrame.csv'
+
+    def test_rerun_overwrites(self):
+        """check that a regenerated file replaces a stale remote file of the same size"""
+        client = FakeSftpClient({self.remote_file: b'files,raw_text\nclaim.docx,old text\n'})
+        result = self.sftp.upload_file(client, self.local_file)
+        self.assertEqual(result['status'], 'uploaded')
+        with open(self.local_file, 'rb') as f:
+            self.assertEqual(client.files[self.remote_file], f.read())
+
+    def test_connect_closes_session(self):
+        """check that connect uploads the file and closes its sftp session"""
+        client = FakeSftpClient()
+        sftp = SftpConnection(root_path=self.tmp_dir.name, remote_path='/remote',
+                              pool=Mock(open_sftp=Mock(return_value=client)))
+        sftp.connect(filename='Docx_MergedDataFrame.csv', filepath=self.tmp_dir.name)
+        self.assertIn(self.remote_file, client.files)
+        self.assertTrue(client.closed)
+        self.assertIsNone(sftp.client)
+
+    def test_upload_files_own_transports(self):
+        """check that every upload channel gets a transport of its own"""
+        files = {}
+        pool = Mock(open_sftp=Mock(side_effect=lambda *args, transport_index: FakeSftpClient(files)))
+        sftp = SftpConnection(root_path=self.tmp_dir.name, remote_path='/remote', pool=pool)
+        for i in range(3):
+            with open(os.path.join(self.tmp_dir.name, f'claim_{i}.csv'), 'wb') as f:
+                f.write(b'x' * (i + 1))
+        results = sftp.upload_files([f'claim_{i}.csv' for i in range(3)], self.tmp_dir.name, channels=2)
+        self.assertEqual([r['status'] for r in results], ['uploaded'] * 3)
+        self.assertEqual(sorted(c.kwargs['transport_index'] for c in pool.open_sftp.call_args_list), [0, 1])
+        self.assertEqual(len(files), 3)
+
+    def test_verify_resumes(self):
+        """check that only a verified prefix of the local file is resumed"""
+        with open(self.local_file, 'rb') as f:
+            data = f.read()
+        client = FakeSftpClient({self.remote_file: data[:10]})
+        result = self.sftp.upload_file(client, self.local_file, verify=True)
+        self.assertEqual((result['status'], result['bytes']), ('resumed', len(data) - 10))
+        self.assertEqual(client.files[self.remote_file], data)
+        client.files[self.remote_file] = b'x' * 10
+        result = self.sftp.upload_file(client, self.local_file, verify=True)
+        self.assertEqual(result['status'], 'uploaded')
+        self.assertEqual(client.files[self.remote_file], data)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestHdfsBulkLoad(unittest.TestCase):
+    """Test the grouping of files into hdfs puts"""
+
+    def test_plan_put_batches(self):
+        """check that large files are put alone and small files are batched"""
+        sizes = {'big.csv': 100, 'a.csv': 10, 'b.csv': 30, 'c.csv': 20, 'd.csv': 5}
+        batches = plan_put_batches(sizes, small_file_bytes=50, batch_bytes=40)
+        self.assertEqual(batches, [['big.csv'], ['b.csv'], ['c.csv', 'a.csv', 'd.csv']])
+
+    def test_max_files(self):
+        """check that a put never has more than max_files files"""
+        sizes = {f'{i}.csv': 1 for i in range(5)}
+        batches = plan_put_batches(sizes, small_file_bytes=50, batch_bytes=40, max_files=2)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+    def test_parse_hdfs_listing(self):
+        """check that only the files of a hdfs dfs -ls are listed, with their sizes"""
+        lines = ['Found 3 items',
+                 'drwxr-xr-x   - etl hadoop          0 2019-05-08 10:00 /data/claims/archive',
+                 '-rw-r--r--   3 etl hadoop       1024 2019-05-08 10:00 /data/claims/a.csv',
+                 '-rw-r--r--   3 etl hadoop         10 2019-05-08 10:01 /data/claims/b c.csv']
+        self.assertEqual(parse_hdfs_listing(lines), {'a.csv': 1024, 'b c.csv': 10})
+
+    def test_failed_put(self):
+        """check that only the files missing from hdfs after a failed put fail, and are put again with -f"""
+        hdfs = HDFS(file_path='/edge', username='user', password='pw', host='edge', port=22, pool=Mock())
+        hdfs.connected = True
+        hdfs.exec_command = Mock(return_value=(None, Mock(**{'channel.recv_exit_status.return_value': 0}), None))
+        landed = {'done.csv': 5}     # put by an earlier run
+        puts = []
+
+        def put_files(hdfs_path, files, overwrite):
+            puts.append((sorted(files), overwrite))
+            if len(puts) == 1:      # the batch fails on b.csv after a.csv landed
+                landed['a.csv'] = 10
+                return {'files': files, 'exit_status': 1, 'error': 'put: b.csv: failed', 'seconds': 2.0}
+            landed.update((f, 20) for f in files)
+            return {'files': files, 'exit_status': 0, 'error': '', 'seconds': 1.0}
+        hdfs.put_files = put_files
+        hdfs.hdfs_sizes = lambda hdfs_path: dict(landed)
+        hdfs.remote_sizes = lambda files: {'a.csv': 10, 'b.csv': 20, 'done.csv': 5, 'gone.csv': None}
+        results = hdfs.bulk_load('/data/claims', ['a.csv', 'b.csv', 'done.csv', 'gone.csv'])
+        self.assertEqual([r['status'] for r in results], ['loaded', 'loaded', 'skipped', 'missing'])
+        self.assertEqual(puts, [(['a.csv', 'b.csv'], False), (['b.csv'], True)])
+
+
+class TestHiveOutput(unittest.TestCase):
+    """Test the split of hive -v output into the results of a batch's statements"""
+
+    def test_fetched_rows(self):
+        """check the timings and row counts of statements that all ran"""
+        statements = ['USE drw', 'SELECT COUNT(*) FROM claims']
+        lines = ['Logging initialized using configuration in hive-log4j.properties',
+                 'USE drw', 'OK', 'Time taken: 0.02 seconds',
+                 'SELECT COUNT(*) FROM claims', 'OK', '42',
+                 'Time taken: 3.5 seconds, Fetched: 1 row(s)']
+        results = parse_hive_output(statements, lines)
+        self.assertEqual([r.status for r in results], ['ok', 'ok'])
+        self.assertEqual([r.seconds for r in results], [0.02, 3.5])
+        self.assertEqual(results[1].rows, 1)
+        self.assertEqual(results[1].output, ['42'])
+
+    def test_failed_statement(self):
+        """check that the statements after a FAILED line are reported as not run"""
+        statements = ['USE drw', 'CREATE TABLE claims (raw_text STRING)',
+                      "LOAD DATA INPATH '/tmp/missing.csv' INTO TABLE claims",
+                      'SELECT COUNT(*) FROM claims', 'DROP TABLE claims_old']
+        lines = ['USE drw', 'OK', 'Time taken: 0.02 seconds',
+                 'CREATE TABLE claims (raw_text STRING)', 'OK', 'Time taken: 1.2 seconds',
+                 "LOAD DATA INPATH '/tmp/missing.csv' INTO TABLE claims",
+                 "FAILED: SemanticException Line 1:17 Invalid path ''/tmp/missing.csv''",
+                 'Time taken: 0.1 seconds']     # never matched to a statement
+        results = parse_hive_output(statements, lines)
+        self.assertEqual([r.statement for r in results], statements)
+        self.assertEqual([r.status for r in results], ['ok', 'ok', 'failed', 'not run', 'not run'])
+        self.assertTrue(results[2].output[-1].startswith('FAILED: SemanticException'))
+        self.assertEqual([r.seconds for r in results[2:]], [None, None, None])
+
+
+class TestDagRunner(unittest.TestCase):
+    """Test the pipeline's task runner"""
+
+    def test_dependencies(self):
+        """check that results are passed along the dependencies"""
+        dag = DagRunner(cpu_workers=1, io_workers=2)
+        dag.add('parse', lambda ext: ext.upper(), 'docx', executor='cpu')
+        dag.add('upload', lambda parsed: parsed + '.csv.gz', dag.output('parse'), depends_on=['parse'])
+        results = dag.run()
+        self.assertEqual(results['upload'].result, 'DOCX.csv.gz')
+
+    def test_failed_dependency(self):
+        """check that the tasks after a failed task are skipped"""
+        dag = DagRunner()
+        dag.add('parse', lambda: 1 / 0, executor='cpu')
+        dag.add('upload', print, depends_on=['parse'])
+        results = dag.run()
+        self.assertEqual([results['parse'].status, results['upload'].status], ['failed', 'skipped'])
+
+    def test_slots(self):
+        """check that tasks sharing a slot don't run at the same time"""
+        import threading
+        import time
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def upload():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        dag = DagRunner(io_workers=4, slots={'upload': 1})
+        for i in range(3):
+            dag.add(f'upload_{i}', upload, slot='upload')
+        dag.run()
+        self.assertEqual(peak[0], 1)
+
+    def test_deadline(self):
+        """check that the deadline times out the running and waiting tasks"""
+        import time
+        dag = DagRunner()
+        # a step that checks cancel_event stops early, one that doesn't run at all is skipped
+        dag.add('parse', dag.cancel_event.wait, 30, executor='cpu')
+        dag.add('upload', print, depends_on=['parse'])
+        start_time = time.time()
+        results = dag.run(deadline=0.2)
+        self.assertEqual([results['parse'].status, results['upload'].status], ['timeout', 'timeout'])
+        self.assertTrue(dag.cancel_event.is_set())
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_unknown_dependency(self):
+        """check that a task must be added after its dependencies"""
+        with self.assertRaises(KeyError):
+            DagRunner().add('upload', print, depends_on=['parse'])
+
+
+class TestRunCheckpoint(unittest.TestCase):
+    """Test the crash-resumable parser runs"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def test_resume(self):
+        """check that a resumed run restores the checkpointed files only"""
+        checkpoint = RunCheckpoint(self.tmp_dir.name, 'Docx_test', checkpoint_every=2)
+        checkpoint.start()
+        checkpoint.add({'a.docx': 'claim a'}, [])
+        checkpoint.add({'b.docx': 'claim b'}, ['c.docx'])
+        checkpoint.add({'d.docx': 'claim d'}, [])   # not checkpointed before the crash
+        resumed = RunCheckpoint(self.tmp_dir.name, 'Docx_test', checkpoint_every=2)
+        self.assertEqual(resumed.start(resume=True), {'a.docx': 'claim a', 'b.docx': 'claim b'})
+        self.assertEqual(resumed.files_with_status('error'), ['c.docx'])
+        self.assertTrue(resumed.is_done(os.path.join('raw', 'c.docx')))
+        self.assertFalse(resumed.is_done(os.path.join('raw', 'd.docx')))
+        resumed.close()
+
+    def test_torn_line(self):
+        """check that a resumed run cuts a torn last record before appending"""
+        checkpoint = RunCheckpoint(self.tmp_dir.name, 'Docx_test', checkpoint_every=1)
+        checkpoint.start()
+        checkpoint.add({'a.docx': 'claim a'}, [])
+        checkpoint.partial.close()
+        with open(os.path.join(self.tmp_dir.name, 'Docx_test_partial.jsonl'), 'a') as f:
+            f.write('{"files": "b.docx", "raw_te')   # the crash tore the last record
+        resumed = RunCheckpoint(self.tmp_dir.name, 'Docx_test', checkpoint_every=1)
+        self.assertEqual(resumed.start(resume=True), {'a.docx': 'claim a'})
+        resumed.add({'b.docx': 'claim b'}, [])
+        resumed.close()
+        resumed = RunCheckpoint(self.tmp_dir.name, 'Docx_test')
+        self.assertEqual(resumed.start(resume=True), {'a.docx': 'claim a', 'b.docx': 'claim b'})
+        resumed.close()
+
+    def test_page_sink(self):
+        """check that a resumed run cuts the page records written after the last checkpoint"""
+        page_sink = JsonLinesSink(self.tmp_dir.name, 'Pdf_ByPage_test.jsonl')
+        checkpoint = RunCheckpoint(self.tmp_dir.name, 'Pdf_test', checkpoint_every=1)
+        checkpoint.start(page_sink=page_sink)
+        page_sink.write_record({'filename': 'a.pdf', 'page': 0})
+        checkpoint.add({'a.pdf': 'claim a'}, [])
+        page_sink.write_record({'filename': 'b.pdf', 'page': 0})  # the crash comes before b.pdf is done
+        page_sink.close()
+        page_sink = JsonLinesSink(self.tmp_dir.name, 'Pdf_ByPage_test.jsonl', append=True)
+        resumed = RunCheckpoint(self.tmp_dir.name, 'Pdf_test', checkpoint_every=1)
+        self.assertEqual(resumed.start(resume=True, page_sink=page_sink), {'a.pdf': 'claim a'})
+        page_sink.write_record({'filename': 'b.pdf', 'page': 0})
+        resumed.add({'b.pdf': 'claim b'}, [])
+        resumed.close()
+        page_sink.close()
+        records = list(iter_json_lines(self.tmp_dir.name, 'Pdf_ByPage_test.jsonl'))
+        self.assertEqual([r['filename'] for r in records], ['a.pdf', 'b.pdf'])
+
+    def test_start_over(self):
+        """check that a run without resume discards the last checkpoint"""
+        checkpoint = RunCheckpoint(self.tmp_dir.name, 'Docx_test', checkpoint_every=1)
+        checkpoint.start()
+        checkpoint.add({'a.docx': 'claim a'}, [])
+        checkpoint.close()
+        restarted = RunCheckpoint(self.tmp_dir.name, 'Docx_test')
+        self.assertEqual(restarted.start(resume=False), {})
+        self.assertEqual(restarted.done, {})
+        restarted.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestDeltaSelector(unittest.TestCase):
+    """Test the incremental selection of the delta's files"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for file_name in ('new_a.docx', 'new_b.docx', 'changed_c.docx', 'new_d.pdf', 'new_b.pdf'):
+            with open(os.path.join(self.tmp_dir.name, file_name), 'w') as f:
+                f.write('claim')
+
+    def selector(self, metadata_date: str, rows: list = None) -> DeltaSelector:
+        rows = rows or [('new_a.docx', None, 'New'), ('new_b', None, ' new '),
+                        ('changed_c.docx', 'old_c.docx', 'Changed'), ('new_d.pdf', None, 'New'),
+                        ('old_e.docx', None, 'Unchanged')]
+        metadata = LoadMetaData()
+        metadata.last_used_metadata_file = metadata_date
+        metadata.current_metadata_file = pd.DataFrame(
+            rows, columns=['Object_name', 'Prior_Version_Object_Name', 'new/changed'])
+        return DeltaSelector(metadata=metadata, watermark_path=self.tmp_dir.name)
+
+    def test_first_run(self):
+        """check that the new and changed files of the file ext are selected and the rest skipped"""
+        selector = self.selector('20190502')
+        self.assertEqual(selector.files_to_parse('docx'), {'new_a.docx', 'new_b.docx', 'changed_c.docx'})
+        self.assertEqual(selector.files_to_parse('pdf'), {'new_b.pdf', 'new_d.pdf'})
+        files = selector.select_files(file_path=self.tmp_dir.name, file_ext='docx')
+        self.assertEqual(sorted(os.path.basename(f) for f in files),
+                         ['changed_c.docx', 'new_a.docx', 'new_b.docx'])
+
+    def test_rerun_skips_processed(self):
+        """check that a rerun of the same delta skips the processed files of each file ext"""
+        selector = self.selector('20190502')
+        selector.files_to_parse('docx')
+        selector.update_watermark([os.path.join(self.tmp_dir.name, 'new_b.docx'),
+                                   os.path.join(self.tmp_dir.name, 'changed_c.docx')])
+        self.assertEqual(self.selector('20190502').files_to_parse('docx'), {'new_a.docx'})
+        self.assertEqual(self.selector('20190502').files_to_parse('pdf'), {'new_b.pdf', 'new_d.pdf'})
+
+    def test_changed_in_later_delta(self):
+        """check that a new file is parsed once but a changed one again in a later delta"""
+        self.selector('20190502').update_watermark(['new_a.docx', 'new_b.docx', 'changed_c.docx'])
+        self.assertEqual(self.selector('20190503').files_to_parse('docx'), {'changed_c.docx'})
+
+    def test_prior_version_superseded(self):
+        """check that a prior version is never selected again once its successor is processed"""
+        selector = self.selector('20190503')
+        selector.files_to_parse('docx')
+        selector.update_watermark(['changed_c.docx'])
+        later = self.selector('20190504', rows=[('old_c.docx', None, 'Changed')])
+        self.assertEqual(later.files_to_parse('docx'), set())
+        same_delta = self.selector('20190505', rows=[('old_f.docx', None, 'New'),
+                                                     ('changed_f.docx', 'old_f', 'Changed')])
+        self.assertEqual(same_delta.files_to_parse('docx'), {'changed_f.docx'})
+
+    def test_no_metadata(self):
+        """check that selecting without a loaded metadata file fails"""
+        selector = DeltaSelector(metadata=LoadMetaData(), watermark_path=self.tmp_dir.name)
+        self.assertRaises(ValueError, selector.files_to_parse, 'docx')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+def write_pdf(file_name, pages):
+    """Write a pdf with one line of text on each page"""
+    n = len(pages)
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               b'<< /Type /Pages /Kids [' + b' '.join(b'%d 0 R' % (4 + 2 * i) for i in range(n))
+               + b'] /Count %d >>' % n,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, text in enumerate(pages):
+        stream = b'BT /F1 12 Tf 72 720 Td (' + text.encode('latin-1') + b') Tj ET'
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R '
+                       b'/Resources << /Font << /F1 3 0 R >> >> >>' % (5 + 2 * i))
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+    body, offsets = b'%PDF-1.4\n', []
+    for i, obj in enumerate(objects):
+        offsets.append(len(body))
+        body += b'%d 0 obj\n' % (i + 1) + obj + b'\nendobj\n'
+    xref = b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    xref += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    with open(file_name, 'wb') as f:
+        f.write(body + xref + b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                % (len(objects) + 1, len(body)))
+
+
+class FakeOCREngine(object):
+    """OCREngine that reads every image as the same scanned claim form"""
+
+    def ocr_images(self, payloads):
+        for payload in payloads:
+            yield payload.name, 'Scanned claim form', None, 0.5
+
+
+class TestPdfRouting(unittest.TestCase):
+    """Test the routing of pdf pages to their text layer or to OCR"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.parser = PdfParser(self.tmp_dir.name, ocr_workers=0, min_text_chars=20)
+
+    def test_route_page(self):
+        """check the text, ocr and empty routes around min_text_chars"""
+        route = lambda text, images: self.parser.route_page(PdfPage(0, text, None, images, 0.1))['route']
+        self.assertEqual(route('x' * 20, 1), 'text')
+        self.assertEqual(route('x' * 19, 1), 'ocr')
+        self.assertEqual(route('', 1), 'ocr')
+        self.assertEqual(route('x' * 19, 0), 'text')    # a short page without images
+        self.assertEqual(route('', 0), 'empty')
+        self.assertEqual(route('x x x', 1), 'ocr')      # spaces don't count
+        self.parser.ocr_workers = None
+        self.assertEqual(route('', 1), 'empty')         # OCR is off
+
+    def test_ocr_pages(self):
+        """check that the OCR text of a page is kept with its short text layer"""
+        pdf_file = os.path.join(self.tmp_dir.name, 'claim.pdf')
+        write_pdf(pdf_file, ['', ''])
+        self.parser.ocr_engine = FakeOCREngine()
+        self.parser.start_document(pdf_file)
+        routed_pages = {0: {'route': 'ocr'}, 1: {'route': 'ocr'}}
+        images = lambda page, prefix: [SimpleNamespace(name=f'{prefix}_0.png')]
+        with patch('data_processing_pipeline_2019_04_30.data_preprocessing.page_images', images):
+            pages = self.parser.ocr_pages(pdf_file, routed_pages, {0: 'claim 7', 1: 'scanned'})
+        self.assertEqual(pages, {0: 'claim 7 scanned claim form', 1: 'scanned claim form'})
+        self.assertEqual(routed_pages[0]['ocr_seconds'], 0.5)
+        self.assertEqual(self.parser.ocr_page_counter, 2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestSandbox(unittest.TestCase):
+    """Test the supervised parser processes"""
+
+    def setUp(self):
+        import zipfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.docx_file = os.path.join(self.tmp_dir.name, 'sample.docx')
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        with zipfile.ZipFile(self.docx_file, 'w') as document:
+            document.writestr('word/document.xml',
+                              f'<w:document {w}><w:body><w:p><w:r><w:t>Claim</w:t></w:r></w:p></w:body></w:document>')
+
+    def test_extract(self):
+        """check that the worker sends back the parser's results"""
+        with SandboxedExtractor('docx', self.tmp_dir.name, timeout=60) as sandbox:
+            results, reason = sandbox.extract(self.docx_file)
+        self.assertIsNone(reason)
+        self.assertEqual(results['mapping_dict'], {'sample.docx': 'claim'})
+
+    def test_timeout(self):
+        """check that a worker over the time limit is killed and replaced"""
+        with SandboxedExtractor('docx', self.tmp_dir.name, timeout=0, poll_interval=0) as sandbox:
+            results, reason = sandbox.extract(self.docx_file)
+            self.assertIsNone(results)
+            self.assertTrue(reason.startswith('timeout'))
+            self.assertIsNone(sandbox.process)
+            sandbox.timeout = 60
+            results, reason = sandbox.extract(self.docx_file)
+        self.assertEqual(results['mapping_dict'], {'sample.docx': 'claim'})
+        self.assertEqual(sandbox.worker_counter, 2)
+
+    def test_unset_limit(self):
+        """check that a limit left at None isn't checked"""
+        with patch.object(SandboxedExtractor, 'rss_mb', return_value=10 ** 6):
+            with SandboxedExtractor('docx', self.tmp_dir.name, timeout=60) as sandbox:
+                results, reason = sandbox.extract(self.docx_file)
+        self.assertIsNone(reason)
+        self.assertEqual(sandbox.memory_counter, 0)
+
+    def test_pdf_page_workers(self):
+        """check that a sandboxed pdf parser can start its page processes"""
+        pdf_file = os.path.join(self.tmp_dir.name, 'sample.pdf')
+        write_pdf(pdf_file, [f'Claim page {pg}' for pg in range(6)])
+        options = {'page_workers': 2, 'pages_per_task': 2}
+        with SandboxedExtractor('pdf', self.tmp_dir.name, options=options, timeout=120) as sandbox:
+            results, reason = sandbox.extract(pdf_file)
+        self.assertIsNone(reason)
+        self.assertEqual(results['error_files'], [])
+        self.assertEqual(results['mapping_dict']['sample.pdf'],
+                         ''.join(f'claim page {pg}' for pg in range(6)))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
 if __name__ == '__main__':
     unittest.main()